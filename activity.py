@@ -0,0 +1,77 @@
+from CTFd.utils import get_config
+
+import logging
+
+logger = logging.getLogger('machine')
+
+# Seconds between two heartbeats of the challenge view, see machineHeartbeat in assets/view.js
+HEARTBEAT_INTERVAL = 60
+# Heartbeats closer than this are not written, so polling doesn't turn every read into a write.
+# Half the interval, so a heartbeat arriving a little early is still recorded.
+HEARTBEAT_THROTTLE = HEARTBEAT_INTERVAL // 2
+# Shorter idle timeouts are raised to this, so a single late or lost heartbeat does not reclaim a machine
+MIN_IDLE_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+
+_sources = {}
+
+def source(name):
+    """
+    Register an activity source under a name, selected with MACHINECHALL_ACTIVITY_SOURCE.
+
+    A source is called with the list of MachineActiveModel objects that may be idle and
+    returns a dictionary of machine log id to the datetime (UTC) of its latest activity.
+    Machines missing from the dictionary have no known activity since their admission.
+    """
+    def decorator(func):
+        _sources[name] = func
+        return func
+    return decorator
+
+
+@source('heartbeat')
+def heartbeat_activity(active_machines):
+    """
+    Latest status request of the player, recorded by the challenge view while it is open.
+
+    Closing the challenge modal stops the heartbeat, even if the player keeps working on the
+    machine over SSH or netcat, so the heartbeat alone never reclaims machines, see traffic_source().
+    """
+    return {
+        active_machine.log_id: active_machine.last_seen
+        for active_machine in active_machines if active_machine.last_seen != None
+    }
+
+
+def traffic_source():
+    """
+    Activity source configured on top of the heartbeat, reporting the traffic of the machines.
+    Idle machines are only reclaimed with one, players mostly work with the challenge modal closed.
+
+    :return: Source function, or None when only the heartbeat is available
+    """
+    name = get_config('MACHINECHALL_ACTIVITY_SOURCE') or 'heartbeat'
+    if name == 'heartbeat':
+        return None
+    func = _sources.get(name)
+    if func == None:
+        logger.info(f"[IDLE] Unknown activity source {name}")
+    return func
+
+
+def last_activity(active_machines):
+    """
+    Latest activity of the given machines, the heartbeat merged with the configured source.
+
+    :param active_machines: list of MachineActiveModel object
+    :return: Dictionary of machine log id to datetime
+    """
+    latest = heartbeat_activity(active_machines)
+    func = traffic_source()
+    if func == None:
+        return latest
+    # Errors are raised, an unreachable source must not make every machine look idle
+    found = func(active_machines)
+    for machine_id, seen in found.items():
+        if seen != None and (latest.get(machine_id) == None or seen > latest[machine_id]):
+            latest[machine_id] = seen
+    return latest
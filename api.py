@@ -1,25 +1,52 @@
-from .models import MachineLogModel, MachineChallenge
+from . import metrics, ratelimit, teardown
+from .models import MachineActiveModel, MachineChallenge, MachineLogModel, solved_challenge_ids, state_version
 from .schema import MachineLogSchema
 
-from flask import request, views
+from flask import Response, request, stream_with_context, views
 from flask_restx import Resource, Namespace
 from werkzeug.exceptions import NotFound, abort
 
 from CTFd.api import CTFd_API_v1
+from CTFd.cache import cache
 from CTFd.api.v1.challenges import Challenge as ChallengeAPI
-from CTFd.models import Challenges, Solves
+from CTFd.models import Challenges, db
 from CTFd.plugins.challenges import get_chal_class
-from CTFd.utils import config
+from CTFd.utils import config, get_config
 from CTFd.utils.dates import ctf_paused
 from CTFd.utils.decorators import admins_only, during_ctf_time_only, require_verified_emails
 from CTFd.utils.decorators.visibility import check_challenge_visibility
 from CTFd.utils.user import authed, get_current_user, is_admin
 
+from datetime import datetime
+
+import json
 import logging
+import time
 
 machineLogDumper = MachineLogSchema()
 logger = logging.getLogger('machine')
 
+def dump_machine(machine):
+    data = machineLogDumper.dump(machine).data
+    if json.loads(machine.detail).get('lastStatus') == 'QUEUED':
+        data['queue_position'] = MachineChallenge.queueposition(machine.id)
+    # Counted on the server, so the countdown doesn't depend on the clock of the browser
+    if machine.status == 1:
+        data['seconds_remaining'] = max(0, int((machine.time_end - datetime.utcnow()).total_seconds()))
+        extensions = MachineActiveModel.query.with_entities(MachineActiveModel.extensions).filter(
+            MachineActiveModel.log_id == machine.id
+        ).scalar()
+        if extensions != None:
+            data['extensions_left'] = max(0, int(get_config('MACHINECHALL_MAX_EXTENSIONS') or 0) - extensions)
+    return data
+
+# Seconds between machine state version checks and lifetime of a single event stream.
+# Browsers reconnect by themselves after the stream is closed.
+STREAM_INTERVAL = 1
+STREAM_TIMEOUT = 60
+# Seconds after which the database is read even if the version did not change, e.g. on cache eviction
+STREAM_RECHECK = 15
+
 class ChallengeAPIMod(ChallengeAPI, views.View):
     @check_challenge_visibility
     @during_ctf_time_only
@@ -77,15 +104,8 @@ class MachineList(Resource):
                 abort(403)
             if challenge.requirements:
                 requirements = challenge.requirements.get("prerequisites", [])
-                solve_ids = (
-                    Solves.query.with_entities(Solves.challenge_id)
-                    .filter_by(account_id=user.account_id)
-                    .order_by(Solves.challenge_id.asc())
-                    .all()
-                )
-                solve_ids = {solve_id for solve_id, in solve_ids}
                 prereqs = set(requirements)
-                if solve_ids < prereqs:
+                if not prereqs <= solved_challenge_ids(user.account_id):
                     abort(403)
 
 
@@ -93,16 +113,44 @@ class MachineList(Resource):
         if not hasattr(chall_class, "startmachine"):
             abort(400)
 
+        # A retried request with the same Idempotency-Key gets the machine of the first one
+        idempotency_key = request.headers.get("Idempotency-Key")
+        if idempotency_key:
+            idempotency_key = f"machine:idempotency:{user.id}:{challenge.id}:{idempotency_key[:64]}"
+            # 0 marks a request in progress, replaced by the machine id once started
+            if not cache.add(idempotency_key, 0, timeout=60):
+                machine_id = cache.get(idempotency_key)
+                machine = MachineLogModel.query.filter_by(id = machine_id, user_id = user.id).first() if machine_id else None
+                if machine == None:
+                    return {"success": False, "errors": "The request is already being processed"}, 409
+                return {"success": True, "data": dump_machine(machine)}
+
+        started = time.monotonic()
         try:
             machine = chall_class.startmachine(user, challenge)
-            response = machineLogDumper.dump(machine)
+            response = dump_machine(machine)
         except Exception as e:
-            logger.error(f"Failed start machine: {user.name} - {challenge_id} - {str(e)}")
+            if idempotency_key:
+                cache.delete(idempotency_key)
+            logger.error(
+                f"Failed start machine: {user.name} - {challenge_id} - {str(e)}",
+                extra={"user_id": user.id, "challenge_id": challenge.id, "duration": time.monotonic() - started}
+            )
             return {"success": False, "errors": str(e)}, 500
-        return {"success": True, "data": response.data}
+        logger.info(
+            f"Started machine: {user.name} - {challenge_id}",
+            extra={
+                "machine_id": machine.id, "user_id": user.id, "challenge_id": challenge.id,
+                "task_arn": machine.task_id, "duration": time.monotonic() - started
+            }
+        )
+        if idempotency_key:
+            cache.set(idempotency_key, machine.id, timeout=int(get_config('MACHINECHALL_IDEMPOTENCY_TTL') or 600))
+        return {"success": True, "data": response}
 
 
     @admins_only
+    @ratelimit.bulk
     @machine_namespace.doc(
         description="Endpoint to terminate multi machine"
     )
@@ -112,22 +160,22 @@ class MachineList(Resource):
         if machine_ids == None or not isinstance(machine_ids, list):
             abort(400)
         
-        machines = MachineLogModel.query.filter(
-            MachineLogModel.status == 1,
-            MachineLogModel.id.in_(machine_ids)
+        machines = MachineActiveModel.query.filter(
+            MachineActiveModel.log_id.in_(machine_ids)
         ).all()
 
+        results = MachineChallenge.terminatemachines(machines)
+
         err = []
-        for machine in machines:
-            try:
-                MachineChallenge.terminatemachine(machine.user, machine.challenge)
-            except Exception as e:
-                logger.error(f"Failed bulk terminate machine: {machine.id} - {str(e)}")
-                err.append(f"ERROR: {machine.id} - {str(e)}")
+        for machine_id, result in results.items():
+            if result != None:
+                logger.error(f"Failed bulk terminate machine: {machine_id} - {result}", extra={"machine_id": machine_id})
+                err.append(f"ERROR: {machine_id} - {result}")
+        data = {machine_id: result or "terminated" for machine_id, result in results.items()}
         if len(err) == 0:
-            return {"success": True}
+            return {"success": True, "data": data}
         else:
-            return {"success": False, "errors": err}, 500
+            return {"success": False, "errors": err, "data": data}, 500
 
 
 @machine_namespace.route("/<challenge_id>")
@@ -151,13 +199,16 @@ class Machine(Resource):
 
         try:
             machine = chall_class.updatemachine(user, challenge)
-            response = machineLogDumper.dump(machine)
+            response = dump_machine(machine)
         except NotFound as e:
             return {'success': False, 'errors': str(e)}
         except Exception as e:
-            logger.error(f"Failed update machine: {user.name} - {challenge_id} - {str(e)}")
+            logger.error(
+                f"Failed update machine: {user.name} - {challenge_id} - {str(e)}",
+                extra={"user_id": user.id, "challenge_id": challenge.id}
+            )
             return {"success": False, "errors": str(e)}, 500
-        return {"success": True, "data": response.data}
+        return {"success": True, "data": response}
 
 
     @check_challenge_visibility
@@ -177,14 +228,167 @@ class Machine(Resource):
         if not hasattr(chall_class, "terminatemachine"):
             abort(400)
 
+        started = time.monotonic()
         try:
             stt = chall_class.terminatemachine(user, challenge)
         except Exception as e:
-            logger.error(f"Failed terminate machine: {user.name} - {challenge_id} - {str(e)}")
+            logger.error(
+                f"Failed terminate machine: {user.name} - {challenge_id} - {str(e)}",
+                extra={"user_id": user.id, "challenge_id": challenge.id, "duration": time.monotonic() - started}
+            )
             return {"success": False, "errors": str(e)}, 500
+        logger.info(
+            f"Terminated machine: {user.name} - {challenge_id}",
+            extra={"user_id": user.id, "challenge_id": challenge.id, "duration": time.monotonic() - started}
+        )
         return {"success": stt}
 
 
+@machine_namespace.route("/<challenge_id>/extend")
+class MachineExtend(Resource):
+    @check_challenge_visibility
+    @during_ctf_time_only
+    @require_verified_emails
+    @machine_namespace.doc(
+        description="Endpoint to extend the lifetime of a machine for a specific challenge"
+    )
+    def post(self, challenge_id):
+        if authed() is False:
+            return {"success": True, "data": {"status": "authentication_required"}}, 403
+
+        user = get_current_user()
+        challenge = Challenges.query.filter_by(id=challenge_id).first_or_404()
+
+        chall_class = get_chal_class(challenge.type)
+        if not hasattr(chall_class, "extendmachine"):
+            abort(400)
+
+        try:
+            machine = chall_class.extendmachine(user, challenge)
+            response = dump_machine(machine)
+        except NotFound as e:
+            return {'success': False, 'errors': str(e)}, 404
+        except Exception as e:
+            logger.error(
+                f"Failed extend machine: {user.name} - {challenge_id} - {str(e)}",
+                extra={"user_id": user.id, "challenge_id": challenge.id}
+            )
+            return {"success": False, "errors": str(e)}, 400
+        logger.info(
+            f"Extended machine: {user.name} - {challenge_id}",
+            extra={"machine_id": machine.id, "user_id": user.id, "challenge_id": challenge.id}
+        )
+        return {"success": True, "data": response}
+
+
+@machine_namespace.route("/<challenge_id>/events")
+class MachineEvents(Resource):
+    @check_challenge_visibility
+    @during_ctf_time_only
+    @require_verified_emails
+    @machine_namespace.doc(
+        description="Endpoint to stream the status changes of a machine for a specific challenge as Server-Sent Events"
+    )
+    def get(self, challenge_id):
+        if authed() is False:
+            return {"success": True, "data": {"status": "authentication_required"}}, 403
+
+        user = get_current_user()
+        challenge = Challenges.query.filter_by(id=challenge_id).first_or_404()
+
+        chall_class = get_chal_class(challenge.type)
+        if not hasattr(chall_class, "updatemachine"):
+            abort(400)
+
+        user_id = user.id
+        chall_id = challenge.id
+
+        def stream():
+            last_state = None
+            last_version = None
+            queued = False
+            checked = 0
+            deadline = time.monotonic() + STREAM_TIMEOUT
+            while time.monotonic() < deadline:
+                # Only the cached state version is polled, the database is read when it changes
+                version = state_version(user_id, chall_id, queued)
+                if version == last_version and time.monotonic() - checked < STREAM_RECHECK:
+                    time.sleep(STREAM_INTERVAL)
+                    continue
+                last_version = version
+                checked = time.monotonic()
+
+                machine = MachineActiveModel.query.filter(
+                    MachineActiveModel.user_id == user_id,
+                    MachineActiveModel.chall_id == chall_id
+                ).first()
+                if machine == None:
+                    # The machine that was watched, or the latest one when it was gone from the start
+                    machine_log = MachineLogModel.query.filter(
+                        MachineLogModel.user_id == user_id,
+                        MachineLogModel.chall_id == chall_id
+                    )
+                    if last_state != None:
+                        machine_log = machine_log.filter(MachineLogModel.id == last_state[0])
+                    machine_log = machine_log.order_by(MachineLogModel.id.desc()).first()
+                    db.session.close()
+                    detail = json.loads(machine_log.detail) if machine_log != None else {}
+                    if detail.get('lastStatus') == 'FAILED':
+                        yield f"event: error\ndata: {json.dumps({'success': False, 'errors': detail.get('error', '')})}\n\n"
+                    else:
+                        yield "event: terminated\ndata: {}\n\n"
+                    return
+
+                queued = machine.last_status == 'QUEUED'
+                state = (machine.log_id, machine.last_status, machine.public_ip, machine.time_end)
+                if queued:
+                    state += (MachineChallenge.queueposition(machine.log_id),)
+                last_status = machine.last_status
+                payload = None
+                if state != last_state:
+                    payload = json.dumps({"success": True, "data": dump_machine(machine.log)})
+                    last_state = state
+                # Release the connection while waiting, and see fresh rows on the next check
+                db.session.close()
+
+                if payload != None:
+                    yield f"data: {payload}\n\n"
+                if last_status == 'RUNNING':
+                    yield "event: end\ndata: {}\n\n"
+                    return
+                time.sleep(STREAM_INTERVAL)
+
+        return Response(
+            stream_with_context(stream()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+
+@machine_namespace.route("/metrics")
+class MachineMetrics(Resource):
+    @admins_only
+    @machine_namespace.doc(
+        description="Endpoint to get the metrics of every process in the Prometheus text format"
+    )
+    def get(self):
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@machine_namespace.route("/teardown", defaults={"job_id": None})
+@machine_namespace.route("/teardown/<job_id>")
+class MachineTeardown(Resource):
+    @admins_only
+    @machine_namespace.doc(
+        description="Endpoint to get the progress of a challenge teardown job, the latest one by default"
+    )
+    def get(self, job_id):
+        progress = teardown.status(job_id)
+        if progress == None:
+            abort(404)
+        return {"success": True, "data": progress}
+
+
 @machine_namespace.route("/ping")
 class MachinePing(Resource):
     def get(self):
@@ -1,13 +1,31 @@
 var htmlLoading = `<span class="spinner-border spinner-border-sm mr-1" role="status"></span>Processing...`
 
-function setMachineTimer(time_end) {
-    let timer = setInterval(updateExpires, 300, time_end)
+function setMachineTimer(seconds_remaining) {
+    clearMachineTimer()
+    let time_end = Math.floor(Date.now() / 1000) + seconds_remaining
+    updateExpires(time_end)
+    let timer = setInterval(updateExpires, 1000, time_end)
     window.sessionStorage.setItem('machineTimerID', timer)
+    // Status requests tell the server the machine is still in use
+    let heartbeat = setInterval(CTFd._internal.challenge.machineHeartbeat, 60000)
+    window.sessionStorage.setItem('machineHeartbeatID', heartbeat)
 }
 
 function clearMachineTimer() {
     let timer = parseInt(window.sessionStorage.getItem('machineTimerID'))
     clearInterval(timer)
+    let heartbeat = parseInt(window.sessionStorage.getItem('machineHeartbeatID'))
+    clearInterval(heartbeat)
+}
+
+var machineEvents = undefined
+var machineEventsFailed = false
+
+function closeMachineEvents() {
+    if (machineEvents !== undefined) {
+        machineEvents.close()
+        machineEvents = undefined
+    }
 }
 
 function updateButton(id, show, attr, html = undefined) {
@@ -27,9 +45,10 @@ function updateExpires(e) {
     let v = e - s
     let timeLbl = ''
     if (v <= 0) {
+        // The server terminates expired machines, only check the status once it had the time to
         timeLbl = '-'
         clearMachineTimer()
-        CTFd._internal.challenge.machineTerminate()
+        setTimeout(CTFd._internal.challenge.machineStatus, 5000 + Math.random() * 5000, true)
     } else {
         let h = parseInt(v / 3600)
         if (h > 0) timeLbl += `${h}h `
@@ -56,6 +75,7 @@ CTFd._internal.challenge.render = function (markdown) {
 
 CTFd._internal.challenge.postRender = function () {
     clearMachineTimer()
+    closeMachineEvents()
     updateButton('#machine-start', true, {'disabled': true}, htmlLoading)
     CTFd._internal.challenge.machineStatus(true)
 
@@ -66,6 +86,9 @@ CTFd._internal.challenge.postRender = function () {
     jQuery('#machine-terminate').click(function() {
         CTFd._internal.challenge.machineTerminate()
     })
+    jQuery('#machine-extend').click(function() {
+        CTFd._internal.challenge.machineExtend()
+    })
 }
 
 
@@ -95,15 +118,15 @@ CTFd._internal.challenge.submit = function (preview) {
     })
 }
 
-function fetchMachineAPI(method, path, body) {
+function fetchMachineAPI(method, path, body, extraHeaders) {
     let url = CTFd.api.domain + '/machines' + path
     if (body === undefined) {
         body = {}
     }
-    let headers = {
+    let headers = Object.assign({
         'Accept': 'application/json',
         'CSRF-Token': CTFd.config.csrfNonce
-    }
+    }, extraHeaders)
     
     if (method == 'GET') {
         return CTFd.lib.$.ajax(url, {
@@ -127,12 +150,11 @@ CTFd._internal.challenge.machineStart = function () {
     let body = {
         'challenge_id': challenge_id
     }
-    fetchMachineAPI('POST', '', body)
+    // Same key for every retry of this click
+    let idempotencyKey = Date.now().toString(36) + Math.random().toString(36).slice(2)
+    fetchMachineAPI('POST', '', body, {'Idempotency-Key': idempotencyKey})
         .then((data) => {
-            setTimeout(
-                CTFd._internal.challenge.machineStatus,
-                5000
-            )
+            CTFd._internal.challenge.machineWatch()
         })
         .fail((xhr) => {
             let errors = xhr.responseJSON
@@ -145,43 +167,112 @@ CTFd._internal.challenge.machineStart = function () {
         })
 }
 
+function renderMachine(data) {
+    let machineDetail = JSON.parse(data.detail)
+    if (machineDetail['lastStatus'] === 'QUEUED') {
+        CTFd.lib.$('#machine-detail').empty()
+        CTFd.lib.$('#machine-detail').append(`<p>Queued, position ${data.queue_position || '-'}</p>`)
+        updateButton('#machine-terminate', true, {'disabled': false}, 'Cancel')
+    }
+    if (machineDetail['lastStatus'] !== 'RUNNING') return false
+
+    if (data.seconds_remaining !== undefined) {
+        setMachineTimer(data.seconds_remaining)
+    } else {
+        setMachineTimer(Math.floor((Date.parse(data.time_end) - Date.now()) / 1000))
+    }
+
+    CTFd.lib.$('#machine-detail').empty()
+
+    if (machineDetail['containers'].length == 0) {
+        CTFd.lib.$('#machine-detail').append("<p>" + machineDetail['publicIp'] + "</p>")
+    } else {
+        let containerHtml = '<div>';
+        for (let container of machineDetail['containers']) {
+            let html = `[${container['name']}]`
+            for (let port of container['portMappings']) {
+                html += `<br>${machineDetail['publicIp']}:${port['hostPort']}`
+            }
+            containerHtml += "<p>" + html + "</p>"
+        }
+        containerHtml += "</div>"
+        CTFd.lib.$('#machine-detail').append(containerHtml)
+    }
+
+    updateButton('#machine-start', false, {'disabled': true})
+    updateButton('#machine-terminate', true, {'disabled': false}, 'Terminate')
+    if (data.extensions_left === 0) {
+        updateButton('#machine-extend', false, {'disabled': true})
+    } else {
+        let label = data.extensions_left === undefined ? 'Extend' : `Extend (${data.extensions_left})`
+        updateButton('#machine-extend', true, {'disabled': false}, label)
+    }
+    return true
+}
+
+CTFd._internal.challenge.machineWatch = function () {
+    if (window.EventSource === undefined || machineEventsFailed) {
+        setTimeout(CTFd._internal.challenge.machineStatus, 5000)
+        return
+    }
+
+    closeMachineEvents()
+    let url = CTFd.api.domain + '/machines/' + CTFd.lib.$('#challenge-id').val() + '/events'
+    let events = new EventSource(url)
+    machineEvents = events
+
+    events.onmessage = (e) => {
+        let data = JSON.parse(e.data)
+        if (renderMachine(data.data)) closeMachineEvents()
+    }
+    events.addEventListener('end', () => {
+        closeMachineEvents()
+    })
+    events.addEventListener('terminated', () => {
+        closeMachineEvents()
+        updateButton('#machine-start', true, {'disabled': false}, 'Deploy')
+    })
+    events.onerror = (e) => {
+        // Error events sent by the server carry the reason the machine failed to start
+        if (e.data !== undefined) {
+            closeMachineEvents()
+            let data = JSON.parse(e.data)
+            CTFd.lib.$('#machine-detail').empty()
+            CTFd.lib.$('#machine-detail').append('<p>-</p>')
+            updateButton('#machine-terminate', false, {'disabled': true})
+            updateButton('#machine-start', true, {'disabled': false}, 'Deploy')
+            CTFd.ui.ezq.ezAlert({
+                title: 'Failed',
+                body: data.errors || 'Failed to start machine.',
+                button: 'Close'
+            })
+            return
+        }
+        // Closed streams are reopened by the browser, anything else falls back to polling
+        if (events.readyState === EventSource.CLOSED) {
+            machineEventsFailed = true
+            closeMachineEvents()
+            CTFd._internal.challenge.machineStatus()
+        }
+    }
+}
+
 CTFd._internal.challenge.machineStatus = function (check = false) {
     let path = "/" + CTFd.lib.$('#challenge-id').val()
     fetchMachineAPI('GET', path)
         .then((data) => {
             if (data.success == false) {
+                clearMachineTimer()
+                CTFd.lib.$('#machine-detail').empty()
+                CTFd.lib.$('#machine-detail').append('<p>-</p>')
+                updateButton('#machine-terminate', false, {'disabled': true})
+                updateButton('#machine-extend', false, {'disabled': true})
                 updateButton('#machine-start', true, {'disabled': false}, 'Deploy')
                 return;
             }
-            
-            data = data.data
-            
-            let machineDetail = JSON.parse(data.detail)
-            if (machineDetail['lastStatus'] === 'RUNNING') {
-                let timeEnd = Math.floor(Date.parse(data.time_end) / 1000)
-                setMachineTimer(timeEnd)
-
-                CTFd.lib.$('#machine-detail').empty()
 
-                if (machineDetail['containers'].length == 0) {
-                    CTFd.lib.$('#machine-detail').append("<p>" + machineDetail['publicIp'] + "</p>")
-                } else {
-                    let containerHtml = '<div>';
-                    for (let container of machineDetail['containers']) {
-                        let html = `[${container['name']}]`
-                        for (let port of container['portMappings']) {
-                            html += `<br>${machineDetail['publicIp']}:${port['hostPort']}`
-                        }
-                        containerHtml += "<p>" + html + "</p>"
-                    }
-                    containerHtml += "</div>"
-                    CTFd.lib.$('#machine-detail').append(containerHtml)
-                }
-
-                updateButton('#machine-start', false, {'disabled': true})
-                updateButton('#machine-terminate', true, {'disabled': false}, 'Terminate')
-            } else {
-                setTimeout(CTFd._internal.challenge.machineStatus, 5000)
+            if (!renderMachine(data.data)) {
+                CTFd._internal.challenge.machineWatch()
             }
         })
         .fail((xhr) => {
@@ -196,12 +287,31 @@ CTFd._internal.challenge.machineStatus = function (check = false) {
         })
 }
 
+CTFd._internal.challenge.machineHeartbeat = function () {
+    // Closed challenge windows stop the heartbeat, even if the machine is still used over SSH or netcat.
+    // Idle machines are only reclaimed when the server also watches their traffic.
+    if (!CTFd.lib.$('#machine-detail').is(':visible')) {
+        clearMachineTimer()
+        return
+    }
+    let path = "/" + CTFd.lib.$('#challenge-id').val()
+    fetchMachineAPI('GET', path)
+        .then((data) => {
+            if (data.success == false) {
+                CTFd._internal.challenge.machineStatus(true)
+                return
+            }
+            renderMachine(data.data)
+        })
+}
+
 CTFd._internal.challenge.machineTerminate = function () {
     updateButton('#machine-terminate', true, {'disabled': true}, htmlLoading)
     var path ="/" + CTFd.lib.$('#challenge-id').val()
     fetchMachineAPI('DELETE', path)
         .then((data) => {
             clearMachineTimer()
+            closeMachineEvents()
             CTFd.lib.$('#machine-detail').empty()
             CTFd.lib.$('#machine-detail').append('<p>-</p>')
             
@@ -209,6 +319,7 @@ CTFd._internal.challenge.machineTerminate = function () {
             CTFd.lib.$('#machine-expires').append('<p>-</p>')
             
             updateButton('#machine-terminate', false, {'disabled': true})
+            updateButton('#machine-extend', false, {'disabled': true})
             updateButton('#machine-start', true, {'disabled': false}, 'Deploy')
         })
         .fail((xhr) => {
@@ -219,4 +330,22 @@ CTFd._internal.challenge.machineTerminate = function () {
             })
             updateButton('#machine-terminate', true, {'disabled': false}, 'Terminate')
         })
-}
\ No newline at end of file
+}
+
+CTFd._internal.challenge.machineExtend = function () {
+    updateButton('#machine-extend', true, {'disabled': true}, htmlLoading)
+    var path = "/" + CTFd.lib.$('#challenge-id').val() + "/extend"
+    fetchMachineAPI('POST', path)
+        .then((data) => {
+            renderMachine(data.data)
+        })
+        .fail((xhr) => {
+            let errors = xhr.responseJSON || {}
+            CTFd.ui.ezq.ezAlert({
+                title: 'Failed',
+                body: errors['errors'] || 'Failed to extend machine.',
+                button: 'Close'
+            })
+            updateButton('#machine-extend', true, {'disabled': false}, 'Extend')
+        })
+}
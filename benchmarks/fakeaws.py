@@ -0,0 +1,544 @@
+"""
+In-process stand-in for the ECS, EC2, SSM and SQS APIs used by the plugin.
+
+FakeBackend keeps the cluster state and plays the task lifecycle from the
+wall clock: a task is PROVISIONING, then PENDING, then RUNNING once start_delay
+has elapsed. Every call sleeps for the configured latency and is throttled like
+the real APIs once it goes over the per-operation rate of the backend, or at
+random with throttle_rate. Throttled calls are retried like botocore does, up to
+max_attempts, then ClientError is raised.
+
+Every status change of a task is also sent to a single SQS queue as an EventBridge
+"ECS Task State Change" event, like a rule targeting the queue would. Changes played
+from the wall clock are sent when the queue is polled. Received messages come back
+after visibility_timeout unless they are deleted.
+
+FakeSession has the boto3.Session.client() signature and the clients emit the
+before-call and after-call events, so the rate limiter and the metrics of the
+plugin see the calls like they would with botocore.
+"""
+from botocore.exceptions import ClientError
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import itertools
+import json
+import random
+import threading
+import time
+
+# Requests per second of the real APIs (burst, sustained), used for the server side throttling
+AWS_RATES = {
+    'ecs.RunTask': (100, 20),
+    'ecs.StopTask': (100, 20),
+    'ecs.DescribeTasks': (50, 20),
+    'ecs.ListTasks': (50, 20),
+    'ec2.DescribeNetworkInterfaces': (100, 20),
+    'ec2.CreateSecurityGroup': (100, 20),
+    'ec2.DeleteSecurityGroup': (100, 20),
+}
+DEFAULT_RATE = (100, 50)
+
+
+def operation_name(method):
+    return ''.join(word.capitalize() for word in method.split('_'))
+
+
+class Bucket(object):
+    def __init__(self, burst, rate):
+        self.burst = burst
+        self.rate = rate
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class FakeBackend(object):
+    def __init__(self, latency = 0.05, start_delay = 20.0, stop_delay = 5.0, throttle_rate = 0.0,
+                 max_attempts = 5, latencies = None, rates = None, default_rate = DEFAULT_RATE, seed = None,
+                 visibility_timeout = 30.0):
+        """
+        :param latency: mean latency of a call in seconds, the actual latency is +-50% around it
+        :param start_delay: seconds from run_task to RUNNING
+        :param stop_delay: seconds from stop_task to STOPPED
+        :param throttle_rate: probability of a call being throttled regardless of the rates
+        :param max_attempts: attempts of a throttled call before the error is raised
+        :param latencies: dictionary of "<service>.<Operation>" to mean latency
+        :param rates: dictionary of "<service>.<Operation>" to (burst, requests per second), AWS_RATES by default
+        :param default_rate: (burst, requests per second) of the other operations, None leaves them unlimited
+        :param visibility_timeout: seconds before a received SQS message that was not deleted is delivered again
+        """
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.start_delay = start_delay
+        self.stop_delay = stop_delay
+        self.throttle_rate = throttle_rate
+        self.max_attempts = max_attempts
+        self.rates = AWS_RATES if rates == None else rates
+        self.default_rate = default_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.buckets = {}
+        self.calls = Counter()
+        self.throttled = Counter()
+        self.errors = Counter()
+
+        self.tasks = {}
+        self.revisions = defaultdict(list)
+        self.secgroups = {}
+        self.subnets = [
+            {'SubnetId': 'subnet-a', 'AvailabilityZone': 'us-east-1a', 'AvailableIpAddressCount': 4000},
+            {'SubnetId': 'subnet-b', 'AvailabilityZone': 'us-east-1b', 'AvailableIpAddressCount': 4000},
+        ]
+
+        self.visibility_timeout = visibility_timeout
+        self.messages = []
+        self.inflight = {}
+        self.published = {}
+
+    def next_id(self):
+        with self.lock:
+            return f"{next(self.ids):012x}"
+
+    def stats(self):
+        return {
+            name: {'calls': self.calls[name], 'throttled': self.throttled[name], 'errors': self.errors[name]}
+            for name in sorted(self.calls)
+        }
+
+    def call(self, name, func, kwargs):
+        """
+        Run one API call with latency, throttling and retries.
+        """
+        for attempt in range(self.max_attempts):
+            mean = self.latencies.get(name, self.latency)
+            time.sleep(self.random.uniform(mean / 2, mean * 1.5))
+            with self.lock:
+                self.calls[name] += 1
+                if name not in self.buckets:
+                    rate = self.rates.get(name, self.default_rate)
+                    self.buckets[name] = Bucket(*rate) if rate != None else None
+                bucket = self.buckets[name]
+                throttled = (bucket != None and not bucket.take()) or self.random.random() < self.throttle_rate
+                if throttled:
+                    self.throttled[name] += 1
+            if not throttled:
+                try:
+                    return func(**kwargs)
+                except ClientError:
+                    with self.lock:
+                        self.errors[name] += 1
+                    raise
+            # Exponential backoff with jitter, like the botocore retry handlers
+            time.sleep(self.random.uniform(0, min(2, 0.05 * 2 ** attempt)))
+
+        with self.lock:
+            self.errors[name] += 1
+        raise ClientError(
+            {'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}},
+            name.split('.')[1]
+        )
+
+    # Task state change queue
+
+    def send(self, body):
+        """
+        Queue a raw SQS message body.
+
+        :return: message id
+        """
+        with self.lock:
+            message_id = f"msg-{next(self.ids):012x}"
+            self.messages.append({'MessageId': message_id, 'Body': body})
+        return message_id
+
+    def publish_changes(self, arns = None):
+        """
+        Queue a task state change event for every task whose status changed since its last event.
+
+        :param arns: task ARNs to check, every task by default
+        """
+        now = time.monotonic()
+        with self.lock:
+            for arn in list(self.tasks) if arns == None else arns:
+                task = self.tasks.get(arn)
+                if task == None:
+                    continue
+                detail = self.describe(task, now)
+                if self.published.get(arn) == detail['lastStatus']:
+                    continue
+                self.published[arn] = detail['lastStatus']
+                event = {
+                    'version': '0',
+                    'id': f"{next(self.ids):012x}",
+                    'detail-type': 'ECS Task State Change',
+                    'source': 'aws.ecs',
+                    'time': datetime.now(timezone.utc).isoformat(),
+                    'detail': detail,
+                }
+                self.messages.append({'MessageId': f"msg-{next(self.ids):012x}", 'Body': json.dumps(event, default=str)})
+
+    def receive(self, count):
+        """
+        Take up to count messages, messages whose visibility timeout expired come back first.
+        """
+        now = time.monotonic()
+        with self.lock:
+            for receipt, (message, visible) in list(self.inflight.items()):
+                if visible <= now:
+                    del self.inflight[receipt]
+                    self.messages.insert(0, message)
+            batch = self.messages[:count]
+            del self.messages[:count]
+            received = []
+            for message in batch:
+                receipt = f"{message['MessageId']}-{next(self.ids):012x}"
+                self.inflight[receipt] = (message, now + self.visibility_timeout)
+                received.append(dict(message, ReceiptHandle=receipt))
+        return received
+
+    def delete(self, receipts):
+        with self.lock:
+            for receipt in receipts:
+                self.inflight.pop(receipt, None)
+
+    # Task lifecycle
+
+    def task_status(self, task, now):
+        if task['stoppedAt'] != None:
+            return 'STOPPED' if now - task['stoppedAt'] >= self.stop_delay else 'DEPROVISIONING'
+        elapsed = now - task['startedAt']
+        if elapsed < self.start_delay / 3:
+            return 'PROVISIONING'
+        if elapsed < self.start_delay:
+            return 'PENDING'
+        return 'RUNNING'
+
+    def describe(self, task, now):
+        status = self.task_status(task, now)
+        return {
+            'taskArn': task['taskArn'],
+            'taskDefinitionArn': task['taskDefinitionArn'],
+            'launchType': task['launchType'],
+            'lastStatus': status,
+            'desiredStatus': 'STOPPED' if task['stoppedAt'] != None else 'RUNNING',
+            'createdAt': task['createdAt'],
+            'attachments': [{
+                'type': 'ElasticNetworkInterface',
+                'details': [{'name': 'networkInterfaceId', 'value': task['eni']}],
+            }],
+            'containers': [],
+        }
+
+
+class FakeEvents(object):
+    def __init__(self):
+        self.handlers = defaultdict(list)
+
+    def register(self, event_name, handler, unique_id = None):
+        self.handlers[event_name].append(handler)
+
+    def emit(self, event_name, **kwargs):
+        # Handlers registered on a prefix, e.g. before-call.ecs, also receive before-call.ecs.RunTask
+        parts = event_name.split('.')
+        for i in range(1, len(parts) + 1):
+            for handler in self.handlers.get('.'.join(parts[:i]), []):
+                handler(event_name=event_name, **kwargs)
+
+
+class FakePaginator(object):
+    def __init__(self, method, key):
+        self.method = method
+        self.key = key
+
+    def paginate(self, **kwargs):
+        token = None
+        while True:
+            page = self.method(nextToken=token, **kwargs) if token else self.method(**kwargs)
+            yield page
+            token = page.get('nextToken') or page.get('NextToken')
+            if not token:
+                return
+
+
+def page(items, key, nextToken = None, size = 100, **kwargs):
+    start = int(nextToken or 0)
+    resp = {key: items[start:start + size]}
+    if start + size < len(items):
+        resp['nextToken'] = str(start + size)
+    return resp
+
+
+class FakeClient(object):
+    service = None
+    service_id = None
+    paginated = {}
+
+    def __init__(self, backend):
+        self.backend = backend
+        service_id = SimpleNamespace(hyphenize=lambda: self.service_id)
+        self.meta = SimpleNamespace(
+            service_model=SimpleNamespace(service_name=self.service, service_id=service_id),
+            events=FakeEvents()
+        )
+
+    def __getattribute__(self, method):
+        attr = object.__getattribute__(self, method)
+        if method.startswith('_') or method in ('backend', 'meta', 'service', 'service_id', 'paginated', 'get_paginator') \
+                or not callable(attr):
+            return attr
+
+        def call(**kwargs):
+            operation = operation_name(method)
+            model = SimpleNamespace(name=operation)
+            context = {}
+            events = self.meta.events
+            events.emit(f'before-call.{self.service_id}.{operation}', model=model, params=kwargs, context=context)
+            try:
+                parsed = self.backend.call(f'{self.service}.{operation}', attr, kwargs)
+            except ClientError as e:
+                events.emit(f'after-call.{self.service_id}.{operation}', http_response=None, parsed=e.response, model=model, context=context)
+                raise
+            events.emit(f'after-call.{self.service_id}.{operation}', http_response=None, parsed=parsed, model=model, context=context)
+            return parsed
+        return call
+
+    def get_paginator(self, method):
+        return FakePaginator(getattr(self, method), self.paginated[method])
+
+
+class FakeECS(FakeClient):
+    service = 'ecs'
+    service_id = 'ecs'
+    paginated = {
+        'list_tasks': 'taskArns',
+        'list_task_definitions': 'taskDefinitionArns',
+        'list_task_definition_families': 'families',
+    }
+
+    def register_task_definition(self, family, **kwargs):
+        backend = self.backend
+        with backend.lock:
+            revision = len(backend.revisions[family]) + 1
+            arn = f"arn:aws:ecs:us-east-1:000000000000:task-definition/{family}:{revision}"
+            backend.revisions[family].append(arn)
+        return {'taskDefinition': {'taskDefinitionArn': arn, 'family': family, 'revision': revision}}
+
+    def deregister_task_definition(self, taskDefinition):
+        backend = self.backend
+        family = taskDefinition.split('/')[-1].split(':')[0]
+        with backend.lock:
+            if taskDefinition in backend.revisions[family]:
+                backend.revisions[family].remove(taskDefinition)
+        return {'taskDefinition': {'taskDefinitionArn': taskDefinition, 'status': 'INACTIVE'}}
+
+    def list_task_definition_families(self, familyPrefix = '', status = 'ACTIVE', nextToken = None):
+        with self.backend.lock:
+            families = sorted(family for family, arns in self.backend.revisions.items() if family.startswith(familyPrefix) and arns)
+        return page(families, 'families', nextToken)
+
+    def list_task_definitions(self, familyPrefix = '', status = 'ACTIVE', nextToken = None):
+        with self.backend.lock:
+            arns = [arn for family, arns in sorted(self.backend.revisions.items()) if family.startswith(familyPrefix) for arn in arns]
+        return page(arns, 'taskDefinitionArns', nextToken)
+
+    def run_task(self, taskDefinition, launchType = 'FARGATE', count = 1, cluster = None, networkConfiguration = None):
+        backend = self.backend
+        family = taskDefinition.split('/')[-1].split(':')[0]
+        with backend.lock:
+            revisions = backend.revisions.get(family)
+        if not revisions:
+            raise ClientError({'Error': {'Code': 'ClientException', 'Message': 'Unable to find task definition'}}, 'RunTask')
+        taskDefinitionArn = taskDefinition if taskDefinition.startswith('arn:') else revisions[-1]
+
+        vpc = (networkConfiguration or {}).get('awsvpcConfiguration', {})
+        tasks = []
+        for _ in range(count):
+            task_id = backend.next_id()
+            task = {
+                'taskArn': f"arn:aws:ecs:us-east-1:000000000000:task/{cluster}/{task_id}",
+                'taskDefinitionArn': taskDefinitionArn,
+                'family': family,
+                'launchType': launchType,
+                'eni': f"eni-{task_id}",
+                'subnetId': (vpc.get('subnets') or ['subnet-a'])[0],
+                'securityGroups': vpc.get('securityGroups', []),
+                'publicIp': f"10.{int(task_id, 16) // 65536 % 256}.{int(task_id, 16) // 256 % 256}.{int(task_id, 16) % 256}",
+                'createdAt': datetime.now(timezone.utc),
+                'startedAt': time.monotonic(),
+                'stoppedAt': None,
+            }
+            with backend.lock:
+                backend.tasks[task['taskArn']] = task
+            tasks.append(backend.describe(task, time.monotonic()))
+        backend.publish_changes([task['taskArn'] for task in tasks])
+        return {'tasks': tasks, 'failures': []}
+
+    def describe_tasks(self, tasks, cluster = None):
+        backend = self.backend
+        now = time.monotonic()
+        resp = {'tasks': [], 'failures': []}
+        with backend.lock:
+            for arn in tasks:
+                task = backend.tasks.get(arn)
+                if task == None:
+                    resp['failures'].append({'arn': arn, 'reason': 'MISSING'})
+                else:
+                    resp['tasks'].append(backend.describe(task, now))
+        return resp
+
+    def stop_task(self, task, cluster = None, reason = None):
+        backend = self.backend
+        with backend.lock:
+            runtask = backend.tasks.get(task)
+            if runtask == None:
+                raise ClientError({'Error': {'Code': 'InvalidParameterException', 'Message': 'The referenced task was not found.'}}, 'StopTask')
+            if runtask['stoppedAt'] == None:
+                runtask['stoppedAt'] = time.monotonic()
+            resp = {'task': backend.describe(runtask, time.monotonic())}
+        backend.publish_changes([task])
+        return resp
+
+    def list_tasks(self, cluster = None, family = None, desiredStatus = 'RUNNING', nextToken = None):
+        with self.backend.lock:
+            arns = [
+                arn for arn, task in self.backend.tasks.items()
+                if (family == None or task['family'] == family)
+                and (task['stoppedAt'] == None) == (desiredStatus == 'RUNNING')
+            ]
+        return page(arns, 'taskArns', nextToken)
+
+    def describe_container_instances(self, containerInstances, cluster = None):
+        return {'containerInstances': []}
+
+
+class FakeEC2(FakeClient):
+    service = 'ec2'
+    service_id = 'ec2'
+    paginated = {'describe_subnets': 'Subnets'}
+
+    def describe_subnets(self, Filters = None, NextToken = None):
+        return {'Subnets': [dict(subnet) for subnet in self.backend.subnets]}
+
+    def create_subnet(self, VpcId, CidrBlock):
+        return {'Subnet': dict(self.backend.subnets[0])}
+
+    def describe_network_interfaces(self, Filters = None, NetworkInterfaceIds = None):
+        ids = set(NetworkInterfaceIds or [])
+        for option in Filters or []:
+            if option['Name'] == 'network-interface-id':
+                ids.update(option['Values'])
+        with self.backend.lock:
+            tasks = [task for task in self.backend.tasks.values() if task['eni'] in ids and task['stoppedAt'] == None]
+        return {'NetworkInterfaces': [{
+            'NetworkInterfaceId': task['eni'],
+            'SubnetId': task['subnetId'],
+            'Association': {'PublicIp': task['publicIp']},
+            'Groups': [{'GroupId': group_id} for group_id in task['securityGroups']],
+        } for task in tasks]}
+
+    def create_security_group(self, GroupName, Description, VpcId = None):
+        backend = self.backend
+        with backend.lock:
+            for group_id, name in backend.secgroups.items():
+                if name == GroupName:
+                    raise ClientError({'Error': {'Code': 'InvalidGroup.Duplicate', 'Message': 'already exists'}}, 'CreateSecurityGroup')
+        group_id = f"sg-{backend.next_id()}"
+        with backend.lock:
+            backend.secgroups[group_id] = GroupName
+        return {'GroupId': group_id}
+
+    def describe_security_groups(self, Filters = None):
+        names = set()
+        for option in Filters or []:
+            if option['Name'] == 'group-name':
+                names.update(option['Values'])
+        with self.backend.lock:
+            return {'SecurityGroups': [
+                {'GroupId': group_id, 'GroupName': name}
+                for group_id, name in self.backend.secgroups.items() if name in names
+            ]}
+
+    def authorize_security_group_ingress(self, GroupId, **rule):
+        return {'Return': True}
+
+    def authorize_security_group_egress(self, GroupId, **rule):
+        return {'Return': True}
+
+    def delete_security_group(self, GroupId):
+        with self.backend.lock:
+            in_use = any(
+                GroupId in task['securityGroups'] for task in self.backend.tasks.values()
+                if task['stoppedAt'] == None or time.monotonic() - task['stoppedAt'] < self.backend.stop_delay
+            )
+            if in_use:
+                raise ClientError({'Error': {'Code': 'DependencyViolation', 'Message': 'resource has a dependent object'}}, 'DeleteSecurityGroup')
+            self.backend.secgroups.pop(GroupId, None)
+        return {}
+
+
+class FakeSSM(FakeClient):
+    service = 'ssm'
+    service_id = 'ssm'
+
+    def describe_instance_information(self, InstanceInformationFilterList = None):
+        return {'InstanceInformationList': []}
+
+
+class FakeSQS(FakeClient):
+    service = 'sqs'
+    service_id = 'sqs'
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages = 10, WaitTimeSeconds = 20):
+        deadline = time.monotonic() + WaitTimeSeconds
+        while True:
+            self.backend.publish_changes()
+            messages = self.backend.receive(MaxNumberOfMessages)
+            remaining = deadline - time.monotonic()
+            if len(messages) > 0 or remaining <= 0:
+                return {'Messages': messages}
+            time.sleep(min(0.1, remaining))
+
+    def send_message(self, QueueUrl, MessageBody):
+        return {'MessageId': self.backend.send(MessageBody)}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.backend.delete([entry['ReceiptHandle'] for entry in Entries])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+
+CLIENTS = {'ecs': FakeECS, 'ec2': FakeEC2, 'ssm': FakeSSM, 'sqs': FakeSQS}
+
+
+class FakeSession(object):
+    """
+    Drop-in for boto3.Session, every session shares the backend given to install().
+    """
+    backend = None
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def client(self, service, config = None, endpoint_url = None, **kwargs):
+        return CLIENTS[service](FakeSession.backend)
+
+
+def install(backend):
+    """
+    Make boto3.Session return fake sessions on top of the backend.
+    Must be called before the plugin is imported, since utils creates its session on import.
+    """
+    import boto3
+    FakeSession.backend = backend
+    boto3.Session = FakeSession
+    return backend
@@ -0,0 +1,244 @@
+"""
+Load test of the machine API against the fake AWS backend of fakeaws.py.
+
+Boots CTFd with the plugin, seeds users and machine challenges, then runs one
+thread per simulated player. Each player deploys a machine, polls it until
+it is RUNNING, keeps it for a while and terminates it, for a number of rounds.
+The cron jobs of the plugin run meanwhile against the same fake backend.
+
+Prints the p50/p95/p99 latency and throughput of every API operation, the
+time to RUNNING, the AWS calls per operation and the duration of the cron sweeps.
+
+Must run from the CTFd root, with the plugin installed as CTFd/plugins/machine_challenges:
+
+    python CTFd/plugins/machine_challenges/benchmarks/loadtest.py --players 500 --rounds 2
+
+SQLite serializes writers, use --database with a PostgreSQL or MySQL URI for realistic numbers.
+"""
+from collections import defaultdict
+from datetime import datetime
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakeaws
+
+TASK_CONFIG = {
+    "launchType": "FARGATE",
+    "taskDefinition": {
+        "requiresCompatibilities": ["FARGATE"],
+        "networkMode": "awsvpc",
+        "cpu": "256",
+        "memory": "512",
+        "containerDefinitions": [{
+            "name": "challenge",
+            "image": "nginx:latest",
+            "portMappings": [{"containerPort": 80, "protocol": "tcp"}],
+        }],
+    },
+    "networks": {
+        "inbound": [{"FromPort": 80, "ToPort": 80, "CidrIp": "0.0.0.0/0", "IpProtocol": "tcp"}],
+        "outbound": [],
+    },
+}
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class Recorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.failures = defaultdict(int)
+
+    def record(self, operation, seconds, ok = True):
+        with self.lock:
+            self.latencies[operation].append(seconds)
+            if not ok:
+                self.failures[operation] += 1
+
+
+def create_app(args):
+    os.environ['MACHINECHALL_ENABLED'] = 'true'
+    os.environ.setdefault('MACHINECHALL_ECS_CLUSTER', 'loadtest')
+    os.environ.setdefault('MACHINECHALL_VPC_ID', 'vpc-loadtest')
+    os.environ.setdefault('MACHINECHALL_REGION', 'us-east-1')
+    os.environ['MACHINECHALL_USER_LIMIT'] = '1'
+    os.environ['MACHINECHALL_CLUSTER_LIMIT'] = str(args.cluster_limit)
+
+    from CTFd import create_app as create_ctfd
+    from CTFd.config import TestingConfig
+
+    class LoadTestConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = args.database
+        SERVER_NAME = 'localhost'
+        CACHE_TYPE = 'simple'
+        LOG_FOLDER = tempfile.mkdtemp(prefix='machine-loadtest-logs-')
+        SQLALCHEMY_ENGINE_OPTIONS = {'connect_args': {'timeout': 30}} if args.database.startswith('sqlite') else {}
+
+    return create_ctfd(LoadTestConfig)
+
+
+def seed(app, args):
+    from CTFd.models import Users, db
+    from CTFd.utils import set_config
+    from CTFd.plugins.machine_challenges import utils
+    from CTFd.plugins.machine_challenges.models import MachineChallModel
+
+    with app.app_context():
+        set_config('setup', True)
+        set_config('ctf_name', 'loadtest')
+        set_config('user_mode', 'users')
+        set_config('challenge_visibility', 'private')
+
+        challenge_ids = []
+        for i in range(args.challenges):
+            slug = f"ctfd-loadtest{i:04d}"
+            config, task_hash, task_arn = utils.ecs_register_task(slug, json.dumps(TASK_CONFIG))
+            challenge = MachineChallModel(
+                name=f"machine {i}", description="", category="loadtest", type="machine", state="visible",
+                value=100, initial=100, minimum=10, decay=50,
+                slug=slug, duration=args.duration, config=config, task_hash=task_hash, task_arn=task_arn,
+                pool_size=args.pool_size
+            )
+            db.session.add(challenge)
+            db.session.commit()
+            challenge_ids.append(challenge.id)
+
+        user_ids = []
+        for i in range(args.players):
+            user = Users(name=f"player{i}", email=f"player{i}@loadtest.local", password="loadtest", verified=True)
+            db.session.add(user)
+            db.session.commit()
+            user_ids.append(user.id)
+        return challenge_ids, user_ids
+
+
+def player(app, user_id, challenge_ids, args, recorder, start_barrier):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['id'] = user_id
+        session['nonce'] = 'loadtest'
+    headers = {'CSRF-Token': 'loadtest', 'Accept': 'application/json'}
+    rng = random.Random(user_id)
+
+    def timed(operation, method, url, **kwargs):
+        started = time.monotonic()
+        resp = getattr(client, method)(url, headers=headers, **kwargs)
+        body = resp.get_json(silent=True) or {}
+        ok = resp.status_code < 400 and body.get('success', False)
+        recorder.record(operation, time.monotonic() - started, ok)
+        return body if ok else None
+
+    start_barrier.wait()
+    time.sleep(rng.uniform(0, args.ramp_up))
+    for _ in range(args.rounds):
+        challenge_id = rng.choice(challenge_ids)
+        started = time.monotonic()
+        body = timed('deploy', 'post', '/api/v1/machines', json={'challenge_id': challenge_id})
+        if body == None:
+            time.sleep(args.poll_interval)
+            continue
+
+        deadline = started + args.timeout
+        running = False
+        while time.monotonic() < deadline:
+            time.sleep(args.poll_interval)
+            body = timed('poll', 'get', f'/api/v1/machines/{challenge_id}')
+            if body != None and json.loads(body['data'].get('detail') or '{}').get('lastStatus') == 'RUNNING':
+                running = True
+                break
+        if running:
+            recorder.record('time_to_running', time.monotonic() - started)
+            time.sleep(rng.uniform(args.hold / 2, args.hold * 1.5))
+        else:
+            recorder.record('time_to_running', time.monotonic() - started, ok=False)
+
+        timed('terminate', 'delete', f'/api/v1/machines/{challenge_id}')
+
+
+def report(recorder, elapsed, backend):
+    from CTFd.plugins.machine_challenges import metrics
+
+    print(f"\n{'operation':<18}{'count':>8}{'failed':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}{'req/s':>10}")
+    for operation in ('deploy', 'poll', 'terminate', 'time_to_running'):
+        values = recorder.latencies.get(operation, [])
+        print(
+            f"{operation:<18}{len(values):>8}{recorder.failures.get(operation, 0):>8}"
+            f"{percentile(values, 50):>10.3f}{percentile(values, 95):>10.3f}{percentile(values, 99):>10.3f}"
+            f"{max(values or [0]):>10.3f}{len(values) / elapsed:>10.1f}"
+        )
+
+    print(f"\n{'AWS operation':<36}{'calls':>8}{'throttled':>11}{'errors':>8}")
+    for name, stats in backend.stats().items():
+        print(f"{name:<36}{stats['calls']:>8}{stats['throttled']:>11}{stats['errors']:>8}")
+
+    print(f"\n{'cron job':<36}{'last run (s)':>14}")
+    for (job,), seconds in sorted(metrics.cron_sweep_seconds.values.items()):
+        print(f"{job:<36}{seconds:>14.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--players', type=int, default=500)
+    parser.add_argument('--challenges', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=2)
+    parser.add_argument('--duration', type=int, default=60, help='machine lifetime in minutes')
+    parser.add_argument('--pool-size', type=int, default=0, help='warm pool size of every challenge')
+    parser.add_argument('--cluster-limit', type=int, default=0)
+    parser.add_argument('--ramp-up', type=float, default=10.0, help='seconds over which players arrive')
+    parser.add_argument('--poll-interval', type=float, default=2.0)
+    parser.add_argument('--hold', type=float, default=10.0, help='mean seconds a running machine is kept')
+    parser.add_argument('--timeout', type=float, default=180.0, help='seconds to wait for RUNNING')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean AWS call latency in seconds')
+    parser.add_argument('--start-delay', type=float, default=20.0, help='seconds from RunTask to RUNNING')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='probability of a throttled AWS call')
+    parser.add_argument('--no-aws-limits', action='store_true', help='disable the fake per-operation API rates')
+    parser.add_argument('--database', default=None, help='SQLAlchemy URI, a temporary SQLite file by default')
+    args = parser.parse_args()
+    if args.database == None:
+        args.database = f"sqlite:///{tempfile.mkstemp(prefix='machine-loadtest-', suffix='.db')[1]}"
+
+    backend = fakeaws.install(fakeaws.FakeBackend(
+        latency=args.latency,
+        start_delay=args.start_delay,
+        throttle_rate=args.throttle_rate,
+        rates={} if args.no_aws_limits else None,
+        default_rate=None if args.no_aws_limits else fakeaws.DEFAULT_RATE,
+    ))
+    app = create_app(args)
+    challenge_ids, user_ids = seed(app, args)
+    print(f"[{datetime.utcnow().isoformat()}] {len(user_ids)} players, {len(challenge_ids)} challenges, database {args.database}")
+
+    recorder = Recorder()
+    start_barrier = threading.Barrier(len(user_ids) + 1)
+    threads = [
+        threading.Thread(target=player, args=(app, user_id, challenge_ids, args, recorder, start_barrier), daemon=True)
+        for user_id in user_ids
+    ]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()
+    started = time.monotonic()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    print(f"[{datetime.utcnow().isoformat()}] done in {elapsed:.1f}s")
+    report(recorder, elapsed, backend)
+
+
+if __name__ == '__main__':
+    main()
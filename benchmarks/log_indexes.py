@@ -0,0 +1,135 @@
+"""
+Benchmark of the machine_log_model hot queries before and after the
+indexes of migration 847fd130e20f. The partial index it also created is
+dropped by migration 5e0a8c3f71d2, the composite index serves the same queries.
+
+The live state of running machines is read from machine_active_model, the log
+only serves the history queries listed in QUERIES.
+
+Seeds an SQLite database with a large machine log history, then prints the
+query plan and the average time of every hot query without and with the indexes.
+
+Usage: python benchmarks/log_indexes.py [--rows 300000] [--repeat 50]
+"""
+from datetime import datetime, timedelta
+
+import argparse
+import random
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE machine_log_model (
+    id INTEGER NOT NULL PRIMARY KEY,
+    chall_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    task_id VARCHAR(255),
+    status INTEGER NOT NULL,
+    time_str DATETIME NOT NULL,
+    time_end DATETIME NOT NULL,
+    detail TEXT
+)
+"""
+
+INDEXES = [
+    "CREATE INDEX ix_machine_log_user_status_chall ON machine_log_model (user_id, status, chall_id)",
+    "CREATE INDEX ix_machine_log_status_time_end ON machine_log_model (status, time_end)",
+]
+
+# Same filters as the queries still served by machine_log_model
+QUERIES = {
+    "cron secgroup": (
+        "SELECT * FROM machine_log_model WHERE status = 2",
+    ),
+    "backlog gauge": (
+        "SELECT count(*) FROM machine_log_model WHERE status = 2",
+    ),
+    "admin list": (
+        "SELECT * FROM machine_log_model ORDER BY id DESC LIMIT 50 OFFSET 0",
+    ),
+    "admin count": (
+        "SELECT count(*) FROM machine_log_model",
+    ),
+    "stream ended": (
+        "SELECT * FROM machine_log_model WHERE user_id = :user_id AND chall_id = :chall_id ORDER BY id DESC LIMIT 1",
+    ),
+    "delete chall": (
+        "SELECT * FROM machine_log_model WHERE status != 0 AND chall_id = :chall_id",
+    ),
+}
+
+def seed(conn, rows, users, challenges, active):
+    now = datetime.utcnow()
+    detail = '{"lastStatus": "STOPPED", "containers": [], "publicIp": ""}'
+
+    def row(i, status):
+        time_str = now - timedelta(minutes=random.randint(60, 60 * 24 * 30))
+        if status == 1:
+            time_str = now - timedelta(minutes=random.randint(0, 30))
+        return (
+            i,
+            random.randint(1, challenges),
+            random.randint(1, users),
+            f"arn:aws:ecs:task/{i:032x}",
+            status,
+            time_str,
+            time_str + timedelta(minutes=60),
+            detail,
+        )
+
+    history = [row(i, 0) for i in range(1, rows - active + 1)]
+    running = [row(i, random.choice((1, 1, 1, 2))) for i in range(rows - active + 1, rows + 1)]
+    conn.executemany("INSERT INTO machine_log_model VALUES (?, ?, ?, ?, ?, ?, ?, ?)", history + running)
+    conn.commit()
+
+
+def run(conn, repeat, users, challenges):
+    results = {}
+    for name, (sql,) in QUERIES.items():
+        params = {"user_id": random.randint(1, users), "chall_id": random.randint(1, challenges), "now": datetime.utcnow()}
+        plan = "; ".join(r[-1] for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            params["user_id"] = random.randint(1, users)
+            params["chall_id"] = random.randint(1, challenges)
+            conn.execute(sql, params).fetchall()
+        elapsed = (time.perf_counter() - start) / repeat * 1000
+        results[name] = (plan, elapsed)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=300000)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--challenges", type=int, default=30)
+    parser.add_argument("--active", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    random.seed(0)
+    conn = sqlite3.connect(":memory:", detect_types=sqlite3.PARSE_DECLTYPES)
+    conn.execute(SCHEMA)
+    seed(conn, args.rows, args.users, args.challenges, args.active)
+
+    before = run(conn, args.repeat, args.users, args.challenges)
+    for index in INDEXES:
+        conn.execute(index)
+    conn.execute("ANALYZE")
+    after = run(conn, args.repeat, args.users, args.challenges)
+
+    print(f"machine_log_model rows: {args.rows}, active rows: {args.active}")
+    print(f"{'query':<16}{'before (ms)':>14}{'after (ms)':>14}{'speedup':>10}")
+    for name in QUERIES:
+        speedup = before[name][1] / after[name][1] if after[name][1] else float("inf")
+        print(f"{name:<16}{before[name][1]:>14.3f}{after[name][1]:>14.3f}{speedup:>9.1f}x")
+    print()
+    for name in QUERIES:
+        print(f"{name}")
+        print(f"  before: {before[name][0]}")
+        print(f"  after:  {after[name][0]}")
+
+
+if __name__ == "__main__":
+    main()
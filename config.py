@@ -13,4 +13,32 @@ def load(app):
     set_config('MACHINECHALL_SECRET_KEY', app.config.get('MACHINECHALL_SECRET_KEY', environ.get('MACHINECHALL_SECRET_KEY')))
     set_config('MACHINECHALL_REGION', app.config.get('MACHINECHALL_REGION', environ.get('MACHINECHALL_REGION')))
     set_config('MACHINECHALL_ECS_CLUSTER', app.config.get('MACHINECHALL_ECS_CLUSTER', environ.get('MACHINECHALL_ECS_CLUSTER')))
-    set_config('MACHINECHALL_VPC_ID', app.config.get('MACHINECHALL_VPC_ID', environ.get('MACHINECHALL_VPC_ID')))
\ No newline at end of file
+    set_config('MACHINECHALL_VPC_ID', app.config.get('MACHINECHALL_VPC_ID', environ.get('MACHINECHALL_VPC_ID')))
+    set_config('MACHINECHALL_PROVISION_WORKERS', app.config.get('MACHINECHALL_PROVISION_WORKERS', environ.get('MACHINECHALL_PROVISION_WORKERS', 8)))
+    set_config('MACHINECHALL_PROVISION_TIMEOUT', app.config.get('MACHINECHALL_PROVISION_TIMEOUT', environ.get('MACHINECHALL_PROVISION_TIMEOUT', 600)))
+    set_config('MACHINECHALL_REFRESH_INTERVAL', app.config.get('MACHINECHALL_REFRESH_INTERVAL', environ.get('MACHINECHALL_REFRESH_INTERVAL', 5)))
+    set_config('MACHINECHALL_TERMINATE_WORKERS', app.config.get('MACHINECHALL_TERMINATE_WORKERS', environ.get('MACHINECHALL_TERMINATE_WORKERS', 16)))
+    set_config('MACHINECHALL_SUBNET_TTL', app.config.get('MACHINECHALL_SUBNET_TTL', environ.get('MACHINECHALL_SUBNET_TTL', 300)))
+    set_config('MACHINECHALL_AWS_MAX_POOL_CONNECTIONS', app.config.get('MACHINECHALL_AWS_MAX_POOL_CONNECTIONS', environ.get('MACHINECHALL_AWS_MAX_POOL_CONNECTIONS', 50)))
+    set_config('MACHINECHALL_AWS_MAX_ATTEMPTS', app.config.get('MACHINECHALL_AWS_MAX_ATTEMPTS', environ.get('MACHINECHALL_AWS_MAX_ATTEMPTS', 5)))
+    set_config('MACHINECHALL_AWS_CONNECT_TIMEOUT', app.config.get('MACHINECHALL_AWS_CONNECT_TIMEOUT', environ.get('MACHINECHALL_AWS_CONNECT_TIMEOUT', 5)))
+    set_config('MACHINECHALL_AWS_READ_TIMEOUT', app.config.get('MACHINECHALL_AWS_READ_TIMEOUT', environ.get('MACHINECHALL_AWS_READ_TIMEOUT', 30)))
+    set_config('MACHINECHALL_EVENTS_QUEUE_URL', app.config.get('MACHINECHALL_EVENTS_QUEUE_URL', environ.get('MACHINECHALL_EVENTS_QUEUE_URL')))
+    set_config('MACHINECHALL_SQS_ENDPOINT_URL', app.config.get('MACHINECHALL_SQS_ENDPOINT_URL', environ.get('MACHINECHALL_SQS_ENDPOINT_URL')))
+    set_config('MACHINECHALL_EXPIRY_BATCH_WINDOW', app.config.get('MACHINECHALL_EXPIRY_BATCH_WINDOW', environ.get('MACHINECHALL_EXPIRY_BATCH_WINDOW', 5)))
+    set_config('MACHINECHALL_EXPIRY_RESYNC_INTERVAL', app.config.get('MACHINECHALL_EXPIRY_RESYNC_INTERVAL', environ.get('MACHINECHALL_EXPIRY_RESYNC_INTERVAL', 60)))
+    set_config('MACHINECHALL_LEADER_TTL', app.config.get('MACHINECHALL_LEADER_TTL', environ.get('MACHINECHALL_LEADER_TTL', 30)))
+    set_config('MACHINECHALL_USER_LIMIT', app.config.get('MACHINECHALL_USER_LIMIT', environ.get('MACHINECHALL_USER_LIMIT', 1)))
+    set_config('MACHINECHALL_TEAM_LIMIT', app.config.get('MACHINECHALL_TEAM_LIMIT', environ.get('MACHINECHALL_TEAM_LIMIT', 0)))
+    set_config('MACHINECHALL_CHALLENGE_LIMIT', app.config.get('MACHINECHALL_CHALLENGE_LIMIT', environ.get('MACHINECHALL_CHALLENGE_LIMIT', 0)))
+    set_config('MACHINECHALL_CLUSTER_LIMIT', app.config.get('MACHINECHALL_CLUSTER_LIMIT', environ.get('MACHINECHALL_CLUSTER_LIMIT', 0)))
+    set_config('MACHINECHALL_AWS_RATE_LIMITS', app.config.get('MACHINECHALL_AWS_RATE_LIMITS', environ.get('MACHINECHALL_AWS_RATE_LIMITS')))
+    set_config('MACHINECHALL_AWS_RATE_LIMIT_SHARED', app.config.get('MACHINECHALL_AWS_RATE_LIMIT_SHARED', environ.get('MACHINECHALL_AWS_RATE_LIMIT_SHARED', 'false')))
+    set_config('MACHINECHALL_IDEMPOTENCY_TTL', app.config.get('MACHINECHALL_IDEMPOTENCY_TTL', environ.get('MACHINECHALL_IDEMPOTENCY_TTL', 600)))
+    set_config('MACHINECHALL_LOG_MAX_BYTES', app.config.get('MACHINECHALL_LOG_MAX_BYTES', environ.get('MACHINECHALL_LOG_MAX_BYTES', 10485760)))
+    set_config('MACHINECHALL_LOG_BACKUP_COUNT', app.config.get('MACHINECHALL_LOG_BACKUP_COUNT', environ.get('MACHINECHALL_LOG_BACKUP_COUNT', 5)))
+    set_config('MACHINECHALL_EXTEND_MINUTES', app.config.get('MACHINECHALL_EXTEND_MINUTES', environ.get('MACHINECHALL_EXTEND_MINUTES', 30)))
+    set_config('MACHINECHALL_MAX_LIFETIME', app.config.get('MACHINECHALL_MAX_LIFETIME', environ.get('MACHINECHALL_MAX_LIFETIME', 180)))
+    set_config('MACHINECHALL_MAX_EXTENSIONS', app.config.get('MACHINECHALL_MAX_EXTENSIONS', environ.get('MACHINECHALL_MAX_EXTENSIONS', 3)))
+    set_config('MACHINECHALL_IDLE_TIMEOUT', app.config.get('MACHINECHALL_IDLE_TIMEOUT', environ.get('MACHINECHALL_IDLE_TIMEOUT', 0)))
+    set_config('MACHINECHALL_ACTIVITY_SOURCE', app.config.get('MACHINECHALL_ACTIVITY_SOURCE', environ.get('MACHINECHALL_ACTIVITY_SOURCE', 'heartbeat')))
@@ -1,40 +1,188 @@
-from .models import MachineLogModel, MachineChallenge
+from . import activity, events, expiry, metrics
+from .ratelimit import bulk
+from .leader import election, leader_only
+from .models import MachineActiveModel, MachineChallModel, MachineLogModel, MachineChallenge
 
 from CTFd.models import db
-from CTFd.plugins.machine_challenges.utils import ecs_delete_secgroup
+from CTFd.utils import get_config
 
 from flask_apscheduler import APScheduler, STATE_RUNNING
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import logging
 
 logger = logging.getLogger('machine')
 
 def load(app):
-    def terminate_expired_machine():
+    @leader_only
+    @bulk
+    @metrics.sweep
+    def release_security_groups():
         with app.app_context():
             machines = MachineLogModel.query.filter(
                 MachineLogModel.status == 2,
             ).all()
             for machine in machines:
                 try:
-                    ecs_delete_secgroup(machine.detail)
+                    MachineChallenge.releasesecgroups(machine.detail)
                     machine.status = 0
                     db.session.commit()
                 except:
-                    logger.info(f"[CRON] Failed to delete security group for machine id {machine.id}")
+                    db.session.rollback()
+                    logger.info(f"[CRON] Failed to delete security group for machine id {machine.id}", extra={'machine_id': machine.id})
+            MachineChallenge.cleansecgroups()
 
-            machines = MachineLogModel.query.filter(
-                MachineLogModel.status == 1,
-                MachineLogModel.time_end <= datetime.utcnow()
-            ).all()    
-            for machine in machines:
-                logger.info(f"[CRON] Terminating machine id {machine.id}")
-                MachineChallenge.terminatemachine(machine.user, machine.challenge)    
+    def heartbeat():
+        with app.app_context():
+            election.heartbeat()
+
+    # Only the leader loads and terminates expired machines, others keep an idle expiry heap
+    def load_machine_deadlines():
+        if not election.is_leader():
+            return []
+        with app.app_context():
+            deadlines = MachineActiveModel.query.with_entities(
+                MachineActiveModel.log_id,
+                MachineActiveModel.time_end
+            ).all()
+            db.session.commit()
+            return deadlines
+
+    @bulk
+    @metrics.sweep
+    def terminate_expired_machine(machine_ids):
+        if not election.is_leader():
+            return []
+        with app.app_context():
+            try:
+                machines = MachineActiveModel.query.filter(
+                    MachineActiveModel.log_id.in_(machine_ids)
+                ).all()
+                now = datetime.utcnow()
+                expired = [machine for machine in machines if machine.time_end <= now]
+                # Extended since they were scheduled
+                for machine in machines:
+                    if machine.time_end > now:
+                        expiry.scheduler.schedule(machine.log_id, machine.time_end)
+
+                for machine in expired:
+                    logger.info(
+                        f"[EXPIRY] Terminating machine id {machine.log_id}",
+                        extra={'machine_id': machine.log_id, 'user_id': machine.user_id, 'challenge_id': machine.chall_id, 'task_arn': machine.task_id}
+                    )
+                results = MachineChallenge.terminatemachines(expired)
+            except Exception:
+                db.session.rollback()
+                raise
+
+            failed = []
+            for machine_id, result in results.items():
+                if result != None:
+                    logger.info(f"[EXPIRY] Failed to terminate machine id {machine_id} - {result}", extra={'machine_id': machine_id})
+                    failed.append(machine_id)
+            return failed
+
+    @leader_only
+    @bulk
+    @metrics.sweep
+    def refresh_machine_status(full = False):
+        with app.app_context():
+            try:
+                MachineChallenge.refreshmachines(full)
+            except Exception as e:
+                db.session.rollback()
+                logger.info(f"[CRON] Failed to refresh machine status - {str(e)}")
+
+    @leader_only
+    @metrics.sweep
+    def fail_stale_provisioning():
+        with app.app_context():
+            try:
+                failed = MachineChallenge.failstaleprovisioning(
+                    timedelta(seconds=int(get_config('MACHINECHALL_PROVISION_TIMEOUT') or 600))
+                )
+                if failed > 0:
+                    logger.info(f"[CRON] Failed {failed} machine(s) stuck in provisioning")
+            except Exception as e:
+                db.session.rollback()
+                logger.info(f"[CRON] Failed to check stale provisioning - {str(e)}")
+
+    @leader_only
+    @bulk
+    @metrics.sweep
+    def reconcile_machines():
+        with app.app_context():
+            try:
+                orphans, lost = MachineChallenge.reconcilemachines()
+                if orphans > 0 or lost > 0:
+                    logger.info(f"[CRON] Reconciled cluster tasks: {orphans} orphaned task(s) stopped, {lost} lost machine(s) terminated")
+            except Exception as e:
+                db.session.rollback()
+                logger.info(f"[CRON] Failed to reconcile cluster tasks - {str(e)}")
+
+    @leader_only
+    @bulk
+    @metrics.sweep
+    def reclaim_idle_machines():
+        with app.app_context():
+            idle_timeout = int(get_config('MACHINECHALL_IDLE_TIMEOUT') or 0)
+            # The heartbeat alone would reclaim machines used over SSH or netcat with the challenge closed
+            if idle_timeout <= 0 or activity.traffic_source() == None:
+                return
+            try:
+                results = MachineChallenge.reclaimidle(timedelta(minutes=idle_timeout))
+            except Exception as e:
+                db.session.rollback()
+                logger.info(f"[CRON] Failed to reclaim idle machines - {str(e)}")
+                return
+            for machine_id, result in results.items():
+                if result == None:
+                    metrics.idle_reclaimed.inc()
+                else:
+                    logger.info(f"[IDLE] Failed to terminate machine id {machine_id} - {result}", extra={'machine_id': machine_id})
+
+    @leader_only
+    @metrics.sweep
+    def admit_queued_machine():
+        with app.app_context():
+            try:
+                MachineChallenge.admitqueue()
+            except Exception as e:
+                db.session.rollback()
+                logger.info(f"[CRON] Failed to admit queued machines - {str(e)}")
+
+    @leader_only
+    @bulk
+    @metrics.sweep
+    def refill_machine_pool():
+        with app.app_context():
+            challenges = MachineChallModel.query.all()
+            for challenge in challenges:
+                try:
+                    MachineChallenge.refillpool(challenge)
+                except Exception as e:
+                    db.session.rollback()
+                    logger.info(f"[CRON] Failed to refill machine pool for challenge id {challenge.id} - {str(e)}")
 
     scheduler = APScheduler()
     if scheduler.state == STATE_RUNNING:
         scheduler.shutdown()
     scheduler.init_app(app)
-    scheduler.add_job(id = 'Terminate expired machine', func = terminate_expired_machine, trigger = 'cron', minute='*/5')
-    scheduler.start()
\ No newline at end of file
+    election.ttl = int(get_config('MACHINECHALL_LEADER_TTL') or 30)
+    heartbeat()
+    scheduler.add_job(id = 'Leader heartbeat', func = heartbeat, trigger = 'interval', seconds = max(1, election.ttl // 3))
+    scheduler.add_job(id = 'Release security groups', func = release_security_groups, trigger = 'cron', minute='*/5')
+    # Task state change events replace the quick refresh, the full refresh still catches missed events
+    if not events.enabled():
+        scheduler.add_job(id = 'Refresh machine status', func = refresh_machine_status, trigger = 'interval', seconds = int(get_config('MACHINECHALL_REFRESH_INTERVAL') or 5))
+    scheduler.add_job(id = 'Refresh all machine status', func = refresh_machine_status, kwargs = {'full': True}, trigger = 'cron', minute='*/5')
+    scheduler.add_job(id = 'Fail stale provisioning', func = fail_stale_provisioning, trigger = 'interval', seconds = 60)
+    scheduler.add_job(id = 'Reconcile machines', func = reconcile_machines, trigger = 'cron', minute='*/10')
+    scheduler.add_job(id = 'Reclaim idle machines', func = reclaim_idle_machines, trigger = 'interval', seconds = 60)
+    scheduler.add_job(id = 'Admit queued machines', func = admit_queued_machine, trigger = 'interval', seconds = 2)
+    scheduler.add_job(id = 'Refill machine pool', func = refill_machine_pool, trigger = 'interval', seconds = 30)
+    scheduler.start()
+
+    expiry.scheduler.batch_window = int(get_config('MACHINECHALL_EXPIRY_BATCH_WINDOW') or 5)
+    expiry.scheduler.resync_interval = int(get_config('MACHINECHALL_EXPIRY_RESYNC_INTERVAL') or 60)
+    expiry.scheduler.start(load_machine_deadlines, terminate_expired_machine)
\ No newline at end of file
@@ -0,0 +1,100 @@
+from .models import MachineChallenge
+from .utils import get_client
+
+from CTFd.models import db
+from CTFd.utils import get_config
+
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger('machine')
+
+TASK_STATE_CHANGE = 'ECS Task State Change'
+# Seconds to wait after a failed batch, its messages are delivered again after the queue visibility timeout
+RETRY_DELAY = 5
+
+def parse_messages(messages):
+    """
+    Extract the ECS tasks from SQS messages carrying EventBridge task state change events.
+    Events delivered through SNS are unwrapped first.
+
+    :param messages: list of SQS message dictionaries
+    :return: list of ECS task dictionaries
+    """
+    runtasks = []
+    for message in messages:
+        try:
+            event = json.loads(message['Body'])
+            if 'Message' in event and 'detail-type' not in event:
+                event = json.loads(event['Message'])
+        except (KeyError, TypeError, ValueError):
+            logger.info(f"[EVENTS] Ignoring malformed message {message.get('MessageId')}")
+            continue
+        if event.get('detail-type') != TASK_STATE_CHANGE:
+            continue
+        detail = event.get('detail', {})
+        if 'taskArn' in detail and 'lastStatus' in detail:
+            runtasks.append(detail)
+    return runtasks
+
+
+def consume(app, queue_url, sqs, stop_event = None, wait_time = 20):
+    """
+    Long-poll the task state change queue until stop_event is set.
+    Messages are deleted once their events are applied, so a failed batch is delivered again.
+
+    :param app: CTFd application
+    :param queue_url: SQS queue URL
+    :param sqs: SQS client, any object with the receive_message and delete_message_batch methods
+    :param stop_event: threading.Event to stop the consumer
+    :param wait_time: long polling duration in seconds
+    """
+    while stop_event == None or not stop_event.is_set():
+        try:
+            resp = sqs.receive_message(
+                QueueUrl=queue_url,
+                MaxNumberOfMessages=10,
+                WaitTimeSeconds=wait_time
+            )
+            messages = resp.get('Messages', [])
+            if len(messages) == 0:
+                continue
+
+            with app.app_context():
+                try:
+                    MachineChallenge.applytaskevents(parse_messages(messages))
+                except Exception:
+                    db.session.rollback()
+                    raise
+
+            sqs.delete_message_batch(
+                QueueUrl=queue_url,
+                Entries=[
+                    {'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']}
+                    for i, message in enumerate(messages)
+                ]
+            )
+        except Exception as e:
+            logger.error(f"[EVENTS] Failed to consume task state changes - {str(e)}")
+            time.sleep(RETRY_DELAY)
+
+
+def enabled():
+    return bool(get_config('MACHINECHALL_EVENTS_QUEUE_URL'))
+
+
+def load(app):
+    if not enabled():
+        return
+
+    queue_url = get_config('MACHINECHALL_EVENTS_QUEUE_URL')
+    sqs = get_client('sqs', endpoint_url=get_config('MACHINECHALL_SQS_ENDPOINT_URL') or None)
+    consumer = threading.Thread(
+        target=consume,
+        args=(app, queue_url, sqs),
+        name='machine-events',
+        daemon=True
+    )
+    consumer.start()
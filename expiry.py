@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta
+
+import heapq
+import logging
+import threading
+
+logger = logging.getLogger('machine')
+
+class ExpiryScheduler(object):
+    """
+    Min-heap of machine expiry times. A single thread sleeps until the earliest
+    expiry, waits batch_window more seconds so close expirations are terminated
+    together, and hands the expired machine ids to the handler.
+
+    Deadlines are pushed on start and extend, and dropped on termination. The heap is
+    also reloaded every resync_interval seconds to pick up machines started by other processes.
+    """
+    def __init__(self, batch_window = 5, resync_interval = 60, retry_delay = 30):
+        self.batch_window = batch_window
+        self.resync_interval = resync_interval
+        self.retry_delay = retry_delay
+        self.cond = threading.Condition()
+        self.heap = []
+        self.deadlines = {}
+        self.thread = None
+        self.loader = None
+        self.handler = None
+        self.next_resync = datetime.utcnow()
+
+    def schedule(self, machine_id, time_end):
+        with self.cond:
+            self.deadlines[machine_id] = time_end
+            heapq.heappush(self.heap, (time_end, machine_id))
+            if self.heap[0][1] == machine_id:
+                self.cond.notify()
+
+    def cancel(self, machine_id):
+        # Heap entries without a matching deadline are skipped when popped
+        with self.cond:
+            self.deadlines.pop(machine_id, None)
+
+    def resync(self):
+        deadlines = dict(self.loader())
+        with self.cond:
+            self.deadlines = deadlines
+            self.heap = [(time_end, machine_id) for machine_id, time_end in deadlines.items()]
+            heapq.heapify(self.heap)
+            self.next_resync = datetime.utcnow() + timedelta(seconds=self.resync_interval)
+
+    def pop_expired(self, now):
+        expired = []
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            time_end, machine_id = heapq.heappop(self.heap)
+            if self.deadlines.get(machine_id) == time_end:
+                del self.deadlines[machine_id]
+                expired.append(machine_id)
+        return expired
+
+    def run(self):
+        while True:
+            try:
+                if datetime.utcnow() >= self.next_resync:
+                    self.resync()
+
+                with self.cond:
+                    now = datetime.utcnow()
+                    wakeup = self.next_resync
+                    if len(self.heap) > 0:
+                        wakeup = min(wakeup, self.heap[0][0] + timedelta(seconds=self.batch_window))
+                    if wakeup > now:
+                        self.cond.wait((wakeup - now).total_seconds())
+                        continue
+                    expired = self.pop_expired(now)
+
+                if len(expired) > 0:
+                    failed = self.handler(expired)
+                    retry_at = datetime.utcnow() + timedelta(seconds=self.retry_delay)
+                    for machine_id in failed:
+                        self.schedule(machine_id, retry_at)
+            except Exception as e:
+                logger.error(f"[EXPIRY] Failed to terminate expired machines - {str(e)}")
+                with self.cond:
+                    self.cond.wait(self.retry_delay)
+
+    def start(self, loader, handler):
+        """
+        :param loader: callable returning (machine id, time_end) pairs of every active machine
+        :param handler: callable terminating the given machine ids, returns the ids that failed
+        """
+        self.loader = loader
+        self.handler = handler
+        if self.thread == None:
+            self.thread = threading.Thread(target=self.run, name='machine-expiry', daemon=True)
+            self.thread.start()
+
+scheduler = ExpiryScheduler()
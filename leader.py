@@ -0,0 +1,76 @@
+from CTFd.cache import cache
+
+from functools import wraps
+from os import getpid, urandom
+
+import logging
+import socket
+import time
+
+logger = logging.getLogger('machine')
+
+class LeaderElection(object):
+    """
+    Lease based leader election on top of the CTFd cache, so only one process
+    runs the background sweeps. Time is cut in terms of ttl seconds, each term has
+    its own key, and the first process adding it leads during that term. cache.add()
+    is atomic, so two processes can never both take the same term.
+
+    The leader claims the next term ahead on its heartbeats and keeps leading without a gap,
+    another process takes over within two terms once a leader dies.
+
+    The cache must be shared by every node (e.g. Redis), otherwise each process leads itself.
+    The clocks of the nodes must be kept in sync (e.g. NTP), within a third of the ttl.
+    """
+    def __init__(self, key = 'machine:leader', ttl = 30):
+        self.key = key
+        self.ttl = ttl
+        self.node_id = f"{socket.gethostname()}:{getpid()}:{urandom(4).hex()}"
+        self.lease_end = 0
+
+    def claim(self, term):
+        """
+        Take a term unless another process already did.
+
+        :return: Boolean, indicate this process holds the term
+        """
+        key = f"{self.key}:{term}"
+        cache.add(key, self.node_id, timeout=self.ttl * 3)
+        return cache.get(key) == self.node_id
+
+    def heartbeat(self):
+        """
+        Take or renew the leadership. Must be called within the application context.
+
+        :return: Boolean, indicate this process is the leader
+        """
+        was_leader = self.is_leader()
+        now = time.time()
+        term = int(now // self.ttl)
+        if self.claim(term):
+            held = term + 1 if self.claim(term + 1) else term
+            # Keep a margin, so the lease is given up locally before another process may take the next term
+            self.lease_end = time.monotonic() + (held + 1) * self.ttl - now - self.ttl / 3
+        else:
+            self.lease_end = 0
+
+        if self.is_leader() != was_leader:
+            logger.info(f"[LEADER] {self.node_id} {'is now' if self.is_leader() else 'is no longer'} the leader")
+        return self.is_leader()
+
+    def is_leader(self):
+        return time.monotonic() < self.lease_end
+
+election = LeaderElection()
+
+
+def leader_only(func):
+    """
+    Skip the decorated job unless this process is the leader.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not election.is_leader():
+            return None
+        return func(*args, **kwargs)
+    return wrapper
@@ -1,7 +1,50 @@
+from CTFd.utils import get_config
+
+from datetime import datetime, timezone
+
+import atexit
+import json
 import logging
+import logging.handlers
 import os
+import queue
+
+# Fields passed with extra={...} that are written as JSON keys
+FIELDS = ('machine_id', 'user_id', 'challenge_id', 'task_arn', 'duration')
+
+_listener = None
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, with the machine fields of the record when they are set.
+    """
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value != None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def stop():
+    global _listener
+    if _listener != None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
 
 def load(app):
+    global _listener
     logger = logging.getLogger('machine')
     logger.setLevel(app.config.get('LOG_LEVEL', "INFO"))
 
@@ -14,6 +57,21 @@ def load(app):
     if not os.path.exists(log_file):
         open(log_file, 'a').close()
 
-    handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=10000)
-    logger.addHandler(handler)
+    handler = logging.handlers.RotatingFileHandler(
+        log_file,
+        maxBytes=int(get_config('MACHINECHALL_LOG_MAX_BYTES') or 10 * 1024 * 1024),
+        backupCount=int(get_config('MACHINECHALL_LOG_BACKUP_COUNT') or 5)
+    )
+    handler.setFormatter(JsonFormatter())
+
+    # Request threads only enqueue records, the listener thread writes them to disk
+    stop()
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    log_queue = queue.Queue(-1)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
     logger.propagate = 0
+
+atexit.register(stop)
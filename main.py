@@ -1,6 +1,6 @@
 import os
 
-from . import api, models, logger, cron, view, config
+from . import api, models, logger, cron, view, config, provision, utils, events, teardown, metrics
 
 from CTFd.plugins import register_plugin_assets_directory
 
@@ -14,7 +14,12 @@ def load(app):
 
     config.load(app)
     logger.load(app)
+    metrics.load(app)
+    utils.load(app)
     models.load(app)
+    provision.load(app)
+    teardown.load(app)
     cron.load(app)
+    events.load(app)
     api.load(app)
     view.load(app)
@@ -0,0 +1,340 @@
+from CTFd.cache import cache
+from CTFd.models import db
+
+from contextlib import contextmanager
+from functools import wraps
+from os import getpid
+from sqlalchemy import event
+
+import logging
+import socket
+import threading
+import time
+
+logger = logging.getLogger('machine')
+
+THROTTLING_ERRORS = {'ThrottlingException', 'Throttling', 'TooManyRequestsException', 'RequestLimitExceeded'}
+
+# Seconds, from fast AWS calls up to slow task starts
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Seconds between two snapshots of the metrics of a process in the cache,
+# and lifetime of the snapshot, so processes that are gone drop out of the scrapes
+PUBLISH_INTERVAL = 15
+PUBLISH_TIMEOUT = 4 * PUBLISH_INTERVAL
+
+_registry = []
+_collectors = []
+_local = threading.local()
+
+
+def _format_labels(names, values, extra = ()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    escaped = [
+        (name, str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+        for name, value in pairs
+    ]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames = (), per_process = True):
+        """
+        :param per_process: The values are recorded by each process and scraped with a process label.
+            Values refreshed from the database by a collector are the same everywhere and rendered once.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.per_process = per_process
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, (), value) for key, value in self.values.items()]
+
+    def render(self, snapshots = None):
+        """
+        :param snapshots: Dictionary of process to its samples of this metric, the samples of this process by default
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        if snapshots == None:
+            snapshots = {None: self.samples()}
+        for process, samples in sorted(snapshots.items(), key=lambda item: item[0] or ''):
+            for name, key, extra, value in samples:
+                if process != None:
+                    extra = (('process', process),) + tuple(extra)
+                lines.append(f"{name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def replace(self, values):
+        """
+        Replace every sample, e.g. with values read from the database on scrape.
+
+        :param values: list of (labels dictionary, value)
+        """
+        with self.lock:
+            self.values = {self.key(labels): value for labels, value in values}
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames = (), buckets = DEFAULT_BUCKETS, per_process = True):
+        super(Histogram, self).__init__(name, documentation, labelnames, per_process)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((f"{self.name}_bucket", key, (('le', _format_value(bound)),), count))
+                samples.append((f"{self.name}_sum", key, (), total))
+                samples.append((f"{self.name}_count", key, (), counts[-1]))
+        return samples
+
+
+aws_call_seconds = Histogram('machine_aws_call_seconds', 'Latency of AWS API calls, retries included', ('service', 'operation'))
+aws_call_errors = Counter('machine_aws_call_errors_total', 'AWS API calls that returned an error', ('service', 'operation', 'code'))
+aws_call_throttled = Counter('machine_aws_call_throttled_total', 'AWS API calls rejected by throttling', ('service', 'operation'))
+aws_ratelimit_wait_seconds = Histogram('machine_aws_ratelimit_wait_seconds', 'Time AWS API calls waited for the rate limiter', ('service', 'operation'))
+helper_seconds = Histogram('machine_aws_helper_seconds', 'Duration of the AWS helpers of the plugin', ('helper',))
+operation_seconds = Histogram('machine_operation_seconds', 'Duration of the machine operations', ('operation',))
+operation_db_seconds = Histogram('machine_operation_db_seconds', 'Database time spent in the machine operations', ('operation',))
+start_seconds = Histogram('machine_start_seconds', 'Time from admission to RUNNING', ('source',))
+cron_sweep_seconds = Gauge('machine_cron_sweep_seconds', 'Duration of the last run of the background jobs', ('job',))
+active_machines = Gauge('machine_active', 'Active machines by challenge and status', ('challenge', 'status'), per_process=False)
+idle_reclaimed = Counter('machine_idle_reclaimed_total', 'Running machines terminated for inactivity')
+secgroup_backlog = Gauge('machine_secgroup_backlog', 'Stopped machines whose security group is not released yet', per_process=False)
+
+
+def collector(func):
+    """
+    Register a function refreshing gauges right before the metrics are rendered.
+    """
+    _collectors.append(func)
+    return func
+
+
+def process_id():
+    return f"{socket.gethostname()}:{getpid()}"
+
+
+def publish():
+    """
+    Store the samples of this process in the cache, where every process renders them from.
+    Must be called within the application context.
+    """
+    process = process_id()
+    cache.set(
+        f"machine:metrics:{process}",
+        {metric.name: metric.samples() for metric in _registry if metric.per_process},
+        timeout=PUBLISH_TIMEOUT
+    )
+    # Index of the processes, entries of the processes that are gone expire with their snapshot
+    now = time.time()
+    processes = cache.get("machine:metrics:processes") or {}
+    processes = {name: seen for name, seen in processes.items() if seen > now - PUBLISH_TIMEOUT}
+    processes[process] = now
+    cache.set("machine:metrics:processes", processes, timeout=PUBLISH_TIMEOUT)
+
+
+def snapshots():
+    """
+    Latest samples of every process sharing the cache, the ones of this process are current.
+
+    :return: Dictionary of process to dictionary of metric name to samples
+    """
+    process = process_id()
+    found = {}
+    for name in cache.get("machine:metrics:processes") or {}:
+        if name == process:
+            continue
+        snapshot = cache.get(f"machine:metrics:{name}")
+        if snapshot != None:
+            found[name] = snapshot
+    found[process] = {metric.name: metric.samples() for metric in _registry if metric.per_process}
+    return found
+
+
+def render():
+    """
+    Metrics of every process of the deployment in the Prometheus text format.
+    Per process metrics carry a process label, sum them over it for the deployment totals.
+    The cache must be shared by every node, like for the leader election, otherwise only this process is rendered.
+    """
+    for func in _collectors:
+        func()
+    publish()
+    found = snapshots()
+    lines = []
+    for metric in _registry:
+        if metric.per_process:
+            lines.extend(metric.render({
+                process: snapshot.get(metric.name, []) for process, snapshot in found.items()
+            }))
+        else:
+            lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def timed(histogram, **labels):
+    """
+    Decorator observing the duration of every call in the histogram.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def aws_helper(func):
+    """
+    Decorator observing the duration of an AWS helper, labelled with its name.
+    """
+    return timed(helper_seconds, helper=func.__name__)(func)
+
+
+def sweep(func):
+    """
+    Decorator recording the duration of the last run of a background job.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            cron_sweep_seconds.set(time.monotonic() - started, job=func.__name__)
+    return wrapper
+
+
+def operation(func):
+    """
+    Decorator recording the duration and the database time of a machine operation.
+    Database time of nested operations also counts for the outer ones.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        frames = getattr(_local, 'frames', None)
+        if frames == None:
+            frames = _local.frames = []
+        frame = [0.0]
+        frames.append(frame)
+        started = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            frames.pop()
+            operation_seconds.observe(time.monotonic() - started, operation=func.__name__)
+            operation_db_seconds.observe(frame[0], operation=func.__name__)
+    return wrapper
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _local.query_started = time.monotonic()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(_local, 'query_started', None)
+    if started == None:
+        return
+    elapsed = time.monotonic() - started
+    for frame in getattr(_local, 'frames', []):
+        frame[0] += elapsed
+
+
+def instrument(client):
+    """
+    Record the latency, errors and throttling of every call of a boto3 client.
+    """
+    service = client.meta.service_model.service_name
+
+    def before_call(model, context, **kwargs):
+        context['machine_started'] = time.monotonic()
+
+    def after_call(model, parsed, context, **kwargs):
+        started = context.get('machine_started')
+        if started != None:
+            aws_call_seconds.observe(time.monotonic() - started, service=service, operation=model.name)
+        code = parsed.get('Error', {}).get('Code') if isinstance(parsed, dict) else None
+        if code != None:
+            aws_call_errors.inc(service=service, operation=model.name, code=code)
+            if code in THROTTLING_ERRORS:
+                aws_call_throttled.inc(service=service, operation=model.name)
+
+    service_id = client.meta.service_model.service_id.hyphenize()
+    client.meta.events.register(f'before-call.{service_id}', before_call)
+    client.meta.events.register(f'after-call.{service_id}', after_call)
+    return client
+
+
+def publisher(app):
+    while True:
+        time.sleep(PUBLISH_INTERVAL)
+        try:
+            with app.app_context():
+                publish()
+        except Exception as e:
+            logger.error(f"[METRICS] Failed to publish the metrics of this process - {str(e)}")
+
+
+def load(app):
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute', after_cursor_execute)
+    threading.Thread(target=publisher, args=(app,), name='machine-metrics', daemon=True).start()
@@ -0,0 +1,33 @@
+"""Add machine warm pool
+
+Revision ID: 055cf405f1e5
+Revises: c343c2fad603
+Create Date: 2026-10-18 09:30:12.104217
+
+"""
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '055cf405f1e5'
+down_revision = 'c343c2fad603'
+branch_labels = None
+depends_on = None
+
+
+def upgrade(op=None):
+    op.add_column("machine_chall_model", sa.Column("pool_size", sa.Integer(), default=0))
+    op.create_table(
+        "machine_pool_model",
+        sa.Column("id", sa.Integer(), nullable=False, primary_key=True),
+        sa.Column("chall_id", sa.Integer(), nullable=False),
+        sa.Column("task_id", sa.String(255)),
+        sa.Column("status", sa.Integer(), nullable=False),
+        sa.Column("time_str", sa.DateTime(), nullable=False),
+        sa.Column("detail", sa.Text()),
+        sa.ForeignKeyConstraint(["chall_id"], ["challenges.id"], ondelete="CASCADE"),
+    )
+
+def downgrade(op=None):
+    op.drop_table("machine_pool_model")
+    op.drop_column("machine_chall_model", "pool_size")
@@ -0,0 +1,24 @@
+"""Add machine activity
+
+Revision ID: 3b91d0c7a2f4
+Revises: eacd6049e899
+Create Date: 2026-10-18 16:42:08.913254
+
+"""
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b91d0c7a2f4'
+down_revision = 'eacd6049e899'
+branch_labels = None
+depends_on = None
+
+
+def upgrade(op=None):
+    op.add_column("machine_active_model", sa.Column("last_seen", sa.DateTime()))
+    op.add_column("machine_active_model", sa.Column("extensions", sa.Integer(), nullable=False, server_default="0"))
+
+def downgrade(op=None):
+    op.drop_column("machine_active_model", "extensions")
+    op.drop_column("machine_active_model", "last_seen")
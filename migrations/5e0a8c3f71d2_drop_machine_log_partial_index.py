@@ -0,0 +1,34 @@
+"""Drop machine log partial index
+
+Revision ID: 5e0a8c3f71d2
+Revises: 3b91d0c7a2f4
+Create Date: 2026-10-19 09:12:44.507316
+
+"""
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e0a8c3f71d2'
+down_revision = '3b91d0c7a2f4'
+branch_labels = None
+depends_on = None
+
+# Backends on which migration 847fd130e20f created the partial index
+PARTIAL_INDEX_DIALECTS = ("postgresql", "sqlite")
+
+
+def upgrade(op=None):
+    # ix_machine_log_user_status_chall already serves the status = 1 lookups
+    if op.get_bind().dialect.name in PARTIAL_INDEX_DIALECTS:
+        op.drop_index("ix_machine_log_active", table_name="machine_log_model")
+
+def downgrade(op=None):
+    if op.get_bind().dialect.name in PARTIAL_INDEX_DIALECTS:
+        op.create_index(
+            "ix_machine_log_active",
+            "machine_log_model",
+            ["user_id", "chall_id"],
+            postgresql_where=sa.text("status = 1"),
+            sqlite_where=sa.text("status = 1"),
+        )
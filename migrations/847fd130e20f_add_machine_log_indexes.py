@@ -0,0 +1,45 @@
+"""Add machine log indexes
+
+Revision ID: 847fd130e20f
+Revises: f2a99727b5bd
+Create Date: 2026-10-18 10:47:03.226914
+
+"""
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '847fd130e20f'
+down_revision = 'f2a99727b5bd'
+branch_labels = None
+depends_on = None
+
+# Backends that support partial indexes
+PARTIAL_INDEX_DIALECTS = ("postgresql", "sqlite")
+
+
+def upgrade(op=None):
+    op.create_index(
+        "ix_machine_log_user_status_chall",
+        "machine_log_model",
+        ["user_id", "status", "chall_id"],
+    )
+    op.create_index(
+        "ix_machine_log_status_time_end",
+        "machine_log_model",
+        ["status", "time_end"],
+    )
+    if op.get_bind().dialect.name in PARTIAL_INDEX_DIALECTS:
+        op.create_index(
+            "ix_machine_log_active",
+            "machine_log_model",
+            ["user_id", "chall_id"],
+            postgresql_where=sa.text("status = 1"),
+            sqlite_where=sa.text("status = 1"),
+        )
+
+def downgrade(op=None):
+    if op.get_bind().dialect.name in PARTIAL_INDEX_DIALECTS:
+        op.drop_index("ix_machine_log_active", table_name="machine_log_model")
+    op.drop_index("ix_machine_log_status_time_end", table_name="machine_log_model")
+    op.drop_index("ix_machine_log_user_status_chall", table_name="machine_log_model")
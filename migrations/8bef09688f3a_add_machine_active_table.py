@@ -0,0 +1,71 @@
+"""Add machine active table
+
+Revision ID: 8bef09688f3a
+Revises: 847fd130e20f
+Create Date: 2026-10-18 11:20:55.871604
+
+"""
+import json
+
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8bef09688f3a'
+down_revision = '847fd130e20f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade(op=None):
+    active_table = op.create_table(
+        "machine_active_model",
+        sa.Column("id", sa.Integer(), nullable=False, primary_key=True),
+        sa.Column("log_id", sa.Integer(), nullable=False, unique=True),
+        sa.Column("chall_id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("task_id", sa.String(255)),
+        sa.Column("public_ip", sa.String(64)),
+        sa.Column("ports", sa.Text()),
+        sa.Column("last_status", sa.String(32)),
+        sa.Column("time_end", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(["log_id"], ["machine_log_model.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["chall_id"], ["challenges.id"], ondelete="CASCADE"),
+    )
+    op.create_index("ix_machine_active_user_chall", "machine_active_model", ["user_id", "chall_id"])
+    op.create_index("ix_machine_active_time_end", "machine_active_model", ["time_end"])
+    op.create_index("ix_machine_active_task_id", "machine_active_model", ["task_id"])
+
+    # Running machines move to the active table
+    log_table = sa.table(
+        "machine_log_model",
+        sa.column("id", sa.Integer),
+        sa.column("chall_id", sa.Integer),
+        sa.column("user_id", sa.Integer),
+        sa.column("task_id", sa.String),
+        sa.column("status", sa.Integer),
+        sa.column("time_end", sa.DateTime),
+        sa.column("detail", sa.Text),
+    )
+    rows = op.get_bind().execute(
+        sa.select([log_table]).where(log_table.c.status == 1)
+    ).fetchall()
+    active = []
+    for row in rows:
+        detail = json.loads(row.detail or "{}")
+        active.append({
+            "log_id": row.id,
+            "chall_id": row.chall_id,
+            "user_id": row.user_id,
+            "task_id": row.task_id,
+            "public_ip": detail.get("publicIp", ""),
+            "ports": json.dumps(detail.get("containers", [])),
+            "last_status": detail.get("lastStatus"),
+            "time_end": row.time_end,
+        })
+    if len(active) > 0:
+        op.bulk_insert(active_table, active)
+
+def downgrade(op=None):
+    op.drop_table("machine_active_model")
@@ -0,0 +1,24 @@
+"""Add machine task definition revision
+
+Revision ID: eacd6049e899
+Revises: 8bef09688f3a
+Create Date: 2026-10-18 14:05:31.402718
+
+"""
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'eacd6049e899'
+down_revision = '8bef09688f3a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade(op=None):
+    op.add_column("machine_chall_model", sa.Column("task_hash", sa.String(64)))
+    op.add_column("machine_chall_model", sa.Column("task_arn", sa.String(255)))
+
+def downgrade(op=None):
+    op.drop_column("machine_chall_model", "task_arn")
+    op.drop_column("machine_chall_model", "task_hash")
@@ -0,0 +1,29 @@
+"""Add shared machine security groups
+
+Revision ID: f2a99727b5bd
+Revises: 055cf405f1e5
+Create Date: 2026-10-18 10:12:40.518330
+
+"""
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a99727b5bd'
+down_revision = '055cf405f1e5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade(op=None):
+    op.create_table(
+        "machine_sec_group_model",
+        sa.Column("id", sa.Integer(), nullable=False, primary_key=True),
+        sa.Column("rules_hash", sa.String(64), nullable=False, unique=True),
+        sa.Column("group_id", sa.String(255), nullable=False),
+        sa.Column("refcount", sa.Integer(), nullable=False, default=0),
+        sa.Column("time_str", sa.DateTime(), nullable=False),
+    )
+
+def downgrade(op=None):
+    op.drop_table("machine_sec_group_model")
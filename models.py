@@ -1,22 +1,140 @@
 from flask import Blueprint
 from werkzeug.exceptions import NotFound
 
-from . import utils
+from . import activity, expiry, metrics, provision, teardown, utils
+from .config import MachineEcsConfig
 
 from CTFd.cache import cache
-from CTFd.models import db
+from CTFd.models import Solves, Users, db
 from CTFd.plugins.challenges import CHALLENGE_CLASSES
 from CTFd.plugins.dynamic_challenges import DynamicChallenge, DynamicValueChallenge
 from CTFd.plugins.migrations import upgrade
+from CTFd.utils import get_config
 
 from os import urandom
-from datetime import datetime, timedelta
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import event, func
+from sqlalchemy.exc import IntegrityError
 
+import hashlib
 import json
+import logging
+import time
+
+logger = logging.getLogger('machine')
+
+# Solves are also cleared on insert and delete, the timeout only covers bulk deletes
+SOLVES_CACHE_TIMEOUT = 300
+# Seconds a start waits for the start lock of the user or the admission lock, and lifetime of a lock if its holder dies
+START_LOCK_WAIT = 5
+START_LOCK_TIMEOUT = 30
+# Lifetime of the state versions watched by the event streams, longer than any stream
+STATE_TIMEOUT = 60 * 60
+
+def solved_challenge_ids(account_id):
+    """
+    Set of challenge ids solved by an account, cached until the account solves another challenge.
+    """
+    key = f"machine:solves:{account_id}"
+    solve_ids = cache.get(key)
+    if solve_ids == None:
+        solve_ids = {
+            solve_id for solve_id, in Solves.query.with_entities(Solves.challenge_id).filter_by(account_id=account_id).all()
+        }
+        cache.set(key, solve_ids, timeout=SOLVES_CACHE_TIMEOUT)
+    return solve_ids
+
+
+@event.listens_for(Solves, "after_insert")
+@event.listens_for(Solves, "after_delete")
+def clear_solved_challenge_ids(mapper, connection, solve):
+    cache.delete(f"machine:solves:{solve.account_id}")
+
 
 def getrandomslug():
     return f"ctfd-{urandom(16).hex()}"
 
+def admission_limits():
+    """
+    Maximum number of machines per user, team, challenge and in the whole cluster. 0 means unlimited.
+    """
+    user_limit = get_config('MACHINECHALL_USER_LIMIT')
+    return {
+        'user': 1 if user_limit == None else int(user_limit),
+        'team': int(get_config('MACHINECHALL_TEAM_LIMIT') or 0),
+        'challenge': int(get_config('MACHINECHALL_CHALLENGE_LIMIT') or 0),
+        'cluster': int(get_config('MACHINECHALL_CLUSTER_LIMIT') or 0),
+    }
+
+@contextmanager
+def cache_lock(key, message):
+    """
+    Lock held in the CTFd cache, waiting up to START_LOCK_WAIT seconds for it.
+    The cache must be shared by every node, like for the leader election.
+    """
+    token = urandom(8).hex()
+    deadline = time.monotonic() + START_LOCK_WAIT
+    while not cache.add(key, token, timeout=START_LOCK_TIMEOUT):
+        if time.monotonic() >= deadline:
+            raise Exception(message)
+        time.sleep(0.05)
+    try:
+        yield
+    finally:
+        if cache.get(key) == token:
+            cache.delete(key)
+
+def start_lock(user_id):
+    """
+    Lock held while a machine of the user is started.
+    """
+    return cache_lock(f"machine:start:{user_id}", 'Another machine is being started, try again later.')
+
+def admission_lock():
+    """
+    Lock held while the team, challenge and cluster capacity is checked and machines are admitted.
+    Admissions of every user share it, so concurrent ones cannot overshoot a limit.
+    """
+    return cache_lock("machine:admission", 'Too many machines are being started, try again later.')
+
+def publish_state(user_id, chall_id):
+    """
+    Signal the event streams that the machine of a user for a challenge changed.
+    Must be called after the change is committed.
+    """
+    cache.set(f"machine:state:{user_id}:{chall_id}", urandom(4).hex(), timeout=STATE_TIMEOUT)
+
+
+def publish_queue():
+    """
+    Signal the event streams of queued machines that the queue moved.
+    """
+    cache.set("machine:state:queue", urandom(4).hex(), timeout=STATE_TIMEOUT)
+
+
+def state_version(user_id, chall_id, queued = False):
+    """
+    Version of the machine state of a user for a challenge, changed by publish_state().
+    Queued machines also change with the queue.
+    """
+    version = cache.get(f"machine:state:{user_id}:{chall_id}")
+    if queued:
+        return (version, cache.get("machine:state:queue"))
+    return (version, None)
+
+
+def withhistory(old_detail, new_detail, now = None):
+    """
+    Carry the status history of a machine detail over to its new detail, with the new status
+    appended when it changed, so the log keeps every transition of the machine.
+    """
+    history = list(old_detail.get('history', []))
+    if new_detail.get('lastStatus') != old_detail.get('lastStatus'):
+        history.append({'lastStatus': new_detail.get('lastStatus'), 'time': (now or datetime.utcnow()).isoformat()})
+    return dict(new_detail, history=history)
+
 class MachineLogModel(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     chall_id = db.Column(db.Integer, db.ForeignKey("challenges.id", ondelete="CASCADE"))
@@ -26,6 +144,7 @@ class MachineLogModel(db.Model):
     # 0 = stopped
     # 1 = running
     # 2 = stopped but security group not deleted
+    # A running machine without task_id is still waiting to be provisioned
     status = db.Column(db.Integer)
     time_str = db.Column(db.DateTime)
     time_end = db.Column(db.DateTime)
@@ -34,6 +153,76 @@ class MachineLogModel(db.Model):
     user = db.relationship("Users", foreign_keys="MachineLogModel.user_id", lazy="select")
     challenge = db.relationship("Challenges", foreign_keys="MachineLogModel.chall_id", lazy="select")
 
+    # Created by migration 847fd130e20f
+    __table_args__ = (
+        db.Index("ix_machine_log_user_status_chall", "user_id", "status", "chall_id"),
+        db.Index("ix_machine_log_status_time_end", "status", "time_end"),
+    )
+
+class MachineActiveModel(db.Model):
+    """
+    Narrow live state of a running machine, one row per machine log with status 1.
+    The machine log detail is only rewritten when the state changes.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    log_id = db.Column(db.Integer, db.ForeignKey("machine_log_model.id", ondelete="CASCADE"), unique=True)
+    chall_id = db.Column(db.Integer, db.ForeignKey("challenges.id", ondelete="CASCADE"))
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"))
+    task_id = db.Column(db.String(255))
+    public_ip = db.Column(db.String(64))
+    # JSON list of containers with their port mappings
+    ports = db.Column(db.Text)
+    last_status = db.Column(db.String(32))
+    time_end = db.Column(db.DateTime)
+    # Latest heartbeat of the player, and number of times the lifetime was extended
+    last_seen = db.Column(db.DateTime)
+    extensions = db.Column(db.Integer, default=0, nullable=False)
+
+    log = db.relationship("MachineLogModel", foreign_keys="MachineActiveModel.log_id", lazy="select")
+
+    __table_args__ = (
+        db.Index("ix_machine_active_user_chall", "user_id", "chall_id"),
+        db.Index("ix_machine_active_time_end", "time_end"),
+        db.Index("ix_machine_active_task_id", "task_id"),
+    )
+
+    @staticmethod
+    def fields(detail):
+        return {
+            'task_id': detail.get('taskArn'),
+            'public_ip': detail.get('publicIp', ''),
+            'ports': json.dumps(detail.get('containers', [])),
+            'last_status': detail.get('lastStatus'),
+        }
+
+class MachinePoolModel(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    chall_id = db.Column(db.Integer, db.ForeignKey("challenges.id", ondelete="CASCADE"))
+    task_id = db.Column(db.String(255))
+    # Status
+    # 0 = starting
+    # 1 = ready to be claimed
+    # 2 = draining, stopped but security group not deleted
+    status = db.Column(db.Integer)
+    time_str = db.Column(db.DateTime)
+    detail = db.Column(db.Text)
+
+    challenge = db.relationship("Challenges", foreign_keys="MachinePoolModel.chall_id", lazy="select")
+
+class MachineSecGroupModel(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    # Hash of the VPC and the challenge networks rules, see rules_hash()
+    rules_hash = db.Column(db.String(64), unique=True)
+    group_id = db.Column(db.String(255))
+    # Number of machines that still use the security group
+    refcount = db.Column(db.Integer, default=0)
+    time_str = db.Column(db.DateTime)
+
+    @staticmethod
+    def rules_hash(networks):
+        rules = json.dumps([MachineEcsConfig.AWS_VPC_ID, networks], sort_keys=True)
+        return hashlib.sha256(rules.encode()).hexdigest()
+
 class MachineChallModel(DynamicChallenge):
     __mapper_args__ = {"polymorphic_identity": "machine"}
     id = db.Column(
@@ -42,6 +231,10 @@ class MachineChallModel(DynamicChallenge):
     slug = db.Column(db.Text(25), unique=True, default=getrandomslug) 
     duration = db.Column(db.Integer, default=60)
     config = db.Column(db.Text, default="")
+    pool_size = db.Column(db.Integer, default=0)
+    # Hash and revision ARN of the registered task definition
+    task_hash = db.Column(db.String(64))
+    task_arn = db.Column(db.String(255))
 
     def __init__(self, *args, **kwargs):
         super(MachineChallModel, self).__init__(**kwargs)
@@ -80,7 +273,7 @@ class MachineChallenge(DynamicValueChallenge):
         """
         data = request.form or request.get_json()
         data['slug'] = getrandomslug()
-        data['config'] = utils.ecs_register_task(data['slug'], data.get('config'))
+        data['config'], data['task_hash'], data['task_arn'] = utils.ecs_register_task(data['slug'], data.get('config'))
         
         challenge = cls.challenge_model(**data)
         db.session.add(challenge)
@@ -101,7 +294,15 @@ class MachineChallenge(DynamicValueChallenge):
         """
         data = request.form or request.get_json()
         if data.get('config') != None and challenge.config != data.get('config'):
-            data['config'] = utils.ecs_register_task(challenge.slug, data.get('config'))
+            old_cfg = json.loads(challenge.config) if challenge.config else None
+            data['config'], task_hash, task_arn = utils.ecs_register_task(challenge.slug, data.get('config'), challenge.task_hash)
+            utils.invalidate_config(challenge.slug)
+            if task_arn != None:
+                data['task_hash'] = task_hash
+                data['task_arn'] = task_arn
+            # Formatting only changes keep the warm pool
+            if task_arn != None or data['config'] == None or json.loads(data['config']) != old_cfg:
+                cls.drainpool(challenge)
         for attr, value in data.items():
             setattr(challenge, attr, value)
 
@@ -148,11 +349,26 @@ class MachineChallenge(DynamicValueChallenge):
         :param challenge:
         :return:
         """
-        utils.ecs_delete_task(challenge.slug)
+        # Tasks and task definition revisions are removed in the background
+        teardown.start(families=[challenge.slug])
+
+        # Pooled and running machines are removed with the challenge, so release their security groups first
+        machines = MachinePoolModel.query.filter(MachinePoolModel.chall_id == challenge.id).all()
+        machines += MachineLogModel.query.filter(
+            MachineLogModel.status != 0,
+            MachineLogModel.chall_id == challenge.id
+        ).all()
+        for machine in machines:
+            try:
+                cls.releasesecgroups(machine.detail)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
         super().delete(challenge)
 
 
     @classmethod
+    @metrics.operation
     def startmachine(cls, user, challenge):
         """
         This method is used to start a machine for a user and a challenge
@@ -161,34 +377,503 @@ class MachineChallenge(DynamicValueChallenge):
         :param challenge:
         :return: MachineLogModel object, data dictionary to be returned to the user
         """
-        CONTAINER_NUMLIMIT = 1
-        active_machine = MachineLogModel.query.filter(
-            MachineLogModel.status == 1,
-            MachineLogModel.user_id == user.id,
-            MachineLogModel.time_end > datetime.utcnow()
+        limits = admission_limits()
+        # Starts of a user are serialized, so concurrent requests cannot both pass the limit check
+        with start_lock(user.id):
+            # End the transaction of the request, so the count is not read from an older snapshot
+            db.session.commit()
+            active_machine = MachineActiveModel.query.filter(
+                MachineActiveModel.user_id == user.id,
+                MachineActiveModel.time_end > datetime.utcnow()
+            ).count()
+
+            if limits['user'] > 0 and active_machine >= limits['user']:
+                raise Exception('You have reached the maximum machine limit. Terminate another machine first.')
+
+            stt_machine = withhistory({}, {
+                'lastStatus': 'QUEUED',
+                'desiredStatus': 'RUNNING',
+                'containers': [],
+                'publicIp': ''
+            })
+            machine_log = MachineLogModel(
+                chall_id = challenge.id,
+                user_id = user.id,
+                status = 1,
+                time_str = datetime.utcnow(),
+                time_end = datetime.utcnow() + timedelta(minutes=challenge.duration),
+                detail = json.dumps(stt_machine)
+            )
+            active_machine = MachineActiveModel(
+                log = machine_log,
+                chall_id = challenge.id,
+                user_id = user.id,
+                time_end = machine_log.time_end,
+                last_seen = datetime.utcnow(),
+                **MachineActiveModel.fields(stt_machine)
+            )
+
+            # Capacity is checked and taken under one lock, so concurrent starts cannot overshoot a limit
+            with admission_lock():
+                db.session.commit()
+                # Checked before the new request is flushed, so it is not counted as waiting ahead of itself
+                capacity = cls.capacity()
+                direct = cls.admissible(capacity, limits, user.team_id, challenge) \
+                    and not cls.queuedahead(capacity, limits, user, challenge)
+
+                db.session.add(machine_log)
+                db.session.add(active_machine)
+                if direct:
+                    cls.admitmachine(machine_log, active_machine, challenge)
+                else:
+                    db.session.commit()
+                    expiry.scheduler.schedule(machine_log.id, machine_log.time_end)
+        return machine_log
+
+
+    @classmethod
+    @metrics.operation
+    def admitmachine(cls, machine_log, active_machine, challenge):
+        """
+        This method is used to let a queued machine start, either from the warm pool or through the provisioning workers.
+        The lifetime of the machine starts on admission.
+
+        :param machine_log:
+        :param active_machine:
+        :param challenge:
+        :return: Boolean, indicate the machine was claimed from the warm pool
+        """
+        stt_machine = cls.claimpool(challenge)
+        pooled = stt_machine != None
+        if stt_machine == None:
+            stt_machine = {
+                'lastStatus': 'PROVISIONING',
+                'desiredStatus': 'RUNNING',
+                'containers': [],
+                'publicIp': ''
+            }
+
+        machine_log.task_id = stt_machine.get('taskArn')
+        machine_log.time_str = datetime.utcnow()
+        machine_log.time_end = machine_log.time_str + timedelta(minutes=challenge.duration)
+        machine_log.detail = json.dumps(withhistory(json.loads(machine_log.detail), stt_machine, machine_log.time_str))
+        active_machine.time_end = machine_log.time_end
+        for attr, value in MachineActiveModel.fields(stt_machine).items():
+            setattr(active_machine, attr, value)
+        db.session.commit()
+        publish_state(active_machine.user_id, active_machine.chall_id)
+        publish_queue()
+
+        expiry.scheduler.schedule(machine_log.id, machine_log.time_end)
+        if machine_log.task_id == None:
+            provision.submit(cls.provisionmachine, machine_log.id)
+        elif stt_machine.get('lastStatus') == 'RUNNING':
+            metrics.start_seconds.observe(0.0, source='pool')
+        return pooled
+
+
+    @classmethod
+    def capacity(cls):
+        """
+        This method is used to count the admitted machines per team, per challenge and in the whole cluster.
+        Pooled machines use cluster capacity too.
+
+        :return: Dictionary of team Counter, challenge Counter and cluster total
+        """
+        admitted = MachineActiveModel.query.filter(MachineActiveModel.last_status != 'QUEUED')
+        teams = Counter(dict(
+            admitted.join(Users, Users.id == MachineActiveModel.user_id)
+            .with_entities(Users.team_id, func.count(MachineActiveModel.id))
+            .group_by(Users.team_id).all()
+        ))
+        challenges = Counter(dict(
+            admitted.with_entities(MachineActiveModel.chall_id, func.count(MachineActiveModel.id))
+            .group_by(MachineActiveModel.chall_id).all()
+        ))
+        pooled = MachinePoolModel.query.filter(MachinePoolModel.status != 2).count()
+        return {
+            'team': teams,
+            'challenge': challenges,
+            'cluster': sum(challenges.values()) + pooled,
+        }
+
+
+    @classmethod
+    def admissible(cls, capacity, limits, team_id, challenge):
+        """
+        This method is used to check whether one more machine fits in the team, challenge and cluster limits.
+
+        :return: Boolean
+        """
+        if team_id != None and limits['team'] > 0 and capacity['team'][team_id] >= limits['team']:
+            return False
+        if limits['challenge'] > 0 and capacity['challenge'][challenge.id] >= limits['challenge']:
+            return False
+        if limits['cluster'] > 0 and capacity['cluster'] >= limits['cluster']:
+            # A pooled machine is already counted, claiming it does not take more capacity
+            return MachinePoolModel.query.filter(
+                MachinePoolModel.status == 1,
+                MachinePoolModel.chall_id == challenge.id
+            ).count() > 0
+        return True
+
+
+    @classmethod
+    def queuedahead(cls, capacity, limits, user, challenge):
+        """
+        This method is used to check whether a new request must wait behind the queued ones.
+        Requests of the same team, for the same limited challenge, or admissible on the next
+        admission round are waited for. Requests held back by limits the new request does
+        not share are not.
+
+        :return: Boolean
+        """
+        for active_machine, team_id in cls.queuedmachines():
+            if active_machine.user_id == user.id or (team_id != None and team_id == user.team_id):
+                return True
+            if limits['challenge'] > 0 and active_machine.chall_id == challenge.id:
+                return True
+            queued_challenge = MachineChallModel.query.filter_by(id=active_machine.chall_id).first()
+            if cls.admissible(capacity, limits, team_id, queued_challenge):
+                return True
+        return False
+
+
+    @classmethod
+    def queuedmachines(cls):
+        """
+        This method is used to get the queued machines in admission order.
+        Teams are served round-robin, each team in the order of its own requests.
+        In user mode every user is its own team.
+
+        :return: List of tuple of MachineActiveModel object and team id
+        """
+        queued = MachineActiveModel.query.join(Users, Users.id == MachineActiveModel.user_id).filter(
+            MachineActiveModel.last_status == 'QUEUED'
+        ).with_entities(MachineActiveModel, Users.team_id).order_by(MachineActiveModel.log_id.asc()).all()
+
+        rounds = Counter()
+        first_request = {}
+        order = []
+        for active_machine, team_id in queued:
+            key = f"team:{team_id}" if team_id != None else f"user:{active_machine.user_id}"
+            first_request.setdefault(key, active_machine.log_id)
+            order.append(((rounds[key], first_request[key]), active_machine, team_id))
+            rounds[key] += 1
+        order.sort(key=lambda item: item[0])
+        return [(active_machine, team_id) for _, active_machine, team_id in order]
+
+
+    @classmethod
+    def queueposition(cls, machine_id):
+        """
+        This method is used to get the position of a machine in the admission queue.
+
+        :param machine_id: Machine log id
+        :return: Position starting from 1, None if the machine is not queued
+        """
+        # Every waiting player polls its position, so the queue order is shared for a short while
+        positions = cache.get('machine:queue')
+        if positions == None:
+            positions = {
+                active_machine.log_id: position
+                for position, (active_machine, _) in enumerate(cls.queuedmachines(), 1)
+            }
+            cache.set('machine:queue', positions, timeout=2)
+        return positions.get(machine_id)
+
+
+    @classmethod
+    @metrics.operation
+    def admitqueue(cls):
+        """
+        This method is used to admit queued machines while capacity is available.
+        Requests blocked by their team, challenge or cluster limit do not hold back the others.
+
+        :return: Number of admitted machines
+        """
+        limits = admission_limits()
+        with admission_lock():
+            # End the transaction of the job, so the capacity is not read from an older snapshot
+            db.session.commit()
+            capacity = cls.capacity()
+            admitted = 0
+            for active_machine, team_id in cls.queuedmachines():
+                challenge = MachineChallModel.query.filter_by(id=active_machine.chall_id).first()
+                # Also checks the cluster limit, pool claims are admitted when the cluster is full
+                if not cls.admissible(capacity, limits, team_id, challenge):
+                    continue
+                try:
+                    pooled = cls.admitmachine(active_machine.log, active_machine, challenge)
+                except Exception as e:
+                    # Terminated while waiting
+                    db.session.rollback()
+                    logger.info(
+                        f"Failed to admit machine id {active_machine.log_id} - {str(e)}",
+                        extra={'machine_id': active_machine.log_id, 'user_id': active_machine.user_id, 'challenge_id': active_machine.chall_id}
+                    )
+                    continue
+                capacity['team'][team_id] += 1
+                capacity['challenge'][challenge.id] += 1
+                # A claimed machine was already counted in the cluster as pooled
+                if not pooled:
+                    capacity['cluster'] += 1
+                admitted += 1
+        return admitted
+
+
+    @classmethod
+    def launchmachine(cls, challenge):
+        """
+        This method is used to start a new task for a challenge.
+        Fargate tasks use the shared security group of the challenge networks rules.
+
+        :param challenge:
+        :return: Machine detail dictionary
+        """
+        cfg = utils.parse_config(challenge.slug, challenge.config)
+        secgroup_id = None
+        if cfg.get('launchType', 'FARGATE') == 'FARGATE':
+            secgroup_id = cls.acquiresecgroup(cfg.get('networks', {'inbound': [], 'outbound': []}))
+
+        try:
+            return utils.ecs_start_machine(challenge.slug, challenge.config, secgroup_id, challenge.task_arn)
+        except Exception:
+            if secgroup_id != None:
+                MachineSecGroupModel.query.filter(MachineSecGroupModel.group_id == secgroup_id).update(
+                    {'refcount': MachineSecGroupModel.refcount - 1}, synchronize_session=False
+                )
+                db.session.commit()
+            raise
+
+
+    @classmethod
+    def acquiresecgroup(cls, networks):
+        """
+        This method is used to get the shared security group for a networks rules,
+        creating it on first use, and to take a reference on it.
+
+        :param networks:
+        :return: Security group id
+        """
+        rules_hash = MachineSecGroupModel.rules_hash(networks)
+        for _ in range(3):
+            secgroup = MachineSecGroupModel.query.filter_by(rules_hash=rules_hash).first()
+            if secgroup == None:
+                group_id = utils.ec2_create_secgroup(f'ctf-sg-{rules_hash[:16]}', f'ctfd machine {rules_hash}', networks)
+                try:
+                    db.session.add(MachineSecGroupModel(
+                        rules_hash = rules_hash,
+                        group_id = group_id,
+                        refcount = 0,
+                        time_str = datetime.utcnow()
+                    ))
+                    db.session.commit()
+                except IntegrityError:
+                    # Created by another request in the meantime
+                    db.session.rollback()
+                continue
+
+            acquired = MachineSecGroupModel.query.filter(MachineSecGroupModel.id == secgroup.id).update(
+                {'refcount': MachineSecGroupModel.refcount + 1}, synchronize_session=False
+            )
+            db.session.commit()
+            # Otherwise deleted by cleansecgroups in the meantime, look it up again
+            if acquired == 1:
+                return secgroup.group_id
+        raise Exception('Failed to acquire a security group.')
+
+
+    @classmethod
+    def releasesecgroups(cls, detail):
+        """
+        This method is used to release the security groups of a stopped machine.
+        Shared groups only lose a reference, groups made for a single machine are deleted.
+        The caller commits the session.
+
+        :param detail: Machine detail string
+        :return:
+        """
+        detail = json.loads(detail)
+        if detail.get('launchType') != 'FARGATE':
+            return
+
+        for group_id in detail.get('securityGroupId', []):
+            released = MachineSecGroupModel.query.filter(MachineSecGroupModel.group_id == group_id).update(
+                {'refcount': MachineSecGroupModel.refcount - 1}, synchronize_session=False
+            )
+            if released == 0:
+                utils.ec2_delete_secgroup(group_id)
+
+
+    @classmethod
+    @metrics.operation
+    def cleansecgroups(cls):
+        """
+        This method is used to delete shared security groups that are no longer used by any machine
+        and no longer match the networks rules of any challenge.
+
+        :return:
+        """
+        used_hashes = set()
+        for challenge in MachineChallModel.query.all():
+            try:
+                cfg = json.loads(challenge.config)
+            except (TypeError, ValueError):
+                continue
+            used_hashes.add(MachineSecGroupModel.rules_hash(cfg.get('networks', {'inbound': [], 'outbound': []})))
+
+        secgroups = MachineSecGroupModel.query.with_entities(
+            MachineSecGroupModel.id, MachineSecGroupModel.group_id, MachineSecGroupModel.rules_hash
+        ).filter(MachineSecGroupModel.refcount <= 0).all()
+        for secgroup_id, group_id, rules_hash in secgroups:
+            if rules_hash in used_hashes:
+                continue
+            # Re-checked when deleting, a launch may have taken a reference since the listing.
+            # The row stays locked until commit, so the group cannot be taken while EC2 deletes it.
+            deleted = MachineSecGroupModel.query.filter(
+                MachineSecGroupModel.id == secgroup_id,
+                MachineSecGroupModel.refcount <= 0
+            ).delete(synchronize_session=False)
+            if deleted == 0:
+                db.session.rollback()
+                continue
+            try:
+                utils.ec2_delete_secgroup(group_id)
+            except Exception as e:
+                db.session.rollback()
+                logger.info(f"Failed to delete security group {group_id} - {str(e)}")
+                continue
+            db.session.commit()
+
+
+    @classmethod
+    def failprovisioning(cls, machine_id, user_id, chall_id, old_detail, error):
+        """
+        This method is used to mark a machine whose task could not be started as failed.
+        Machines that got their task meanwhile are left as is.
+
+        :param machine_id:
+        :param user_id:
+        :param chall_id:
+        :param old_detail: Machine detail dictionary before the failure
+        :param error: Reason shown to the player
+        :return: Boolean, indicate the machine was marked as failed
+        """
+        failed = MachineActiveModel.query.filter(
+            MachineActiveModel.log_id == machine_id,
+            MachineActiveModel.task_id == None
+        ).delete(synchronize_session=False)
+        if failed == 1:
+            MachineLogModel.query.filter(MachineLogModel.id == machine_id).update({
+                'status': 0,
+                'time_end': datetime.utcnow(),
+                'detail': json.dumps(withhistory(old_detail, {'lastStatus': 'FAILED', 'desiredStatus': 'STOPPED', 'error': error}))
+            }, synchronize_session=False)
+        db.session.commit()
+        if failed == 1:
+            expiry.scheduler.cancel(machine_id)
+            publish_queue()
+        publish_state(user_id, chall_id)
+        return failed == 1
+
+
+    @classmethod
+    @metrics.operation
+    def failstaleprovisioning(cls, timeout):
+        """
+        This method is used to fail machines whose provisioning job never finished, e.g. when the worker died.
+        A job still running past the timeout finds the machine failed and stops its task.
+
+        :param timeout: timedelta
+        :return: Number of failed machines
+        """
+        stale = MachineActiveModel.query.join(
+            MachineLogModel, MachineLogModel.id == MachineActiveModel.log_id
+        ).filter(
+            MachineActiveModel.last_status == 'PROVISIONING',
+            MachineActiveModel.task_id == None,
+            MachineLogModel.time_str < datetime.utcnow() - timeout
+        ).with_entities(
+            MachineActiveModel.log_id, MachineActiveModel.user_id, MachineActiveModel.chall_id, MachineLogModel.detail
         ).all()
+        db.session.commit()
+
+        failed = 0
+        for machine_id, user_id, chall_id, detail in stale:
+            logger.info(
+                f"Provisioning of machine id {machine_id} timed out",
+                extra={'machine_id': machine_id, 'user_id': user_id, 'challenge_id': chall_id}
+            )
+            if cls.failprovisioning(machine_id, user_id, chall_id, json.loads(detail), 'Provisioning timed out, try again.'):
+                failed += 1
+        return failed
+
+
+    @classmethod
+    @metrics.operation
+    def provisionmachine(cls, machine_id):
+        """
+        This method is used by the provisioning workers to start the task of a queued machine log.
+
+        :param machine_id:
+        :return:
+        """
+        active_machine = MachineActiveModel.query.filter_by(log_id=machine_id).first()
+        if active_machine == None or active_machine.task_id != None:
+            return
+        challenge = MachineChallModel.query.filter_by(id=active_machine.chall_id).first()
+        fields = {'machine_id': machine_id, 'user_id': active_machine.user_id, 'challenge_id': active_machine.chall_id}
+        old_detail = json.loads(active_machine.log.detail)
+
+        started = time.monotonic()
+        try:
+            stt_machine = cls.launchmachine(challenge)
+        except Exception as e:
+            logger.error(f"Failed provision machine: {machine_id} - {str(e)}", extra=dict(fields, duration=time.monotonic() - started))
+            cls.failprovisioning(machine_id, fields['user_id'], fields['challenge_id'], old_detail, str(e))
+            return
 
-        if len(active_machine) >= CONTAINER_NUMLIMIT:
-            raise Exception('You have reached the maximum machine limit. Terminate another machine first.')
-
-        stt_machine = utils.ecs_start_machine(challenge.slug, challenge.config)
-        machine_log = MachineLogModel(
-            chall_id = challenge.id,
-            user_id = user.id,
-            task_id = stt_machine['taskArn'],
-            status = 1,
-            time_str = datetime.utcnow(),
-            time_end = datetime.utcnow() + timedelta(minutes=challenge.duration),
-            detail = json.dumps(stt_machine)
+        logger.info(
+            f"Provisioned machine id {machine_id}",
+            extra=dict(fields, task_arn=stt_machine['taskArn'], duration=time.monotonic() - started)
         )
 
-        db.session.add(machine_log)
+        time_str = datetime.utcnow()
+        time_end = time_str + timedelta(minutes=challenge.duration)
+        provisioned = MachineActiveModel.query.filter(
+            MachineActiveModel.log_id == machine_id,
+            MachineActiveModel.task_id == None
+        ).update(dict(
+            time_end = time_end,
+            **MachineActiveModel.fields(stt_machine)
+        ), synchronize_session=False)
+
+        if provisioned == 1:
+            MachineLogModel.query.filter(MachineLogModel.id == machine_id).update({
+                'task_id': stt_machine['taskArn'],
+                'time_str': time_str,
+                'time_end': time_end,
+                'detail': json.dumps(withhistory(old_detail, stt_machine, time_str))
+            }, synchronize_session=False)
+            db.session.commit()
+            publish_state(fields['user_id'], fields['challenge_id'])
+            expiry.scheduler.schedule(machine_id, time_end)
+            return
         db.session.commit()
 
-        return machine_log
+        # Terminated while the task was starting, stop it and let the cron release its security group
+        utils.ecs_terminate_machine(stt_machine['taskArn'])
+        MachineLogModel.query.filter(MachineLogModel.id == machine_id).update({
+            'task_id': stt_machine['taskArn'],
+            'status': 2,
+            'detail': json.dumps(withhistory(old_detail, stt_machine))
+        }, synchronize_session=False)
+        db.session.commit()
 
 
     @classmethod
+    @metrics.operation
     def updatemachine(cls, user, challenge):
         """
         This method is used to update machine status for a user and a challenge.
@@ -197,26 +882,352 @@ class MachineChallenge(DynamicValueChallenge):
         :param challenge:
         :return: MachineLogModel object, data dictionary to be returned to the user
         """
-        active_machine = MachineLogModel.query.filter(
-            MachineLogModel.status == 1,
-            MachineLogModel.user_id == user.id,
-            MachineLogModel.chall_id == challenge.id
+        active_machine = MachineActiveModel.query.filter(
+            MachineActiveModel.user_id == user.id,
+            MachineActiveModel.chall_id == challenge.id
+        ).first()
+        if active_machine == None:
+            raise NotFound('Machine log not found.')
+
+        # Status requests of the player are the heartbeat of the machine
+        cls.touchmachine(active_machine)
+
+        # Machine detail is kept up to date by the status refresher
+        return active_machine.log
+
+
+    @classmethod
+    def touchmachine(cls, active_machine):
+        """
+        This method is used to record the activity of the player on a machine.
+        Heartbeats are written at most once per activity.HEARTBEAT_THROTTLE.
+
+        :param active_machine: MachineActiveModel object
+        :return:
+        """
+        now = datetime.utcnow()
+        if active_machine.last_seen != None and (now - active_machine.last_seen).total_seconds() < activity.HEARTBEAT_THROTTLE:
+            return
+        MachineActiveModel.query.filter(MachineActiveModel.id == active_machine.id).update(
+            {'last_seen': now}, synchronize_session=False
+        )
+        db.session.commit()
+
+
+    @classmethod
+    @metrics.operation
+    def extendmachine(cls, user, challenge):
+        """
+        This method is used to extend the lifetime of a machine, up to the maximum lifetime counted from its admission.
+
+        :param user:
+        :param challenge:
+        :return: MachineLogModel object
+        """
+        active_machine = MachineActiveModel.query.filter(
+            MachineActiveModel.user_id == user.id,
+            MachineActiveModel.chall_id == challenge.id
         ).first()
         if active_machine == None:
             raise NotFound('Machine log not found.')
+        if active_machine.last_status == 'QUEUED':
+            raise Exception('The machine has not started yet.')
+        max_extensions = int(get_config('MACHINECHALL_MAX_EXTENSIONS') or 0)
+        if active_machine.extensions >= max_extensions:
+            raise Exception('The machine cannot be extended anymore.')
+
+        extend_minutes = get_config('MACHINECHALL_EXTEND_MINUTES')
+        extend_minutes = 30 if extend_minutes == None else int(extend_minutes)
+        if extend_minutes <= 0:
+            raise Exception('The machine cannot be extended anymore.')
 
-        cache_key = f'machine:{active_machine.id}'
-        if cache.get(cache_key) == None:
-            new_detail = utils.ecs_update_machine(active_machine.detail)
-            active_machine.detail = json.dumps(new_detail)
+        machine_log = active_machine.log
+        time_end = active_machine.time_end
+        if time_end <= datetime.utcnow():
+            raise Exception('The machine has expired.')
+        extended = min(
+            time_end + timedelta(minutes=extend_minutes),
+            machine_log.time_str + timedelta(minutes=max(challenge.duration, int(get_config('MACHINECHALL_MAX_LIFETIME') or 180)))
+        )
+        if extended <= time_end:
+            raise Exception('The machine has reached its maximum lifetime.')
+
+        # Only one of concurrent extensions applies
+        updated = MachineActiveModel.query.filter(
+            MachineActiveModel.id == active_machine.id,
+            MachineActiveModel.time_end == time_end,
+            MachineActiveModel.extensions < max_extensions
+        ).update({
+            'time_end': extended,
+            'extensions': MachineActiveModel.extensions + 1,
+            'last_seen': datetime.utcnow()
+        }, synchronize_session=False)
+        if updated == 0:
+            db.session.rollback()
+            raise Exception('The machine is being updated, try again later.')
+        MachineLogModel.query.filter(MachineLogModel.id == machine_log.id).update(
+            {'time_end': extended}, synchronize_session=False
+        )
+        db.session.commit()
+        publish_state(user.id, challenge.id)
+
+        expiry.scheduler.schedule(machine_log.id, extended)
+        db.session.refresh(machine_log)
+        return machine_log
+
+
+    @classmethod
+    @metrics.operation
+    def refreshmachines(cls, full = False):
+        """
+        This method is used to refresh the detail of every active machine with batched AWS calls.
+        Machines that are already running are skipped unless full refresh is requested.
+
+        :param full:
+        :return:
+        """
+        active_machines = MachineActiveModel.query.filter(MachineActiveModel.task_id != None)
+        if not full:
+            active_machines = active_machines.filter(MachineActiveModel.last_status != 'RUNNING')
+        active_machines = active_machines.all()
+        if len(active_machines) == 0:
+            return
+
+        machine_logs = MachineLogModel.query.filter(
+            MachineLogModel.id.in_([active_machine.log_id for active_machine in active_machines])
+        ).all()
+        old_details = {machine_log.id: json.loads(machine_log.detail) for machine_log in machine_logs}
+        admitted = {machine_log.id: machine_log.time_str for machine_log in machine_logs}
+
+        new_details = utils.ecs_update_multimachine(list(old_details.values()))
+
+        now = datetime.utcnow()
+        log_mappings = []
+        active_mappings = []
+        changed = []
+        stopped = []
+        for active_machine in active_machines:
+            old_detail = old_details.get(active_machine.log_id)
+            new_detail = new_details.get(active_machine.task_id)
+            if old_detail == None or new_detail == None or new_detail == old_detail:
+                continue
+            if old_detail.get('lastStatus') != 'RUNNING' and new_detail.get('lastStatus') == 'RUNNING':
+                metrics.start_seconds.observe((now - admitted[active_machine.log_id]).total_seconds(), source='task')
+            log_mappings.append({'id': active_machine.log_id, 'detail': json.dumps(withhistory(old_detail, new_detail, now))})
+            # Missing tasks are reported as STOPPED too
+            if new_detail.get('lastStatus') == 'STOPPED':
+                stopped.append(active_machine)
+                continue
+            active_mappings.append(dict(id = active_machine.id, **MachineActiveModel.fields(new_detail)))
+            changed.append((active_machine.user_id, active_machine.chall_id))
+        db.session.bulk_update_mappings(MachineLogModel, log_mappings)
+        db.session.bulk_update_mappings(MachineActiveModel, active_mappings)
+        db.session.commit()
+        for user_id, chall_id in changed:
+            publish_state(user_id, chall_id)
+        cls.retiremachines(stopped)
+
+
+    @classmethod
+    def retiremachines(cls, active_machines):
+        """
+        This method is used to mark machines whose task stopped outside of the plugin as terminated.
+        Their security groups are released by the cron, like for terminated machines.
+
+        :param active_machines: list of MachineActiveModel object
+        :return:
+        """
+        if len(active_machines) == 0:
+            return
+        now = datetime.utcnow()
+        retired = [
+            (active_machine.id, active_machine.log_id, active_machine.user_id, active_machine.chall_id, active_machine.task_id)
+            for active_machine in active_machines
+        ]
+        for _, log_id, user_id, chall_id, task_id in retired:
+            logger.info(
+                f"Machine id {log_id} stopped outside of the plugin",
+                extra={'machine_id': log_id, 'user_id': user_id, 'challenge_id': chall_id, 'task_arn': task_id}
+            )
+        MachineLogModel.query.filter(MachineLogModel.id.in_([retire[1] for retire in retired])).update({
+            'status': 2,
+            'time_end': now
+        }, synchronize_session=False)
+        MachineActiveModel.query.filter(MachineActiveModel.id.in_([retire[0] for retire in retired])).delete(synchronize_session=False)
+        db.session.commit()
+
+        for _, log_id, user_id, chall_id, _ in retired:
+            expiry.scheduler.cancel(log_id)
+            publish_state(user_id, chall_id)
+        # The freed capacity may let queued machines in
+        publish_queue()
+
+
+    @classmethod
+    @metrics.operation
+    def applytaskevents(cls, runtasks):
+        """
+        This method is used to apply ECS task state changes to the active and pooled machines.
+        Tasks stopped out-of-band are marked as terminated.
+
+        :param runtasks: list of ECS task dictionaries, e.g. the detail of task state change events
+        :return:
+        """
+        latest = {}
+        for runtask in runtasks:
+            old = latest.get(runtask['taskArn'])
+            if old == None or utils.task_status_rank(runtask['lastStatus']) >= utils.task_status_rank(old['lastStatus']):
+                latest[runtask['taskArn']] = runtask
+        if len(latest) == 0:
+            return
+
+        active_machines = MachineActiveModel.query.filter(MachineActiveModel.task_id.in_(list(latest))).all()
+        pooled = MachinePoolModel.query.filter(
+            MachinePoolModel.status != 2,
+            MachinePoolModel.task_id.in_(list(latest))
+        ).all()
+        machine_logs = {}
+        if len(active_machines) > 0:
+            machine_logs = {
+                machine_log.id: machine_log for machine_log in MachineLogModel.query.filter(
+                    MachineLogModel.id.in_([active_machine.log_id for active_machine in active_machines])
+                ).all()
+            }
+
+        old_details = {}
+        for active_machine in active_machines:
+            if active_machine.log_id in machine_logs:
+                old_details[active_machine.task_id] = json.loads(machine_logs[active_machine.log_id].detail)
+        for machine in pooled:
+            old_details[machine.task_id] = json.loads(machine.detail)
+
+        # Ignore events older than what is already known
+        runtasks = [
+            runtask for arn, runtask in latest.items()
+            if arn in old_details
+            and utils.task_status_rank(runtask['lastStatus']) >= utils.task_status_rank(old_details[arn].get('lastStatus'))
+        ]
+        new_details = utils.parse_multitask_response(runtasks, old_details)
+
+        now = datetime.utcnow()
+        changed = []
+        stopped = []
+        for active_machine in active_machines:
+            new_detail = new_details.get(active_machine.task_id)
+            machine_log = machine_logs.get(active_machine.log_id)
+            if new_detail == None or machine_log == None:
+                continue
+            if old_details[active_machine.task_id].get('lastStatus') != 'RUNNING' and new_detail['lastStatus'] == 'RUNNING':
+                metrics.start_seconds.observe((now - machine_log.time_str).total_seconds(), source='task')
+            machine_log.detail = json.dumps(withhistory(old_details[active_machine.task_id], new_detail, now))
+            if new_detail['lastStatus'] == 'STOPPED':
+                stopped.append(active_machine)
+                continue
+            changed.append((active_machine.user_id, active_machine.chall_id))
+            for attr, value in MachineActiveModel.fields(new_detail).items():
+                setattr(active_machine, attr, value)
+
+        for machine in pooled:
+            new_detail = new_details.get(machine.task_id)
+            if new_detail == None:
+                continue
+            machine.detail = json.dumps(new_detail)
             if new_detail['lastStatus'] == 'RUNNING':
-                cache.set(cache_key, active_machine.detail, 5 * 60)
+                machine.status = 1
+            elif new_detail['lastStatus'] == 'STOPPED':
+                machine.status = 2
+        db.session.commit()
+        for user_id, chall_id in changed:
+            publish_state(user_id, chall_id)
+        cls.retiremachines(stopped)
+
+
+    @classmethod
+    @metrics.operation
+    def reconcilemachines(cls, grace = timedelta(minutes=5)):
+        """
+        This method is used to compare the tasks running in the cluster with the active machines.
+        Tasks unknown to the database are stopped, machines whose task is gone are marked as terminated.
 
+        :param grace: Minimum age of a task before it is considered orphaned or lost.
+            Covers machines being provisioned and the eventual consistency of the task listing.
+        :return: Tuple of the number of orphaned tasks and lost machines
+        """
+        # Load the database side first, so machines started during the listing are not reported as lost
+        active_machines = MachineActiveModel.query.join(
+            MachineLogModel, MachineLogModel.id == MachineActiveModel.log_id
+        ).filter(MachineActiveModel.task_id != None).with_entities(MachineActiveModel, MachineLogModel.time_str).all()
+        pooled = MachinePoolModel.query.filter(MachinePoolModel.status != 2).all()
+        db.session.commit()
+
+        runtasks = utils.ecs_describe_cluster_tasks('ctfd-')
+        running = {runtask['taskArn'] for runtask in runtasks}
+
+        # Query again after the listing, so tasks committed meanwhile are known too
+        known = {
+            task_id for task_id, in MachineActiveModel.query.with_entities(MachineActiveModel.task_id).filter(
+                MachineActiveModel.task_id != None
+            ).all()
+        }
+        known |= {
+            task_id for task_id, in MachinePoolModel.query.with_entities(MachinePoolModel.task_id).all()
+        }
+
+        created_before = datetime.now(timezone.utc) - grace
+        orphans = [
+            runtask['taskArn'] for runtask in runtasks
+            if runtask['taskArn'] not in known and runtask['createdAt'] < created_before
+        ]
+        for taskArn, result in utils.ecs_terminate_machines(
+            orphans,
+            max_workers=int(get_config('MACHINECHALL_TERMINATE_WORKERS') or 16)
+        ).items():
+            if result != None:
+                logger.info(f"Failed to stop orphaned task {taskArn} - {result}", extra={'task_arn': taskArn})
+
+        # Fresh tasks may be missing from the listing for a while
+        started_before = datetime.utcnow() - grace
+        lost_machines = [
+            active_machine for active_machine, time_str in active_machines
+            if active_machine.task_id not in running and time_str < started_before
+        ]
+        lost_pooled_machines = [
+            machine for machine in pooled
+            if machine.task_id not in running and machine.time_str < started_before
+        ]
+        # Stop them anyway, in case the task is still running but was missed by the listing
+        for taskArn, result in utils.ecs_terminate_machines(
+            [machine.task_id for machine in lost_machines + lost_pooled_machines],
+            max_workers=int(get_config('MACHINECHALL_TERMINATE_WORKERS') or 16)
+        ).items():
+            if result != None:
+                logger.info(f"Failed to stop lost task {taskArn} - {result}", extra={'task_arn': taskArn})
+
+        lost = [active_machine.log_id for active_machine in lost_machines]
+        owners = [(active_machine.user_id, active_machine.chall_id) for active_machine in lost_machines]
+        if len(lost) > 0:
+            MachineActiveModel.query.filter(
+                MachineActiveModel.log_id.in_(lost)
+            ).delete(synchronize_session=False)
+            MachineLogModel.query.filter(
+                MachineLogModel.status == 1,
+                MachineLogModel.id.in_(lost)
+            ).update({'status': 2, 'time_end': datetime.utcnow()}, synchronize_session=False)
+
+        lost_pooled = [machine.id for machine in lost_pooled_machines]
+        if len(lost_pooled) > 0:
+            MachinePoolModel.query.filter(
+                MachinePoolModel.id.in_(lost_pooled)
+            ).update({'status': 2}, synchronize_session=False)
         db.session.commit()
-        return active_machine
+        for user_id, chall_id in owners:
+            publish_state(user_id, chall_id)
+
+        return len(orphans), len(lost) + len(lost_pooled)
 
 
     @classmethod
+    @metrics.operation
     def terminatemachine(cls, user = None, challenge = None):
         """
         This method is used to terminate machine for a user and a challenge
@@ -226,26 +1237,144 @@ class MachineChallenge(DynamicValueChallenge):
         :param challenge:
         :return: Boolean, indicate job is successfully executed or not
         """
-        active_machines = MachineLogModel.query.filter(MachineLogModel.status == 1)
+        active_machines = MachineActiveModel.query
         if user != None:
-            active_machines = active_machines.filter(MachineLogModel.user_id == user.id)
+            active_machines = active_machines.filter(MachineActiveModel.user_id == user.id)
         if challenge != None:
-            active_machines = active_machines.filter(MachineLogModel.chall_id == challenge.id)
+            active_machines = active_machines.filter(MachineActiveModel.chall_id == challenge.id)
         active_machines = active_machines.all()
 
+        results = cls.terminatemachines(active_machines)
+        errors = [result for result in results.values() if result != None]
+        if len(errors) > 0:
+            raise Exception(errors[0])
+        return True
+
+
+    @classmethod
+    @metrics.operation
+    def reclaimidle(cls, idle_timeout):
+        """
+        This method is used to terminate running machines without activity for longer than the idle timeout.
+        Activity is counted from the admission of the machine, so fresh machines are never idle.
+        The idle timeout is at least activity.MIN_IDLE_TIMEOUT, a few heartbeats of the challenge view.
+
+        :param idle_timeout: timedelta
+        :return: Dictionary of machine log id to None on success, or the error message
+        """
+        idle_timeout = max(idle_timeout, timedelta(seconds=activity.MIN_IDLE_TIMEOUT))
+        cutoff = datetime.utcnow() - idle_timeout
+        candidates = MachineActiveModel.query.join(
+            MachineLogModel, MachineLogModel.id == MachineActiveModel.log_id
+        ).filter(
+            MachineActiveModel.last_status == 'RUNNING',
+            MachineLogModel.time_str < cutoff,
+            (MachineActiveModel.last_seen == None) | (MachineActiveModel.last_seen < cutoff)
+        ).all()
+        if len(candidates) == 0:
+            return {}
+
+        latest = activity.last_activity(candidates)
+        idle = [
+            active_machine for active_machine in candidates
+            if latest.get(active_machine.log_id) == None or latest[active_machine.log_id] < cutoff
+        ]
+        for active_machine in idle:
+            logger.info(
+                f"[IDLE] Terminating machine id {active_machine.log_id}",
+                extra={'machine_id': active_machine.log_id, 'user_id': active_machine.user_id, 'challenge_id': active_machine.chall_id, 'task_arn': active_machine.task_id}
+            )
+        return cls.terminatemachines(idle)
+
+
+    @classmethod
+    @metrics.operation
+    def terminatemachines(cls, active_machines):
+        """
+        This method is used to terminate many machines at once.
+        Tasks are stopped in parallel and the machine logs are updated in bulk.
+
+        :param active_machines: list of MachineActiveModel object
+        :return: Dictionary of machine log id to None on success, or the error message
+        """
+        now = datetime.utcnow()
+        results = {}
+        owners = {active_machine.log_id: (active_machine.user_id, active_machine.chall_id) for active_machine in active_machines}
+        queued = any(active_machine.last_status == 'QUEUED' for active_machine in active_machines)
+
+        # Machines still provisioning have nothing to stop, unless their task started in the meantime
+        pending = []
         for active_machine in active_machines:
-            stt_machine = utils.ecs_terminate_machine(active_machine.task_id)
-            if not stt_machine:
-                return False
+            if active_machine.task_id != None:
+                continue
+            cancelled = MachineActiveModel.query.filter(
+                MachineActiveModel.id == active_machine.id,
+                MachineActiveModel.task_id == None
+            ).delete(synchronize_session=False)
+            if cancelled == 1:
+                pending.append(active_machine.log_id)
+                results[active_machine.log_id] = None
+            else:
+                results[active_machine.log_id] = 'Machine is starting, try again later.'
 
-            active_machine.status = 2
-            active_machine.time_end = datetime.utcnow()
-            db.session.commit()
+        started = {
+            active_machine.log_id: active_machine.task_id
+            for active_machine in active_machines if active_machine.task_id != None
+        }
+        stt_machines = utils.ecs_terminate_machines(
+            list(started.values()),
+            max_workers=int(get_config('MACHINECHALL_TERMINATE_WORKERS') or 16)
+        )
+        for machine_id, task_id in started.items():
+            results[machine_id] = stt_machines[task_id]
+        stopped = [machine_id for machine_id, task_id in started.items() if stt_machines[task_id] == None]
 
-        return True
+        if len(pending) > 0:
+            MachineLogModel.query.filter(
+                MachineLogModel.status == 1,
+                MachineLogModel.id.in_(pending)
+            ).update({'status': 0, 'time_end': now}, synchronize_session=False)
+        if len(stopped) > 0:
+            MachineActiveModel.query.filter(
+                MachineActiveModel.log_id.in_(stopped)
+            ).delete(synchronize_session=False)
+            MachineLogModel.query.filter(
+                MachineLogModel.status == 1,
+                MachineLogModel.id.in_(stopped)
+            ).update({'status': 2, 'time_end': now}, synchronize_session=False)
+        db.session.commit()
+
+        for machine_id in pending + stopped:
+            publish_state(*owners[machine_id])
+            expiry.scheduler.cancel(machine_id)
+        if queued:
+            publish_queue()
+        return results
 
 
     @classmethod
+    @metrics.operation
+    def resetmachines(cls):
+        """
+        This method is used to forget every machine and tear down the tasks of every challenge in the background.
+        Shared security groups lose all their references, they are deleted once their tasks are gone.
+
+        :return: teardown job id
+        """
+        now = datetime.utcnow()
+        MachineActiveModel.query.delete(synchronize_session=False)
+        MachinePoolModel.query.delete(synchronize_session=False)
+        MachineLogModel.query.filter(MachineLogModel.status == 1).update(
+            {'status': 0, 'time_end': now}, synchronize_session=False
+        )
+        MachineLogModel.query.filter(MachineLogModel.status == 2).update({'status': 0}, synchronize_session=False)
+        MachineSecGroupModel.query.update({'refcount': 0}, synchronize_session=False)
+        db.session.commit()
+        return teardown.start(prefix='ctfd')
+
+
+    @classmethod
+    @metrics.operation
     def statusmachine(cls, user = None, challenge = None):
         """
         This method is used to get machine status for a user and a challenge.
@@ -255,15 +1384,137 @@ class MachineChallenge(DynamicValueChallenge):
         :param challenge:
         :return: List of MachineLogModel object, list of data dictionary to be returned to the user
         """
-        active_machines = MachineLogModel.query.filter(MachineLogModel.status == 1)
+        active_machines = MachineLogModel.query.join(
+            MachineActiveModel, MachineActiveModel.log_id == MachineLogModel.id
+        )
         if user != None:
-            active_machines = active_machines.filter(MachineLogModel.user_id == user.id)
+            active_machines = active_machines.filter(MachineActiveModel.user_id == user.id)
         if challenge != None:
-            active_machines = active_machines.filter(MachineLogModel.chall_id == challenge.id)
+            active_machines = active_machines.filter(MachineActiveModel.chall_id == challenge.id)
         active_machines = active_machines.all()
 
         return active_machines
 
+
+    @classmethod
+    @metrics.operation
+    def claimpool(cls, challenge):
+        """
+        This method is used to take a ready machine out of the challenge warm pool.
+        The claim is not committed, so it is persisted together with the machine log.
+
+        :param challenge:
+        :return: Machine detail dictionary, None if the pool is empty
+        """
+        candidates = MachinePoolModel.query.filter(
+            MachinePoolModel.status == 1,
+            MachinePoolModel.chall_id == challenge.id
+        ).order_by(MachinePoolModel.id.asc()).limit(5).all()
+
+        for candidate in candidates:
+            detail = candidate.detail
+            # Conditional delete, only one request can win the same pooled machine
+            claimed = MachinePoolModel.query.filter(
+                MachinePoolModel.id == candidate.id,
+                MachinePoolModel.status == 1
+            ).delete(synchronize_session=False)
+            if claimed == 1:
+                return json.loads(detail)
+        return None
+
+
+    @classmethod
+    @metrics.operation
+    def refillpool(cls, challenge):
+        """
+        This method is used to refresh the warm pool of a challenge and
+        start machines until it reaches the configured pool size.
+
+        :param challenge:
+        :return:
+        """
+        pooled = MachinePoolModel.query.filter(
+            MachinePoolModel.chall_id == challenge.id
+        ).all()
+
+        for machine in pooled:
+            if machine.status == 2:
+                try:
+                    cls.releasesecgroups(machine.detail)
+                    db.session.delete(machine)
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+
+        new_details = utils.ecs_update_multimachine([
+            json.loads(machine.detail) for machine in pooled if machine.status != 2
+        ])
+        for machine in pooled:
+            new_detail = new_details.get(machine.task_id)
+            if machine.status == 2 or new_detail == None:
+                continue
+
+            machine.detail = json.dumps(new_detail)
+            if new_detail['lastStatus'] == 'RUNNING':
+                machine.status = 1
+            elif new_detail['lastStatus'] in ('DEPROVISIONING', 'STOPPED'):
+                machine.status = 2
+        db.session.commit()
+
+        alive = [machine for machine in pooled if machine.status != 2]
+        pool_size = challenge.pool_size or 0
+        for machine in alive[pool_size:]:
+            utils.ecs_terminate_machine(machine.task_id)
+            machine.status = 2
+        db.session.commit()
+
+        missing = pool_size - len(alive)
+        cluster_limit = admission_limits()['cluster']
+        if cluster_limit > 0:
+            missing = min(missing, cluster_limit - cls.capacity()['cluster'])
+        for _ in range(missing):
+            stt_machine = cls.launchmachine(challenge)
+            db.session.add(MachinePoolModel(
+                chall_id = challenge.id,
+                task_id = stt_machine['taskArn'],
+                status = 0,
+                time_str = datetime.utcnow(),
+                detail = json.dumps(stt_machine)
+            ))
+            db.session.commit()
+
+
+    @classmethod
+    @metrics.operation
+    def drainpool(cls, challenge):
+        """
+        This method is used to stop every pooled machine of a challenge, e.g. after its configuration changed.
+        Security groups are deleted later by the refill job.
+
+        :param challenge:
+        :return:
+        """
+        pooled = MachinePoolModel.query.filter(
+            MachinePoolModel.status != 2,
+            MachinePoolModel.chall_id == challenge.id
+        ).all()
+        for machine in pooled:
+            utils.ecs_terminate_machine(machine.task_id)
+            machine.status = 2
+        db.session.commit()
+
+@metrics.collector
+def collect_machine_gauges():
+    metrics.active_machines.replace([
+        ({'challenge': chall_id, 'status': last_status}, count)
+        for chall_id, last_status, count in MachineActiveModel.query.with_entities(
+            MachineActiveModel.chall_id,
+            MachineActiveModel.last_status,
+            func.count(MachineActiveModel.id)
+        ).group_by(MachineActiveModel.chall_id, MachineActiveModel.last_status).all()
+    ])
+    metrics.secgroup_backlog.set(MachineLogModel.query.filter(MachineLogModel.status == 2).count())
+
 def load(app):
     upgrade()
 
@@ -0,0 +1,33 @@
+from CTFd.utils import get_config
+
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+
+logger = logging.getLogger('machine')
+
+_app = None
+_executor = None
+
+def submit(func, *args):
+    """
+    Queue a provisioning job. The job runs inside the application context
+    on one of the bounded worker threads.
+    """
+    def job():
+        with _app.app_context():
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error(f"Failed provisioning job: {func.__name__} - {args} - {str(e)}")
+
+    return _executor.submit(job)
+
+
+def load(app):
+    global _app, _executor
+    _app = app
+    _executor = ThreadPoolExecutor(
+        max_workers=int(get_config('MACHINECHALL_PROVISION_WORKERS') or 8),
+        thread_name_prefix='machine-provision'
+    )
@@ -0,0 +1,184 @@
+from . import metrics
+
+from CTFd.cache import cache
+
+from contextlib import contextmanager
+from functools import wraps
+
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger('machine')
+
+# Requests per second and burst size for each AWS API, "<service>" is the default of a service.
+# Values stay below the documented ECS and EC2 API limits, see MACHINECHALL_AWS_RATE_LIMITS to override them.
+DEFAULT_BUDGETS = {
+    'ecs': (20, 50),
+    'ecs.RunTask': (20, 100),
+    'ecs.StopTask': (20, 100),
+    'ecs.DescribeTasks': (20, 50),
+    'ecs.ListTasks': (20, 50),
+    'ecs.RegisterTaskDefinition': (1, 5),
+    'ecs.DeregisterTaskDefinition': (1, 5),
+    'ec2': (20, 100),
+    'ec2.CreateSecurityGroup': (5, 10),
+    'ec2.DeleteSecurityGroup': (5, 10),
+    'ec2.AuthorizeSecurityGroupIngress': (5, 10),
+    'ec2.AuthorizeSecurityGroupEgress': (5, 10),
+    'ssm': (10, 20),
+    'sqs': (100, 300),
+}
+
+# Share of the budget that only player-facing calls may use
+BULK_RESERVE = 0.3
+
+PRIORITY_PLAYER = 'player'
+PRIORITY_BULK = 'bulk'
+
+_local = threading.local()
+
+@contextmanager
+def priority(level):
+    """
+    Run the AWS calls of the block with the given priority, e.g. PRIORITY_BULK for admin and cron work.
+    """
+    previous = current_priority()
+    _local.priority = level
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def current_priority():
+    return getattr(_local, 'priority', PRIORITY_PLAYER)
+
+
+def bulk(func):
+    """
+    Run the decorated job with the bulk priority.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with priority(PRIORITY_BULK):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, reserve = 0.0):
+        """
+        Take one token, waiting until one is available above the reserved share of the bucket.
+
+        :return: Seconds spent waiting
+        """
+        floor = self.burst * reserve
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens - 1 >= floor:
+                    self.tokens -= 1
+                    return waited
+                delay = (floor + 1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class SharedWindow(object):
+    """
+    Cross-process budget on top of the CTFd cache, counting calls in one second windows.
+    """
+    def __init__(self, backend, name, rate):
+        self.backend = backend
+        self.name = name
+        self.rate = rate
+
+    def acquire(self, reserve = 0.0):
+        limit = max(1, int(self.rate * (1 - reserve)))
+        waited = 0.0
+        while True:
+            now = time.time()
+            key = f"machine:ratelimit:{self.name}:{int(now)}"
+            self.backend.add(key, 0, timeout=5)
+            if (self.backend.inc(key) or 0) <= limit:
+                return waited
+            delay = 1 - (now - int(now))
+            time.sleep(delay)
+            waited += delay
+
+
+class RateLimiter(object):
+    def __init__(self, budgets = None, backend = None):
+        self.budgets = dict(DEFAULT_BUDGETS)
+        self.budgets.update(budgets or {})
+        self.backend = backend
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, service, operation):
+        name = f"{service}.{operation}"
+        if name not in self.budgets:
+            name = service
+        with self.lock:
+            bucket = self.buckets.get(name)
+            if bucket == None:
+                rate, burst = self.budgets.get(name, (10, 20))
+                if self.backend != None:
+                    bucket = SharedWindow(self.backend, name, rate)
+                else:
+                    bucket = TokenBucket(rate, burst)
+                self.buckets[name] = bucket
+        return bucket
+
+    def before_call(self, service, operation):
+        reserve = BULK_RESERVE if current_priority() == PRIORITY_BULK else 0.0
+        waited = self.bucket(service, operation).acquire(reserve)
+        metrics.aws_ratelimit_wait_seconds.observe(waited, service=service, operation=operation)
+
+    def register(self, client):
+        """
+        Route every call of a boto3 client through the limiter.
+        Latency, errors and throttling of the calls are recorded by metrics.instrument().
+        """
+        service = client.meta.service_model.service_name
+
+        def before_call(model, **kwargs):
+            self.before_call(service, model.name)
+
+        service_id = client.meta.service_model.service_id.hyphenize()
+        client.meta.events.register(f'before-call.{service_id}', before_call)
+        return client
+
+limiter = RateLimiter()
+
+
+def load(app, budgets = None, shared = False):
+    """
+    Configure the process-wide limiter. Budgets is a JSON object of "<service>.<Operation>" to [rate, burst].
+    The shared mode counts calls in the CTFd cache, so every process of the deployment uses one budget.
+    """
+    global limiter
+    if isinstance(budgets, str):
+        try:
+            budgets = {name: tuple(value) for name, value in json.loads(budgets).items()}
+        except (TypeError, ValueError) as e:
+            logger.error(f"Invalid AWS rate limits: {str(e)}")
+            budgets = None
+
+    backend = None
+    if shared:
+        with app.app_context():
+            backend = cache.cache
+    limiter = RateLimiter(budgets, backend)
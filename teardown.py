@@ -0,0 +1,145 @@
+from . import utils
+from .ratelimit import bulk
+
+from CTFd.cache import cache
+from CTFd.utils import get_config
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from os import urandom
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger('machine')
+
+# Progress is kept in the CTFd cache, so every process can answer the status endpoint
+PROGRESS_TIMEOUT = 24 * 60 * 60
+# Only the first errors are reported
+MAX_ERRORS = 50
+
+_app = None
+
+class TeardownJob(object):
+    """
+    Background removal of task definition families: every running task is stopped,
+    then every active revision is deregistered. Listing is paginated and the calls
+    are fanned out through a bounded pool.
+    """
+    def __init__(self, families = None, prefix = None, max_workers = 16):
+        self.id = urandom(8).hex()
+        self.families = families
+        self.prefix = prefix
+        self.max_workers = max_workers
+        self.saved = 0
+        self.progress = {
+            'id': self.id,
+            'state': 'pending',
+            'families': 0,
+            'tasks': 0,
+            'stopped': 0,
+            'revisions': 0,
+            'deregistered': 0,
+            'failed': 0,
+            'errors': [],
+            'time_str': datetime.utcnow().isoformat(),
+            'time_end': None,
+        }
+
+    def save(self, force = False):
+        # Progress is written at most once per second while the job runs
+        if not force and time.monotonic() - self.saved < 1:
+            return
+        self.saved = time.monotonic()
+        cache.set(f"machine:teardown:{self.id}", dict(self.progress), timeout=PROGRESS_TIMEOUT)
+
+    def fail(self, arn, error):
+        self.progress['failed'] += 1
+        if len(self.progress['errors']) < MAX_ERRORS:
+            self.progress['errors'].append(f"{arn} - {error}")
+
+    def fanout(self, executor, func, arns, counter):
+        futures = {executor.submit(func, arn): arn for arn in arns}
+        for future in as_completed(futures):
+            error = future.result()
+            if error == None:
+                self.progress[counter] += 1
+            else:
+                self.fail(futures[future], error)
+            self.save()
+
+    @bulk
+    def run(self):
+        self.progress['state'] = 'running'
+        self.save(force=True)
+        try:
+            families = self.families
+            if families == None:
+                families = utils.ecs_list_families(self.prefix)
+            self.progress['families'] = len(families)
+            self.save(force=True)
+
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='machine-teardown') as executor:
+                taskArns = []
+                for arns in executor.map(bulk(utils.ecs_list_family_tasks), families):
+                    taskArns.extend(arns)
+                self.progress['tasks'] = len(taskArns)
+                self.save(force=True)
+                self.fanout(executor, bulk(utils.ecs_stop_task), taskArns, 'stopped')
+
+                taskDefinitionArns = []
+                for arns in executor.map(bulk(utils.ecs_list_task_revisions), families):
+                    taskDefinitionArns.extend(arns)
+                self.progress['revisions'] = len(taskDefinitionArns)
+                self.save(force=True)
+                self.fanout(executor, bulk(utils.ecs_deregister_task), taskDefinitionArns, 'deregistered')
+
+            self.progress['state'] = 'done' if self.progress['failed'] == 0 else 'failed'
+        except Exception as e:
+            self.progress['state'] = 'failed'
+            self.fail(self.prefix or ','.join(self.families), str(e))
+        self.progress['time_end'] = datetime.utcnow().isoformat()
+        self.save(force=True)
+        logger.info(
+            f"[TEARDOWN] Job {self.id} {self.progress['state']}: "
+            f"{self.progress['stopped']}/{self.progress['tasks']} task(s) stopped, "
+            f"{self.progress['deregistered']}/{self.progress['revisions']} revision(s) deregistered"
+        )
+
+
+def start(families = None, prefix = None):
+    """
+    Start tearing down the given task definition families, or every family with the given prefix.
+    Must be called within the application context.
+
+    :return: job id, to be looked up with status()
+    """
+    job = TeardownJob(families, prefix, int(get_config('MACHINECHALL_TERMINATE_WORKERS') or 16))
+    job.save(force=True)
+    cache.set('machine:teardown:latest', job.id, timeout=PROGRESS_TIMEOUT)
+
+    def worker():
+        with _app.app_context():
+            job.run()
+
+    threading.Thread(target=worker, name=f"machine-teardown-{job.id}", daemon=True).start()
+    logger.info(f"[TEARDOWN] Job {job.id} started for {prefix or ', '.join(families)}")
+    return job.id
+
+
+def status(job_id = None):
+    """
+    :param job_id: job id, the latest job when omitted
+    :return: progress dictionary, or None when the job is unknown
+    """
+    if job_id == None:
+        job_id = cache.get('machine:teardown:latest')
+        if job_id == None:
+            return None
+    return cache.get(f"machine:teardown:{job_id}")
+
+
+def load(app):
+    global _app
+    _app = app
@@ -0,0 +1,69 @@
+"""
+Fixtures of the plugin tests. AWS is replaced by the in-process fake of benchmarks/fakeaws.py.
+
+Must run from the CTFd root, with the plugin installed as CTFd/plugins/machine_challenges:
+
+    python -m pytest CTFd/plugins/machine_challenges/tests
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+import fakeaws
+
+# The plugin creates its boto3 session and reads its AWS settings on import
+os.environ['MACHINECHALL_ENABLED'] = 'true'
+os.environ.setdefault('MACHINECHALL_ECS_CLUSTER', 'test')
+os.environ.setdefault('MACHINECHALL_VPC_ID', 'vpc-test')
+os.environ.setdefault('MACHINECHALL_REGION', 'us-east-1')
+fakeaws.install(fakeaws.FakeBackend(latency=0, start_delay=0, stop_delay=0, rates={}, default_rate=None, seed=0))
+
+
+@pytest.fixture
+def aws():
+    """
+    Fresh fake AWS backend, tasks are RUNNING as soon as they are started.
+    """
+    backend = fakeaws.FakeBackend(latency=0, start_delay=0, stop_delay=0, rates={}, default_rate=None, seed=0)
+    fakeaws.FakeSession.backend = backend
+    return backend
+
+
+@pytest.fixture
+def app(aws, monkeypatch):
+    """
+    CTFd with the plugin loaded on a temporary SQLite database.
+    Background jobs are kept out of the way by never being the leader,
+    and provisioning runs synchronously, so tests drive every step themselves.
+    """
+    from CTFd import create_app
+    from CTFd.config import TestingConfig
+
+    class PluginTestingConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{tempfile.mkstemp(prefix='machine-test-', suffix='.db')[1]}"
+        SERVER_NAME = 'localhost'
+        CACHE_TYPE = 'simple'
+        LOG_FOLDER = tempfile.mkdtemp(prefix='machine-test-logs-')
+        # Threaded tests wait on the SQLite write lock
+        SQLALCHEMY_ENGINE_OPTIONS = {'connect_args': {'timeout': 30}}
+
+    app = create_app(PluginTestingConfig)
+
+    from CTFd.plugins.machine_challenges import provision
+    from CTFd.plugins.machine_challenges.leader import election
+    monkeypatch.setattr(election, 'is_leader', lambda: False)
+    monkeypatch.setattr(provision, 'submit', lambda func, *args: func(*args))
+
+    with app.app_context():
+        from CTFd.utils import set_config
+        set_config('setup', True)
+        set_config('ctf_name', 'test')
+        set_config('user_mode', 'users')
+        yield app
+
+        from CTFd.models import db
+        db.session.remove()
+    os.remove(PluginTestingConfig.SQLALCHEMY_DATABASE_URI[len('sqlite:///'):])
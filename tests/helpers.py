@@ -0,0 +1,102 @@
+"""
+Helpers of the plugin tests, to be used within the app fixture.
+"""
+import json
+
+TASK_CONFIG = {
+    "launchType": "FARGATE",
+    "taskDefinition": {
+        "requiresCompatibilities": ["FARGATE"],
+        "networkMode": "awsvpc",
+        "cpu": "256",
+        "memory": "512",
+        "containerDefinitions": [{
+            "name": "challenge",
+            "image": "nginx:latest",
+            "portMappings": [{"containerPort": 80, "protocol": "tcp"}],
+        }],
+    },
+    "networks": {
+        "inbound": [{"FromPort": 80, "ToPort": 80, "CidrIp": "0.0.0.0/0", "IpProtocol": "tcp"}],
+        "outbound": [],
+    },
+}
+
+
+def gen_user(name = 'player', team_id = None):
+    from CTFd.models import Users, db
+
+    user = Users(name=name, email=f"{name}@test.local", password='password', verified=True, team_id=team_id)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def gen_team(name = 'team'):
+    from CTFd.models import Teams, db
+
+    team = Teams(name=name, email=f"{name}@test.local", password='password')
+    db.session.add(team)
+    db.session.commit()
+    return team
+
+
+def gen_machine_challenge(name = 'machine', duration = 60, pool_size = 0, config = None):
+    from CTFd.models import db
+    from CTFd.plugins.machine_challenges import utils
+    from CTFd.plugins.machine_challenges.models import MachineChallModel, getrandomslug
+
+    slug = getrandomslug()
+    config, task_hash, task_arn = utils.ecs_register_task(slug, json.dumps(config or TASK_CONFIG))
+    challenge = MachineChallModel(
+        name=name, description='', category='test', type='machine', state='visible',
+        value=100, initial=100, minimum=10, decay=50,
+        slug=slug, duration=duration, config=config, task_hash=task_hash, task_arn=task_arn,
+        pool_size=pool_size
+    )
+    db.session.add(challenge)
+    db.session.commit()
+    return challenge
+
+
+def login_as(app, user):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['id'] = user.id
+        session['nonce'] = 'test'
+    return client
+
+
+HEADERS = {'CSRF-Token': 'test', 'Accept': 'application/json'}
+
+
+def run_concurrently(app, func, *args_list):
+    """
+    Run func once per arguments tuple, each call on its own thread and application context,
+    all released at the same time.
+
+    :return: list of (result, exception) in the order of the arguments
+    """
+    import threading
+
+    barrier = threading.Barrier(len(args_list))
+    results = [None] * len(args_list)
+
+    def worker(i, args):
+        from CTFd.models import db
+        with app.app_context():
+            barrier.wait()
+            try:
+                results[i] = (func(*args), None)
+            except Exception as e:
+                db.session.rollback()
+                results[i] = (None, e)
+            finally:
+                db.session.remove()
+
+    threads = [threading.Thread(target=worker, args=(i, args)) for i, args in enumerate(args_list)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
@@ -0,0 +1,125 @@
+from CTFd.models import Challenges, Users, db
+from CTFd.plugins.machine_challenges.models import MachineActiveModel, MachineChallenge, MachinePoolModel
+from CTFd.utils import set_config
+
+from helpers import gen_machine_challenge, gen_team, gen_user, run_concurrently
+
+
+def last_status(user):
+    return MachineActiveModel.query.filter_by(user_id=user.id).first().last_status
+
+
+def start(user_id, challenge_id):
+    return MachineChallenge.startmachine(
+        Users.query.filter_by(id=user_id).first(),
+        Challenges.query.filter_by(id=challenge_id).first()
+    ).id
+
+
+def test_cluster_limit_queues_new_machines(app):
+    set_config('MACHINECHALL_CLUSTER_LIMIT', 1)
+    challenge = gen_machine_challenge()
+    first, second = gen_user('first'), gen_user('second')
+
+    MachineChallenge.startmachine(first, challenge)
+    MachineChallenge.startmachine(second, challenge)
+    assert last_status(first) == 'RUNNING'
+    assert last_status(second) == 'QUEUED'
+    assert MachineChallenge.admitqueue() == 0
+
+    MachineChallenge.terminatemachine(first, challenge)
+    assert MachineChallenge.admitqueue() == 1
+    assert last_status(second) == 'RUNNING'
+
+
+def test_admitqueue_claims_pool_when_cluster_is_full(app):
+    set_config('MACHINECHALL_CLUSTER_LIMIT', 2)
+    plain = gen_machine_challenge('plain')
+    pooled = gen_machine_challenge('pooled', pool_size=1)
+    running, waiting, claiming = gen_user('running'), gen_user('waiting'), gen_user('claiming')
+
+    MachineChallenge.startmachine(running, plain)
+    # The starting pooled machine fills the cluster, but cannot be claimed yet
+    MachineChallenge.refillpool(pooled)
+    MachineChallenge.startmachine(waiting, plain)
+    MachineChallenge.startmachine(claiming, pooled)
+    assert last_status(waiting) == 'QUEUED'
+    assert last_status(claiming) == 'QUEUED'
+
+    # The request held back by the cluster limit does not hold back the pool claim behind it
+    MachineChallenge.refillpool(pooled)
+    assert MachineChallenge.admitqueue() == 1
+    assert last_status(waiting) == 'QUEUED'
+    assert last_status(claiming) == 'RUNNING'
+    assert MachinePoolModel.query.count() == 0
+
+
+def test_start_claims_pool_ahead_of_cluster_bound_requests(app):
+    set_config('MACHINECHALL_CLUSTER_LIMIT', 2)
+    plain = gen_machine_challenge('plain')
+    pooled = gen_machine_challenge('pooled', pool_size=1)
+    running, waiting, claiming = gen_user('running'), gen_user('waiting'), gen_user('claiming')
+
+    MachineChallenge.startmachine(running, plain)
+    MachineChallenge.refillpool(pooled)
+    MachineChallenge.refillpool(pooled)
+    MachineChallenge.startmachine(waiting, plain)
+    MachineChallenge.startmachine(claiming, pooled)
+    assert last_status(waiting) == 'QUEUED'
+    assert last_status(claiming) == 'RUNNING'
+
+
+def test_team_limited_requests_do_not_queue_other_teams(app):
+    set_config('MACHINECHALL_TEAM_LIMIT', 1)
+    red, blue = gen_team('red'), gen_team('blue')
+    red1, red2, blue1 = gen_user('red1', red.id), gen_user('red2', red.id), gen_user('blue1', blue.id)
+    first, second, third = gen_machine_challenge('first'), gen_machine_challenge('second'), gen_machine_challenge('third')
+
+    MachineChallenge.startmachine(red1, first)
+    MachineChallenge.startmachine(red2, second)
+    assert last_status(red2) == 'QUEUED'
+
+    MachineChallenge.startmachine(blue1, third)
+    assert last_status(blue1) == 'RUNNING'
+
+
+def test_new_request_waits_behind_its_team(app):
+    set_config('MACHINECHALL_TEAM_LIMIT', 1)
+    red = gen_team('red')
+    red1, red2, red3 = gen_user('red1', red.id), gen_user('red2', red.id), gen_user('red3', red.id)
+    first, second, third = gen_machine_challenge('first'), gen_machine_challenge('second'), gen_machine_challenge('third')
+
+    MachineChallenge.startmachine(red1, first)
+    MachineChallenge.startmachine(red2, second)
+    MachineChallenge.terminatemachine(red1, first)
+
+    # Capacity is free again, but red2 asked first
+    MachineChallenge.startmachine(red3, third)
+    assert last_status(red3) == 'QUEUED'
+    assert MachineChallenge.admitqueue() == 1
+    assert last_status(red2) == 'RUNNING'
+    assert last_status(red3) == 'QUEUED'
+
+
+def test_concurrent_starts_of_different_users_respect_cluster_limit(app):
+    set_config('MACHINECHALL_CLUSTER_LIMIT', 1)
+    users = [gen_user(f"player{i}") for i in range(4)]
+    challenge = gen_machine_challenge()
+
+    results = run_concurrently(app, start, *[(user.id, challenge.id) for user in users])
+    assert [error for _, error in results] == [None] * 4
+    db.session.expire_all()
+    assert MachineActiveModel.query.filter(MachineActiveModel.last_status != 'QUEUED').count() == 1
+    assert MachineActiveModel.query.filter(MachineActiveModel.last_status == 'QUEUED').count() == 3
+
+
+def test_concurrent_starts_of_a_team_respect_team_limit(app):
+    set_config('MACHINECHALL_TEAM_LIMIT', 1)
+    red = gen_team('red')
+    red1, red2 = gen_user('red1', red.id), gen_user('red2', red.id)
+    first, second = gen_machine_challenge('first'), gen_machine_challenge('second')
+
+    results = run_concurrently(app, start, (red1.id, first.id), (red2.id, second.id))
+    assert [error for _, error in results] == [None] * 2
+    db.session.expire_all()
+    assert sorted(last_status(user) for user in (red1, red2)) == ['QUEUED', 'RUNNING']
@@ -0,0 +1,45 @@
+from CTFd.plugins.machine_challenges.models import MachineChallenge, state_version
+from CTFd.utils import set_config
+
+from helpers import HEADERS, gen_machine_challenge, gen_user, login_as
+
+import json
+
+
+def test_state_version_changes_with_the_machine(app):
+    user, challenge = gen_user(), gen_machine_challenge()
+    initial = state_version(user.id, challenge.id)
+
+    MachineChallenge.startmachine(user, challenge)
+    started = state_version(user.id, challenge.id)
+    assert started != initial
+
+    MachineChallenge.terminatemachine(user, challenge)
+    assert state_version(user.id, challenge.id) != started
+
+
+def test_queued_version_changes_with_the_queue(app):
+    set_config('MACHINECHALL_CLUSTER_LIMIT', 1)
+    challenge = gen_machine_challenge()
+    first, second = gen_user('first'), gen_user('second')
+    MachineChallenge.startmachine(first, challenge)
+    MachineChallenge.startmachine(second, challenge)
+    queued = state_version(second.id, challenge.id, queued=True)
+
+    MachineChallenge.terminatemachine(first, challenge)
+    assert state_version(second.id, challenge.id, queued=True) != queued
+
+
+def test_stream_reports_provisioning_failure(app, monkeypatch):
+    user, challenge = gen_user(), gen_machine_challenge()
+
+    def fail(challenge):
+        raise Exception('No capacity')
+    monkeypatch.setattr(MachineChallenge, 'launchmachine', fail)
+    MachineChallenge.startmachine(user, challenge)
+
+    client = login_as(app, user)
+    response = client.get(f"/api/v1/machines/{challenge.id}/events", headers=HEADERS)
+    events = response.get_data(as_text=True).strip().split('\n\n')
+    assert events[-1].startswith('event: error\n')
+    assert json.loads(events[-1].split('data: ', 1)[1]) == {'success': False, 'errors': 'No capacity'}
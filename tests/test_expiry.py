@@ -0,0 +1,63 @@
+from CTFd.plugins.machine_challenges.expiry import ExpiryScheduler
+
+from datetime import datetime, timedelta
+
+import threading
+
+
+def test_pop_expired_returns_due_machines_in_order():
+    scheduler = ExpiryScheduler()
+    now = datetime.utcnow()
+    scheduler.schedule(1, now - timedelta(seconds=10))
+    scheduler.schedule(2, now + timedelta(seconds=10))
+    scheduler.schedule(3, now - timedelta(seconds=20))
+
+    assert scheduler.pop_expired(now) == [3, 1]
+    assert scheduler.pop_expired(now) == []
+    assert list(scheduler.deadlines) == [2]
+
+
+def test_cancel_and_extend_supersede_old_deadlines():
+    scheduler = ExpiryScheduler()
+    now = datetime.utcnow()
+    scheduler.schedule(1, now - timedelta(seconds=10))
+    scheduler.schedule(2, now - timedelta(seconds=10))
+    scheduler.cancel(1)
+    # Extended, the old heap entry is skipped
+    scheduler.schedule(2, now + timedelta(minutes=30))
+
+    assert scheduler.pop_expired(now) == []
+    assert scheduler.pop_expired(now + timedelta(minutes=30)) == [2]
+
+
+def test_close_expirations_are_handled_in_one_batch():
+    scheduler = ExpiryScheduler(batch_window=0.2, resync_interval=3600)
+    now = datetime.utcnow()
+    batches = []
+    done = threading.Event()
+
+    def handler(machine_ids):
+        batches.append(sorted(machine_ids))
+        done.set()
+        return []
+
+    scheduler.start(lambda: [(1, now + timedelta(seconds=0.1)), (2, now + timedelta(seconds=0.2))], handler)
+    assert done.wait(5)
+    assert batches == [[1, 2]]
+
+
+def test_failed_terminations_are_retried():
+    scheduler = ExpiryScheduler(batch_window=0, resync_interval=3600, retry_delay=0.1)
+    calls = []
+    done = threading.Event()
+
+    def handler(machine_ids):
+        calls.append(list(machine_ids))
+        if len(calls) == 2:
+            done.set()
+            return []
+        return machine_ids
+
+    scheduler.start(lambda: [(1, datetime.utcnow())], handler)
+    assert done.wait(5)
+    assert calls == [[1], [1]]
@@ -0,0 +1,66 @@
+from CTFd.models import Challenges, Users, db
+from CTFd.plugins.machine_challenges.models import MachineActiveModel, MachineChallenge
+from CTFd.utils import set_config
+
+from helpers import gen_machine_challenge, gen_user, run_concurrently
+
+from datetime import datetime, timedelta
+
+import pytest
+
+
+def extend(user_id, challenge_id):
+    return MachineChallenge.extendmachine(
+        Users.query.filter_by(id=user_id).first(),
+        Challenges.query.filter_by(id=challenge_id).first()
+    ).time_end
+
+
+def test_extend_adds_minutes_up_to_the_maximum_lifetime(app):
+    set_config('MACHINECHALL_EXTEND_MINUTES', 30)
+    set_config('MACHINECHALL_MAX_LIFETIME', 100)
+    user, challenge = gen_user(), gen_machine_challenge(duration=60)
+    machine_log = MachineChallenge.startmachine(user, challenge)
+    time_str, time_end = machine_log.time_str, machine_log.time_end
+
+    assert MachineChallenge.extendmachine(user, challenge).time_end == time_end + timedelta(minutes=30)
+    assert MachineChallenge.extendmachine(user, challenge).time_end == time_str + timedelta(minutes=100)
+    with pytest.raises(Exception, match='maximum lifetime'):
+        MachineChallenge.extendmachine(user, challenge)
+
+
+def test_extend_rejects_expired_machines(app):
+    user, challenge = gen_user(), gen_machine_challenge()
+    machine_log = MachineChallenge.startmachine(user, challenge)
+    MachineActiveModel.query.filter_by(log_id=machine_log.id).update({'time_end': datetime.utcnow() - timedelta(seconds=1)})
+    db.session.commit()
+
+    with pytest.raises(Exception, match='expired'):
+        MachineChallenge.extendmachine(user, challenge)
+
+
+def test_extend_is_disabled_with_zero_minutes(app):
+    set_config('MACHINECHALL_EXTEND_MINUTES', 0)
+    user, challenge = gen_user(), gen_machine_challenge()
+    machine_log = MachineChallenge.startmachine(user, challenge)
+
+    with pytest.raises(Exception, match='cannot be extended'):
+        MachineChallenge.extendmachine(user, challenge)
+    assert MachineActiveModel.query.filter_by(log_id=machine_log.id).first().time_end == machine_log.time_end
+
+
+def test_concurrent_extends_are_not_lost(app):
+    set_config('MACHINECHALL_EXTEND_MINUTES', 30)
+    set_config('MACHINECHALL_MAX_LIFETIME', 1000)
+    set_config('MACHINECHALL_MAX_EXTENSIONS', 10)
+    user, challenge = gen_user(), gen_machine_challenge()
+    time_end = MachineChallenge.startmachine(user, challenge).time_end
+
+    results = run_concurrently(app, extend, *[(user.id, challenge.id)] * 4)
+    extended = sorted(extended for extended, _ in results if extended != None)
+    # Every applied extension starts from the end left by the previous one
+    assert extended == [time_end + timedelta(minutes=30 * (i + 1)) for i in range(len(extended))]
+    db.session.expire_all()
+    active_machine = MachineActiveModel.query.filter_by(user_id=user.id).first()
+    assert active_machine.extensions == len(extended)
+    assert active_machine.time_end == time_end + timedelta(minutes=30 * len(extended))
@@ -0,0 +1,35 @@
+from CTFd.plugins.machine_challenges import utils
+from CTFd.plugins.machine_challenges.models import MachineChallenge, MachineLogModel
+
+from helpers import gen_machine_challenge, gen_user
+
+import json
+
+
+def statuses(machine_log):
+    detail = json.loads(MachineLogModel.query.filter_by(id=machine_log.id).first().detail)
+    return [entry['lastStatus'] for entry in detail['history']]
+
+
+def test_history_keeps_every_transition(app, aws):
+    machine_log = MachineChallenge.startmachine(gen_user(), gen_machine_challenge())
+    started = statuses(machine_log)
+    assert started[:2] == ['QUEUED', 'PROVISIONING']
+
+    # Refreshes without a status change do not grow the history
+    MachineChallenge.refreshmachines(full=True)
+    assert statuses(machine_log) == started
+
+    ecs = utils.get_client('ecs')
+    ecs.stop_task(cluster='test', task=machine_log.task_id)
+    MachineChallenge.applytaskevents(ecs.describe_tasks(cluster='test', tasks=[machine_log.task_id])['tasks'])
+    assert statuses(machine_log) == started + ['STOPPED']
+
+
+def test_history_records_provisioning_failure(app, monkeypatch):
+    def fail(challenge):
+        raise Exception('No capacity')
+    monkeypatch.setattr(MachineChallenge, 'launchmachine', fail)
+
+    machine_log = MachineChallenge.startmachine(gen_user(), gen_machine_challenge())
+    assert statuses(machine_log) == ['QUEUED', 'PROVISIONING', 'FAILED']
@@ -0,0 +1,89 @@
+from CTFd.models import db
+from CTFd.plugins.machine_challenges import activity
+from CTFd.plugins.machine_challenges.models import MachineActiveModel, MachineChallenge, MachineLogModel
+from CTFd.utils import set_config
+
+from helpers import gen_machine_challenge, gen_user
+
+from datetime import datetime, timedelta
+
+
+def idle_for(machine_log, minutes):
+    since = datetime.utcnow() - timedelta(minutes=minutes)
+    MachineLogModel.query.filter_by(id=machine_log.id).update({'time_str': since})
+    MachineActiveModel.query.filter_by(log_id=machine_log.id).update({'last_seen': since})
+    db.session.commit()
+
+
+def test_reclaimidle_terminates_only_idle_machines(app, aws):
+    challenge = gen_machine_challenge()
+    idle = MachineChallenge.startmachine(gen_user('idle'), challenge)
+    busy = MachineChallenge.startmachine(gen_user('busy'), challenge)
+    idle_for(idle, 20)
+    idle_for(busy, 20)
+    MachineChallenge.touchmachine(MachineActiveModel.query.filter_by(log_id=busy.id).first())
+
+    assert MachineChallenge.reclaimidle(timedelta(minutes=10)) == {idle.id: None}
+    assert [active_machine.log_id for active_machine in MachineActiveModel.query.all()] == [busy.id]
+    assert aws.tasks[idle.task_id]['stoppedAt'] != None
+
+
+def test_reclaimidle_keeps_fresh_machines(app):
+    machine_log = MachineChallenge.startmachine(gen_user(), gen_machine_challenge())
+    MachineActiveModel.query.filter_by(log_id=machine_log.id).update({'last_seen': None})
+    db.session.commit()
+
+    assert MachineChallenge.reclaimidle(timedelta(minutes=10)) == {}
+
+
+def test_idle_timeout_spans_several_heartbeats(app):
+    machine_log = MachineChallenge.startmachine(gen_user(), gen_machine_challenge())
+    # One heartbeat was missed, the machine is still in use
+    idle_for(machine_log, 2 * activity.HEARTBEAT_INTERVAL / 60)
+
+    assert MachineChallenge.reclaimidle(timedelta(seconds=activity.HEARTBEAT_INTERVAL)) == {}
+
+
+def test_touchmachine_records_heartbeats_of_the_view_interval(app):
+    machine_log = MachineChallenge.startmachine(gen_user(), gen_machine_challenge())
+    # The previous heartbeat arrived slightly less than an interval ago
+    seen = datetime.utcnow() - timedelta(seconds=activity.HEARTBEAT_INTERVAL - 5)
+    MachineActiveModel.query.filter_by(log_id=machine_log.id).update({'last_seen': seen})
+    db.session.commit()
+
+    MachineChallenge.touchmachine(MachineActiveModel.query.filter_by(log_id=machine_log.id).first())
+    assert MachineActiveModel.query.filter_by(log_id=machine_log.id).first().last_seen > seen
+
+
+def test_touchmachine_throttles_writes(app):
+    machine_log = MachineChallenge.startmachine(gen_user(), gen_machine_challenge())
+    seen = datetime.utcnow() - timedelta(seconds=1)
+    MachineActiveModel.query.filter_by(log_id=machine_log.id).update({'last_seen': seen})
+    db.session.commit()
+
+    MachineChallenge.touchmachine(MachineActiveModel.query.filter_by(log_id=machine_log.id).first())
+    assert MachineActiveModel.query.filter_by(log_id=machine_log.id).first().last_seen == seen
+
+
+def test_heartbeat_alone_does_not_enable_reclaim(app, monkeypatch):
+    assert activity.traffic_source() == None
+
+    traffic = lambda active_machines: {}
+    monkeypatch.setitem(activity._sources, 'traffic', traffic)
+    set_config('MACHINECHALL_ACTIVITY_SOURCE', 'traffic')
+    assert activity.traffic_source() == traffic
+
+    set_config('MACHINECHALL_ACTIVITY_SOURCE', 'unknown')
+    assert activity.traffic_source() == None
+
+
+def test_traffic_keeps_machines_without_heartbeat(app, monkeypatch):
+    machine_log = MachineChallenge.startmachine(gen_user(), gen_machine_challenge())
+    idle_for(machine_log, 20)
+    # Used over SSH with the challenge modal closed
+    monkeypatch.setitem(activity._sources, 'traffic', lambda active_machines: {
+        active_machine.log_id: datetime.utcnow() for active_machine in active_machines
+    })
+    set_config('MACHINECHALL_ACTIVITY_SOURCE', 'traffic')
+
+    assert MachineChallenge.reclaimidle(timedelta(minutes=10)) == {}
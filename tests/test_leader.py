@@ -0,0 +1,33 @@
+from CTFd.plugins.machine_challenges import leader
+from CTFd.plugins.machine_challenges.leader import LeaderElection
+
+from helpers import run_concurrently
+
+
+def test_single_leader_per_term(app):
+    elections = [LeaderElection(key='machine:leader:test') for _ in range(4)]
+
+    results = run_concurrently(app, lambda election: election.heartbeat(), *[(election,) for election in elections])
+    assert [leading for leading, _ in results].count(True) == 1
+
+
+def test_leader_keeps_the_next_term(app, monkeypatch):
+    now = [1000 * 30 + 1.0]
+    monkeypatch.setattr(leader.time, 'time', lambda: now[0])
+    first, second = LeaderElection(key='machine:leader:test'), LeaderElection(key='machine:leader:test')
+
+    assert first.heartbeat() == True
+    now[0] += 30
+    assert second.heartbeat() == False
+    assert first.heartbeat() == True
+
+
+def test_other_process_takes_over_a_dead_leader(app, monkeypatch):
+    now = [1000 * 30 + 1.0]
+    monkeypatch.setattr(leader.time, 'time', lambda: now[0])
+    first, second = LeaderElection(key='machine:leader:test'), LeaderElection(key='machine:leader:test')
+
+    assert first.heartbeat() == True
+    # The leader stops renewing, the term it claimed ahead runs out
+    now[0] += 60
+    assert second.heartbeat() == True
@@ -0,0 +1,25 @@
+from CTFd.plugins.machine_challenges import metrics
+
+
+def test_render_includes_every_process(app, monkeypatch):
+    # Another worker recorded its samples in the shared cache
+    monkeypatch.setattr(metrics, 'process_id', lambda: 'other:1')
+    monkeypatch.setattr(metrics.idle_reclaimed, 'values', {(): 2})
+    metrics.publish()
+
+    monkeypatch.setattr(metrics, 'process_id', lambda: 'this:1')
+    monkeypatch.setattr(metrics.idle_reclaimed, 'values', {(): 1})
+    lines = metrics.render().splitlines()
+    assert 'machine_idle_reclaimed_total{process="other:1"} 2.0' in lines
+    assert 'machine_idle_reclaimed_total{process="this:1"} 1.0' in lines
+    # Read from the database, the same for every process
+    assert 'machine_secgroup_backlog 0.0' in lines
+
+
+def test_processes_that_are_gone_drop_out(app, monkeypatch):
+    monkeypatch.setattr(metrics, 'process_id', lambda: 'other:1')
+    metrics.publish()
+    metrics.cache.delete('machine:metrics:other:1')
+
+    monkeypatch.setattr(metrics, 'process_id', lambda: 'this:1')
+    assert list(metrics.snapshots()) == ['this:1']
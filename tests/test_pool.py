@@ -0,0 +1,60 @@
+from CTFd.models import db
+from CTFd.plugins.machine_challenges.models import MachineChallenge, MachineChallModel, MachinePoolModel
+
+from helpers import gen_machine_challenge, gen_user, run_concurrently
+
+import json
+
+
+def test_refillpool_starts_up_to_pool_size(app, aws):
+    challenge = gen_machine_challenge(pool_size=2)
+
+    MachineChallenge.refillpool(challenge)
+    assert MachinePoolModel.query.filter_by(chall_id=challenge.id, status=0).count() == 2
+    assert len(aws.tasks) == 2
+
+    # Started machines become ready on the next refresh, no more tasks are started
+    MachineChallenge.refillpool(challenge)
+    assert MachinePoolModel.query.filter_by(chall_id=challenge.id, status=1).count() == 2
+    assert len(aws.tasks) == 2
+
+
+def test_refillpool_shrinks_to_pool_size(app, aws):
+    challenge = gen_machine_challenge(pool_size=3)
+    MachineChallenge.refillpool(challenge)
+
+    challenge.pool_size = 1
+    db.session.commit()
+    MachineChallenge.refillpool(challenge)
+    assert MachinePoolModel.query.filter(MachinePoolModel.status != 2).count() == 1
+    assert len([task for task in aws.tasks.values() if task['stoppedAt'] == None]) == 1
+
+
+def test_startmachine_claims_ready_pooled_machine(app, aws):
+    challenge = gen_machine_challenge(pool_size=1)
+    MachineChallenge.refillpool(challenge)
+    MachineChallenge.refillpool(challenge)
+    pooled_task = MachinePoolModel.query.filter_by(chall_id=challenge.id, status=1).first().task_id
+
+    machine_log = MachineChallenge.startmachine(gen_user(), challenge)
+    assert machine_log.task_id == pooled_task
+    assert json.loads(machine_log.detail)['lastStatus'] == 'RUNNING'
+    assert MachinePoolModel.query.filter_by(chall_id=challenge.id).count() == 0
+    assert len(aws.tasks) == 1
+
+
+def test_claimpool_gives_a_pooled_machine_to_a_single_request(app, aws):
+    challenge = gen_machine_challenge(pool_size=1)
+    MachineChallenge.refillpool(challenge)
+    MachineChallenge.refillpool(challenge)
+
+    def claim(challenge_id):
+        detail = MachineChallenge.claimpool(MachineChallModel.query.filter_by(id=challenge_id).first())
+        db.session.commit()
+        return detail
+
+    results = run_concurrently(app, claim, *[(challenge.id,)] * 4)
+    assert [error for _, error in results] == [None] * 4
+    claimed = [detail for detail, _ in results if detail != None]
+    assert len(claimed) == 1
+    assert MachinePoolModel.query.filter_by(chall_id=challenge.id).count() == 0
@@ -0,0 +1,52 @@
+from CTFd.models import db
+from CTFd.plugins.machine_challenges import provision
+from CTFd.plugins.machine_challenges.models import MachineActiveModel, MachineChallenge, MachineLogModel
+
+from helpers import gen_machine_challenge, gen_user
+
+from datetime import datetime, timedelta
+
+import json
+
+
+def age(machine_log, minutes):
+    MachineLogModel.query.filter_by(id=machine_log.id).update({'time_str': datetime.utcnow() - timedelta(minutes=minutes)})
+    db.session.commit()
+
+
+def test_lost_provisioning_jobs_are_failed(app, monkeypatch):
+    # The worker running the job died
+    monkeypatch.setattr(provision, 'submit', lambda func, *args: None)
+    user, challenge = gen_user(), gen_machine_challenge()
+    stale = MachineChallenge.startmachine(user, challenge)
+    fresh = MachineChallenge.startmachine(gen_user('fresh'), challenge)
+    age(stale, 20)
+
+    assert MachineChallenge.failstaleprovisioning(timedelta(minutes=10)) == 1
+    assert MachineActiveModel.query.filter_by(log_id=stale.id).count() == 0
+    assert json.loads(MachineLogModel.query.filter_by(id=stale.id).first().detail)['lastStatus'] == 'FAILED'
+    assert MachineActiveModel.query.filter_by(log_id=fresh.id).first().last_status == 'PROVISIONING'
+
+    # The slot of the user is free again
+    monkeypatch.setattr(provision, 'submit', lambda func, *args: func(*args))
+    MachineChallenge.startmachine(user, challenge)
+
+
+def test_late_provisioning_job_stops_its_task(app, aws, monkeypatch):
+    launch = MachineChallenge.launchmachine
+    monkeypatch.setattr(provision, 'submit', lambda func, *args: None)
+    machine_log = MachineChallenge.startmachine(gen_user(), gen_machine_challenge())
+    age(machine_log, 20)
+
+    # The machine times out while its task is being started
+    def slow_launch(challenge):
+        stt_machine = launch(challenge)
+        MachineChallenge.failstaleprovisioning(timedelta(minutes=10))
+        return stt_machine
+    monkeypatch.setattr(MachineChallenge, 'launchmachine', slow_launch)
+
+    MachineChallenge.provisionmachine(machine_log.id)
+    machine_log = MachineLogModel.query.filter_by(id=machine_log.id).first()
+    assert machine_log.status == 2
+    assert aws.tasks[machine_log.task_id]['stoppedAt'] != None
+    assert MachineActiveModel.query.count() == 0
@@ -0,0 +1,63 @@
+from CTFd.models import db
+from CTFd.plugins.machine_challenges import expiry, utils
+from CTFd.plugins.machine_challenges.models import MachineActiveModel, MachineChallenge, MachineLogModel, state_version
+
+from helpers import gen_machine_challenge, gen_user
+
+from datetime import datetime, timedelta, timezone
+
+
+def age(machine_log, minutes):
+    machine_log.time_str = datetime.utcnow() - timedelta(minutes=minutes)
+    db.session.commit()
+
+
+def test_fresh_machines_missing_from_listing_are_kept(app, aws, monkeypatch):
+    machine_log = MachineChallenge.startmachine(gen_user(), gen_machine_challenge())
+    monkeypatch.setattr(utils, 'ecs_describe_cluster_tasks', lambda prefix: [])
+
+    assert MachineChallenge.reconcilemachines() == (0, 0)
+    assert MachineActiveModel.query.filter_by(log_id=machine_log.id).count() == 1
+    assert aws.tasks[machine_log.task_id]['stoppedAt'] == None
+
+
+def test_lost_machines_are_terminated_and_stopped(app, aws, monkeypatch):
+    machine_log = MachineChallenge.startmachine(gen_user(), gen_machine_challenge())
+    task_id = machine_log.task_id
+    age(machine_log, 10)
+    monkeypatch.setattr(utils, 'ecs_describe_cluster_tasks', lambda prefix: [])
+
+    assert MachineChallenge.reconcilemachines() == (0, 1)
+    assert MachineActiveModel.query.count() == 0
+    assert MachineLogModel.query.filter_by(id=machine_log.id).first().status == 2
+    # Still running in the cluster but missed by the listing
+    assert aws.tasks[task_id]['stoppedAt'] != None
+
+
+def test_old_orphaned_tasks_are_stopped(app, aws):
+    challenge = gen_machine_challenge()
+    MachineChallenge.startmachine(gen_user(), challenge)
+    orphan = utils.get_client('ecs').run_task(taskDefinition=challenge.task_arn, cluster='test')['tasks'][0]['taskArn']
+    fresh = utils.get_client('ecs').run_task(taskDefinition=challenge.task_arn, cluster='test')['tasks'][0]['taskArn']
+    aws.tasks[orphan]['createdAt'] = datetime.now(timezone.utc) - timedelta(minutes=10)
+
+    assert MachineChallenge.reconcilemachines() == (1, 0)
+    assert aws.tasks[orphan]['stoppedAt'] != None
+    assert aws.tasks[fresh]['stoppedAt'] == None
+    assert MachineActiveModel.query.count() == 1
+
+
+def test_refresh_retires_machines_whose_task_is_gone(app, aws):
+    user, challenge = gen_user(), gen_machine_challenge()
+    machine_log = MachineChallenge.startmachine(user, challenge)
+    version = state_version(user.id, challenge.id)
+    # Crashed and already forgotten by ECS
+    del aws.tasks[machine_log.task_id]
+
+    MachineChallenge.refreshmachines(full=True)
+    assert MachineActiveModel.query.filter_by(log_id=machine_log.id).count() == 0
+    assert MachineLogModel.query.filter_by(id=machine_log.id).first().status == 2
+    assert machine_log.id not in expiry.scheduler.deadlines
+    assert state_version(user.id, challenge.id) != version
+    # The slot of the user is free again
+    MachineChallenge.startmachine(user, challenge)
@@ -0,0 +1,75 @@
+from CTFd.models import db
+from CTFd.plugins.machine_challenges import utils
+from CTFd.plugins.machine_challenges.models import MachineChallenge, MachineLogModel, MachineSecGroupModel
+
+from helpers import TASK_CONFIG, gen_machine_challenge, gen_user
+
+from datetime import datetime
+
+import json
+import sqlalchemy as sa
+
+
+def test_machines_of_the_same_rules_share_a_security_group(app, aws):
+    challenge = gen_machine_challenge()
+    MachineChallenge.startmachine(gen_user('first'), challenge)
+    MachineChallenge.startmachine(gen_user('second'), challenge)
+
+    secgroup = MachineSecGroupModel.query.one()
+    assert secgroup.refcount == 2
+    assert list(aws.secgroups) == [secgroup.group_id]
+
+
+def test_released_reference_survives_empty_eni_lookup(app, aws, monkeypatch):
+    user, challenge = gen_user(), gen_machine_challenge()
+    machine_log = MachineChallenge.startmachine(user, challenge)
+    group_id = MachineSecGroupModel.query.one().group_id
+
+    # Right after RUNNING the ENI is often not visible yet
+    monkeypatch.setattr(utils, 'fargate_describe_enis', lambda eni_ids: {})
+    MachineChallenge.refreshmachines(full=True)
+    assert json.loads(MachineLogModel.query.filter_by(id=machine_log.id).first().detail)['securityGroupId'] == [group_id]
+
+    MachineChallenge.terminatemachine(user, challenge)
+    machine_log = MachineLogModel.query.filter_by(id=machine_log.id).first()
+    MachineChallenge.releasesecgroups(machine_log.detail)
+    db.session.commit()
+    assert MachineSecGroupModel.query.one().refcount == 0
+
+
+def test_cleansecgroups_deletes_only_unused_groups(app, aws):
+    networks = {'inbound': [], 'outbound': []}
+    unused = MachineSecGroupModel(rules_hash='unused', refcount=0, time_str=datetime.utcnow(),
+                                  group_id=utils.ec2_create_secgroup('ctf-sg-unused', 'unused', networks))
+    referenced = MachineSecGroupModel(rules_hash='referenced', refcount=1, time_str=datetime.utcnow(),
+                                      group_id=utils.ec2_create_secgroup('ctf-sg-referenced', 'referenced', networks))
+    db.session.add_all([unused, referenced])
+    db.session.commit()
+    unused_id, referenced_id = unused.group_id, referenced.group_id
+
+    MachineChallenge.cleansecgroups()
+    assert [secgroup.rules_hash for secgroup in MachineSecGroupModel.query.all()] == ['referenced']
+    assert unused_id not in aws.secgroups
+    assert referenced_id in aws.secgroups
+
+
+def test_cleansecgroups_keeps_group_acquired_meanwhile(app, aws):
+    group_id = MachineChallenge.acquiresecgroup(TASK_CONFIG['networks'])
+    MachineSecGroupModel.query.update({'refcount': 0, 'rules_hash': 'stale'})
+    db.session.commit()
+
+    # A launch takes a reference between the listing and the deletion
+    def acquire_before_delete(orm_execute_state):
+        if orm_execute_state.is_delete and orm_execute_state.session.info.pop('acquire', False):
+            orm_execute_state.session.execute(
+                sa.update(MachineSecGroupModel).values(refcount=MachineSecGroupModel.refcount + 1)
+            )
+    db.session.info['acquire'] = True
+    sa.event.listen(db.session, 'do_orm_execute', acquire_before_delete)
+    try:
+        MachineChallenge.cleansecgroups()
+    finally:
+        sa.event.remove(db.session, 'do_orm_execute', acquire_before_delete)
+
+    assert MachineSecGroupModel.query.one().refcount == 1
+    assert group_id in aws.secgroups
@@ -0,0 +1,61 @@
+from CTFd.models import Challenges, Users, db
+from CTFd.plugins.machine_challenges.models import MachineActiveModel, MachineChallenge, start_lock
+from CTFd.utils import set_config
+
+from helpers import gen_machine_challenge, gen_user, run_concurrently
+
+import pytest
+
+
+def start(user_id, challenge_id):
+    return MachineChallenge.startmachine(
+        Users.query.filter_by(id=user_id).first(),
+        Challenges.query.filter_by(id=challenge_id).first()
+    ).id
+
+
+def test_startmachine_enforces_user_limit(app):
+    user = gen_user()
+    first, second = gen_machine_challenge('first'), gen_machine_challenge('second')
+
+    MachineChallenge.startmachine(user, first)
+    with pytest.raises(Exception, match='maximum machine limit'):
+        MachineChallenge.startmachine(user, second)
+    assert MachineActiveModel.query.filter_by(user_id=user.id).count() == 1
+
+
+def test_concurrent_starts_of_a_user_pass_the_limit_once(app):
+    set_config('MACHINECHALL_USER_LIMIT', 1)
+    user = gen_user()
+    challenges = [gen_machine_challenge(f"machine {i}") for i in range(4)]
+
+    results = run_concurrently(app, start, *[(user.id, challenge.id) for challenge in challenges])
+    assert len([machine_id for machine_id, _ in results if machine_id != None]) == 1
+    db.session.expire_all()
+    assert MachineActiveModel.query.filter_by(user_id=user.id).count() == 1
+
+
+def test_concurrent_starts_of_different_users_are_not_serialized(app):
+    users = [gen_user(f"player{i}") for i in range(3)]
+    challenge = gen_machine_challenge()
+
+    results = run_concurrently(app, start, *[(user.id, challenge.id) for user in users])
+    assert [error for _, error in results] == [None] * 3
+
+
+def test_start_lock_is_released_on_error(app):
+    user = gen_user()
+    with pytest.raises(ValueError):
+        with start_lock(user.id):
+            raise ValueError()
+    with start_lock(user.id):
+        pass
+
+
+def test_zero_user_limit_is_unlimited(app):
+    set_config('MACHINECHALL_USER_LIMIT', 0)
+    user = gen_user()
+
+    for i in range(3):
+        MachineChallenge.startmachine(user, gen_machine_challenge(f"machine {i}"))
+    assert MachineActiveModel.query.filter_by(user_id=user.id).count() == 3
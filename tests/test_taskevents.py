@@ -0,0 +1,89 @@
+from CTFd.models import db
+from CTFd.plugins.machine_challenges import events, utils
+from CTFd.plugins.machine_challenges.models import MachineActiveModel, MachineChallenge, MachineLogModel
+
+from helpers import gen_machine_challenge, gen_user
+
+import json
+import threading
+import time
+
+
+def consume_once(app, sqs):
+    """
+    Run the consumer for a single receive of the queue.
+    """
+    stop_event = threading.Event()
+
+    class Once(object):
+        def receive_message(self, **kwargs):
+            stop_event.set()
+            return sqs.receive_message(**kwargs)
+
+        def delete_message_batch(self, **kwargs):
+            return sqs.delete_message_batch(**kwargs)
+
+    events.consume(app, 'queue', Once(), stop_event, wait_time=0)
+    db.session.expire_all()
+
+
+def test_running_event_fills_network(app, aws):
+    aws.start_delay = 0.2
+    machine_log = MachineChallenge.startmachine(gen_user(), gen_machine_challenge())
+    active_machine = MachineActiveModel.query.filter_by(log_id=machine_log.id).first()
+    assert active_machine.last_status != 'RUNNING'
+    assert active_machine.public_ip == ''
+
+    time.sleep(0.3)
+    consume_once(app, utils.get_client('sqs'))
+    active_machine = MachineActiveModel.query.filter_by(log_id=machine_log.id).first()
+    assert active_machine.last_status == 'RUNNING'
+    assert active_machine.public_ip == aws.tasks[active_machine.task_id]['publicIp']
+    assert json.loads(active_machine.ports)[0]['portMappings'][0]['hostPort'] == 80
+    assert aws.inflight == {}
+
+
+def test_stopped_event_retires_machine(app, aws):
+    machine_log = MachineChallenge.startmachine(gen_user(), gen_machine_challenge())
+    consume_once(app, utils.get_client('sqs'))
+
+    # Stopped outside of the plugin
+    utils.get_client('ecs').stop_task(cluster='test', task=machine_log.task_id)
+    consume_once(app, utils.get_client('sqs'))
+    assert MachineActiveModel.query.filter_by(log_id=machine_log.id).count() == 0
+    assert MachineLogModel.query.filter_by(id=machine_log.id).first().status == 2
+
+
+def test_parse_messages_unwraps_sns_and_skips_malformed(app, aws):
+    detail = {'taskArn': 'arn:task', 'lastStatus': 'RUNNING'}
+    event = json.dumps({'detail-type': events.TASK_STATE_CHANGE, 'detail': detail})
+    messages = [
+        {'MessageId': '1', 'Body': event},
+        {'MessageId': '2', 'Body': json.dumps({'Type': 'Notification', 'Message': event})},
+        {'MessageId': '3', 'Body': 'not json'},
+        {'MessageId': '4', 'Body': json.dumps({'detail-type': 'ECS Container Instance State Change', 'detail': detail})},
+        {'MessageId': '5', 'Body': json.dumps({'detail-type': events.TASK_STATE_CHANGE, 'detail': {}})},
+    ]
+    assert events.parse_messages(messages) == [detail, detail]
+
+
+def test_malformed_messages_are_deleted(app, aws):
+    sqs = utils.get_client('sqs')
+    sqs.send_message(QueueUrl='queue', MessageBody='not json')
+    sqs.send_message(QueueUrl='queue', MessageBody=json.dumps({'Type': 'Notification', 'Message': '{'}))
+
+    consume_once(app, sqs)
+    assert aws.messages == []
+    assert aws.inflight == {}
+
+
+def test_failed_batch_is_not_deleted(app, aws, monkeypatch):
+    MachineChallenge.startmachine(gen_user(), gen_machine_challenge())
+
+    def fail(runtasks):
+        raise Exception('Database is gone')
+    monkeypatch.setattr(MachineChallenge, 'applytaskevents', fail)
+    monkeypatch.setattr(events, 'RETRY_DELAY', 0)
+
+    consume_once(app, utils.get_client('sqs'))
+    assert len(aws.inflight) == 1
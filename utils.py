@@ -1,8 +1,21 @@
 from os import urandom
+from . import metrics, ratelimit
 from .config import MachineEcsConfig
 
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from CTFd.utils import get_config
+
 import boto3
+import hashlib
 import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger('machine')
 
 awssession = boto3.Session(
     aws_access_key_id=MachineEcsConfig.AWS_ACCESS_KEY_ID,
@@ -10,59 +23,178 @@ awssession = boto3.Session(
     region_name=MachineEcsConfig.AWS_REGION_NAME
 )
 
-def ecs_register_task(slug, cfg_str):
-    if cfg_str == "" or cfg_str == None: return None
-    client = awssession.client('ecs')
+# Clients are thread-safe, so each service client is built once per process and shared.
+# client_config is replaced from the plugin configuration in load().
+client_config = Config(
+    max_pool_connections=50,
+    retries={'mode': 'adaptive', 'max_attempts': 5},
+    connect_timeout=5,
+    read_timeout=30
+)
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(service, endpoint_url = None):
+    key = (service, endpoint_url)
+    client = _clients.get(key)
+    if client == None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client == None:
+                client = awssession.client(service, config=client_config, endpoint_url=endpoint_url)
+                ratelimit.limiter.register(client)
+                metrics.instrument(client)
+                _clients[key] = client
+    return client
+
+
+# ECS task lifecycle, used to ignore task state changes received out of order
+TASK_STATUS_ORDER = [
+    'PROVISIONING', 'PENDING', 'ACTIVATING', 'RUNNING',
+    'DEACTIVATING', 'STOPPING', 'DEPROVISIONING', 'STOPPED'
+]
+
+def task_status_rank(status):
+    if status in TASK_STATUS_ORDER:
+        return TASK_STATUS_ORDER.index(status)
+    return -1
+
+
+# Parsed challenge configs by slug, along with the config string they were parsed from
+_configs = {}
+
+def parse_config(slug, cfg_str):
+    """
+    Parse a challenge config, memoized until the config of the challenge changes.
+    The returned dictionary is shared, callers must not modify it.
+    """
+    cached = _configs.get(slug)
+    if cached != None and cached[0] == cfg_str:
+        return cached[1]
+    cfg = json.loads(cfg_str)
+    _configs[slug] = (cfg_str, cfg)
+    return cfg
+
+
+def invalidate_config(slug):
+    _configs.pop(slug, None)
+
+
+def task_definition_hash(task_def):
+    """
+    Hash of the task definition content, insensitive to whitespace and key order.
+    """
+    canonical = json.dumps(task_def, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+@metrics.aws_helper
+def ecs_register_task(slug, cfg_str, task_hash = None):
+    """
+    Register the task definition of a challenge config, unless it has the same content as task_hash.
+
+    :param slug: challenge slug, used as task definition family
+    :param cfg_str: challenge config
+    :param task_hash: hash of the currently registered task definition
+    :return: tuple of formatted config, task definition hash and new revision ARN (None when nothing was registered)
+    """
+    if cfg_str == "" or cfg_str == None: return None, None, None
+    client = get_client('ecs')
 
     cfg = json.loads(cfg_str)
     task_def = cfg['taskDefinition']
     task_def['family'] = slug
-    
-    client.register_task_definition(**task_def)
-    return json.dumps(cfg, indent=2)
+    new_hash = task_definition_hash(task_def)
+    invalidate_config(slug)
+    if new_hash == task_hash:
+        return json.dumps(cfg, indent=2), new_hash, None
+
+    r = client.register_task_definition(**task_def)
+    return json.dumps(cfg, indent=2), new_hash, r['taskDefinition']['taskDefinitionArn']
+
+
+@metrics.aws_helper
+def ecs_list_families(prefix):
+    paginator = get_client('ecs').get_paginator('list_task_definition_families')
+    families = []
+    for page in paginator.paginate(familyPrefix=prefix, status='ACTIVE'):
+        families.extend(page['families'])
+    return families
 
 
-def ecs_delete_task(slug):
-    client = awssession.client('ecs')
+@metrics.aws_helper
+def ecs_list_task_revisions(family):
+    paginator = get_client('ecs').get_paginator('list_task_definitions')
+    taskDefinitionArns = []
+    for page in paginator.paginate(familyPrefix=family, status='ACTIVE'):
+        taskDefinitionArns.extend(page['taskDefinitionArns'])
+    return taskDefinitionArns
 
-    def delete_task_revision():
-        r = client.list_task_definitions(familyPrefix=slug)
-        task_list = r['taskDefinitionArns']
-        for arn in task_list:
-            client.deregister_task_definition(taskDefinition=arn)
-        return r.get('nextToken')
-        
-    nextToken = delete_task_revision()
-    while nextToken:
-        nextToken = delete_task_revision()
 
-    ecs_terminate_multimachine(slug)
+@metrics.aws_helper
+def ecs_list_family_tasks(family):
+    paginator = get_client('ecs').get_paginator('list_tasks')
+    taskArns = []
+    for page in paginator.paginate(cluster=MachineEcsConfig.AWS_ECS_CLUSTER, family=family):
+        taskArns.extend(page['taskArns'])
+    return taskArns
 
 
-def ecs_delete_multitask(prefix):    
-    client = awssession.client('ecs')
+@metrics.aws_helper
+def ecs_deregister_task(taskDefinitionArn):
+    """
+    Deregister a task definition revision, throttled calls are retried by the adaptive client.
 
-    nextToken = "init"
-    while nextToken:
-        if nextToken == "init": nextToken = ""
-        r = client.list_task_definition_families(familyPrefix=prefix, status="ACTIVE", nextToken=nextToken)
-        for family in r['families']:
-            ecs_delete_task(family)
-        nextToken = r.get('nextToken')
+    :return: None on success, or the error message
+    """
+    try:
+        get_client('ecs').deregister_task_definition(taskDefinition=taskDefinitionArn)
+    except Exception as e:
+        return str(e)
+    return None
 
 
-def fargate_get_networks(runtask, resp):
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def fargate_get_eni_id(runtask):
     for attachment in runtask.get("attachments", []):
         for detail in attachment.get("details", []):
             if detail.get("name") == "networkInterfaceId":
-                eni_id = detail.get("value")
-                eni = awssession.resource('ec2').NetworkInterface(eni_id)
-                
-                resp['networkInterfaceId'] = eni_id
-                resp['publicIp'] = eni.association_attribute['PublicIp']
-                resp['subnetId'] = eni.subnet_id
-                for secgroup in eni.groups:
-                    resp['securityGroupId'].append(secgroup['GroupId'])
+                return detail.get("value")
+    return None
+
+
+@metrics.aws_helper
+def fargate_describe_enis(eni_ids):
+    ec2 = get_client('ec2')
+    enis = {}
+    for ids in chunks(list(eni_ids), 100):
+        # Filter instead of NetworkInterfaceIds, so a deleted ENI doesn't fail the whole batch
+        r = ec2.describe_network_interfaces(Filters=[{'Name': 'network-interface-id', 'Values': ids}])
+        for eni in r['NetworkInterfaces']:
+            enis[eni['NetworkInterfaceId']] = eni
+    return enis
+
+
+def fargate_get_networks(runtask, resp, enis = None):
+    eni_id = fargate_get_eni_id(runtask)
+    if eni_id == None:
+        return
+    if enis == None:
+        enis = fargate_describe_enis([eni_id])
+    eni = enis.get(eni_id)
+    if eni == None:
+        return
+
+    resp['networkInterfaceId'] = eni_id
+    resp['publicIp'] = eni.get('Association', {}).get('PublicIp', '')
+    resp['subnetId'] = eni['SubnetId']
+    # The groups given to run_task are the ones to release, the ENI only fills in older details
+    if len(resp.get('securityGroupId') or []) == 0:
+        resp['securityGroupId'] = [secgroup['GroupId'] for secgroup in eni['Groups']]
 
 
 def fargate_get_containers(taskDef):
@@ -73,37 +205,45 @@ def fargate_get_containers(taskDef):
             'portMappings': []
         }
         for port in container['portMappings']:
-            port['hostPort'] = port['containerPort']
-            accum['portMappings'].append(port)
+            accum['portMappings'].append(dict(port, hostPort=port['containerPort']))
         if len(accum['portMappings']) > 0:
             containers.append(accum)
     return containers
 
 
-def external_get_networks(runtask, resp):
-    ecs = awssession.client('ecs')
-    ssm = awssession.client('ssm')
-
-    containers = ecs.describe_container_instances(
-        cluster=MachineEcsConfig.AWS_ECS_CLUSTER,
-        containerInstances=[
-            runtask['containerInstanceArn'],
-        ]
-    )
-    container = containers['containerInstances'][0]
-
-    instances = ssm.describe_instance_information(
-        InstanceInformationFilterList=[
-            {
-                'key': 'InstanceIds',
-                'valueSet': [
-                    container['ec2InstanceId'],
-                ]
-            },
-        ],
-    )
-    instance = instances['InstanceInformationList'][0]
-    resp['publicIp'] = instance['IPAddress']
+@metrics.aws_helper
+def external_describe_instance_ips(containerInstanceArns):
+    ecs = get_client('ecs')
+    ssm = get_client('ssm')
+
+    instance_ids = {}
+    for arns in chunks(list(containerInstanceArns), 100):
+        containers = ecs.describe_container_instances(
+            cluster=MachineEcsConfig.AWS_ECS_CLUSTER,
+            containerInstances=arns
+        )
+        for container in containers['containerInstances']:
+            instance_ids[container['ec2InstanceId']] = container['containerInstanceArn']
+
+    instance_ips = {}
+    for ids in chunks(list(instance_ids), 50):
+        instances = ssm.describe_instance_information(
+            InstanceInformationFilterList=[
+                {
+                    'key': 'InstanceIds',
+                    'valueSet': ids
+                },
+            ],
+        )
+        for instance in instances['InstanceInformationList']:
+            instance_ips[instance_ids[instance['InstanceId']]] = instance['IPAddress']
+    return instance_ips
+
+
+def external_get_networks(runtask, resp, instance_ips = None):
+    if instance_ips == None:
+        instance_ips = external_describe_instance_ips([runtask['containerInstanceArn']])
+    resp['publicIp'] = instance_ips.get(runtask['containerInstanceArn'], '')
 
 
 def external_get_containers(cfg):
@@ -125,7 +265,7 @@ def external_get_containers(cfg):
     return containers
 
 
-def parse_runtask_response(runtask, cfg = None, old = None):
+def parse_runtask_response(runtask, cfg = None, old = None, enis = None, instance_ips = None):
     resp = {
         "launchType": runtask['launchType'],
         "taskArn": runtask['taskArn'],
@@ -136,7 +276,7 @@ def parse_runtask_response(runtask, cfg = None, old = None):
         "subnetId": "",
         "securityGroupId": []
     }
-    if old != None: resp = old
+    if old != None: resp = dict(old)
 
     resp['lastStatus'] = runtask['lastStatus']
     resp['desiredStatus'] = runtask['desiredStatus']
@@ -146,48 +286,126 @@ def parse_runtask_response(runtask, cfg = None, old = None):
             resp['containers'] = fargate_get_containers(cfg['taskDefinition'])
     if runtask['lastStatus'] == 'RUNNING':
         if runtask['launchType'] == 'FARGATE':
-            resp['securityGroupId'] = list()
-            fargate_get_networks(runtask, resp)
+            fargate_get_networks(runtask, resp, enis)
         else:
             resp['containers'] = list()
             resp['containers'] = external_get_containers(runtask)
-            external_get_networks(runtask, resp)
+            external_get_networks(runtask, resp, instance_ips)
     return resp
 
 
-def generate_network_conf(slug, networks_opt):
-    ec2 = boto3.resource(
-        'ec2',
-        aws_access_key_id=MachineEcsConfig.AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=MachineEcsConfig.AWS_SECRET_ACCESS_KEY,
-        region_name=MachineEcsConfig.AWS_REGION_NAME
-    )
-    vpc = ec2.Vpc(MachineEcsConfig.AWS_VPC_ID)
-    subnets_it = vpc.subnets.all()
-    subnets = [elm for elm in subnets_it]
-    if len(subnets) == 0:
-        subnet = vpc.create_subnet(CidrBlock='172.0.0.0/16')
-    else:
-        subnet = subnets[0]
-
-    secgroup = vpc.create_security_group(GroupName=f'ctf-sg-{urandom(8).hex()}', Description = slug)
+@metrics.aws_helper
+def ec2_create_secgroup(name, description, networks_opt):
+    """
+    Create a security group in the challenge VPC and authorize its rules.
+    An existing group with the same name is returned as is.
+
+    :return: security group id
+    """
+    ec2 = get_client('ec2')
+    try:
+        secgroup = ec2.create_security_group(
+            GroupName=name,
+            Description=description,
+            VpcId=MachineEcsConfig.AWS_VPC_ID
+        )
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'InvalidGroup.Duplicate':
+            raise
+        secgroups = ec2.describe_security_groups(Filters=[
+            {'Name': 'group-name', 'Values': [name]},
+            {'Name': 'vpc-id', 'Values': [MachineEcsConfig.AWS_VPC_ID]},
+        ])
+        return secgroups['SecurityGroups'][0]['GroupId']
+
+    secgroup_id = secgroup['GroupId']
     for rule in networks_opt.get('inbound', []):
-        secgroup.authorize_ingress(**rule)
+        ec2.authorize_security_group_ingress(GroupId=secgroup_id, **rule)
     for rule in networks_opt.get('outbound', []):
-        secgroup.authorize_egress(**rule)
+        ec2.authorize_security_group_egress(GroupId=secgroup_id, **rule)
+    return secgroup_id
+
+
+@metrics.aws_helper
+def ec2_delete_secgroup(secgroup_id):
+    ec2 = get_client('ec2')
+    ec2.delete_security_group(GroupId=secgroup_id)
+
+
+class SubnetInventory(object):
+    """
+    Cached list of the VPC subnets. Launches are spread round-robin across
+    availability zones and then to the subnet with the most free addresses.
+    """
+    def __init__(self, ttl = 300):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.subnets = []
+        self.expires = 0
+        self.launches = Counter()
+
+    def invalidate(self):
+        with self.lock:
+            self.expires = 0
+
+    def refresh(self):
+        ec2 = get_client('ec2')
+        subnets = []
+        paginator = ec2.get_paginator('describe_subnets')
+        for page in paginator.paginate(Filters=[{'Name': 'vpc-id', 'Values': [MachineEcsConfig.AWS_VPC_ID]}]):
+            subnets.extend(page['Subnets'])
+        if len(subnets) == 0:
+            subnets.append(ec2.create_subnet(VpcId=MachineEcsConfig.AWS_VPC_ID, CidrBlock='172.0.0.0/16')['Subnet'])
+
+        with self.lock:
+            self.subnets = [{
+                'id': subnet['SubnetId'],
+                'az': subnet['AvailabilityZone'],
+                'available': subnet['AvailableIpAddressCount'],
+            } for subnet in subnets]
+            self.launches = Counter()
+            self.expires = time.monotonic() + self.ttl
+
+    def pick(self):
+        if time.monotonic() >= self.expires:
+            self.refresh()
+
+        with self.lock:
+            def free(subnet):
+                return subnet['available'] - self.launches[subnet['id']]
+
+            # Skip nearly exhausted subnets unless nothing else is left
+            subnets = [subnet for subnet in self.subnets if free(subnet) > 4] or self.subnets
+            az_launches = Counter()
+            for subnet in subnets:
+                az_launches[subnet['az']] += self.launches[subnet['id']]
+
+            subnet = min(subnets, key=lambda subnet: (az_launches[subnet['az']], -free(subnet)))
+            self.launches[subnet['id']] += 1
+            return subnet['id']
+
+subnet_inventory = SubnetInventory()
+
+
+def generate_network_conf(slug, networks_opt, secgroup_id = None):
+    subnet_id = subnet_inventory.pick()
+
+    if secgroup_id == None:
+        secgroup_id = ec2_create_secgroup(f'ctf-sg-{urandom(8).hex()}', slug, networks_opt)
     return {
         'awsvpcConfiguration': {
-            'subnets': [subnet.id],
-            'securityGroups': [secgroup.id],
+            'subnets': [subnet_id],
+            'securityGroups': [secgroup_id],
             'assignPublicIp': 'ENABLED'
         }
     }
 
 
-def ecs_start_machine(slug, cfg_str):
-    client = awssession.client('ecs')
-    
-    cfg = json.loads(cfg_str)
+@metrics.aws_helper
+def ecs_start_machine(slug, cfg_str, secgroup_id = None, task_arn = None):
+    client = get_client('ecs')
+
+    cfg = parse_config(slug, cfg_str)
     launchType = cfg.get('launchType', 'FARGATE')
     networks = cfg.get('networks', {'inbound': [], 'outbound': []})
 
@@ -195,29 +413,106 @@ def ecs_start_machine(slug, cfg_str):
         'cluster': MachineEcsConfig.AWS_ECS_CLUSTER,
         'count': 1,
         'launchType': launchType,
-        'taskDefinition': slug
+        # The registered revision ARN spares ECS resolving the latest revision of the family
+        'taskDefinition': task_arn or slug
     }
 
     if launchType == "FARGATE":
-        runtask_options['networkConfiguration'] = generate_network_conf(slug, networks)
-    
-    runtask_resp = client.run_task(**runtask_options)['tasks'][0]
-    return parse_runtask_response(runtask_resp, cfg)
-
+        runtask_options['networkConfiguration'] = generate_network_conf(slug, networks, secgroup_id)
 
-def ecs_update_machine(oldStt_str):
-    client = awssession.client('ecs')
-    oldStt = json.loads(oldStt_str)
-    taskArn = oldStt['taskArn']
+    runtask = client.run_task(**runtask_options)
+    if len(runtask['tasks']) == 0:
+        # Capacity or addressing problems, the subnets will be looked up again on the next launch
+        subnet_inventory.invalidate()
+        reasons = [failure.get('reason', '') for failure in runtask.get('failures', [])]
+        raise Exception(f"Failed to run task: {', '.join(reasons)}")
 
-    resp = client.describe_tasks(cluster=MachineEcsConfig.AWS_ECS_CLUSTER, tasks=[taskArn])
-    runtask_resp = resp['tasks'][0]
-
-    return parse_runtask_response(runtask_resp, old = oldStt)
+    runtask_resp = runtask['tasks'][0]
+    resp = parse_runtask_response(runtask_resp, cfg)
+    if launchType == "FARGATE":
+        # Remember the security group before the ENI is attached, so it can always be released
+        resp['securityGroupId'] = list(runtask_options['networkConfiguration']['awsvpcConfiguration']['securityGroups'])
+    return resp
 
 
+@metrics.aws_helper
+def ecs_update_multimachine(oldStts):
+    """
+    Refresh many machines at once. Tasks are described 100 ARNs per call
+    and their network interfaces or container instances are looked up in batches.
+
+    :param oldStts: list of machine detail dictionaries
+    :return: dictionary of taskArn to the new machine detail
+    """
+    client = get_client('ecs')
+    oldStts = {oldStt['taskArn']: oldStt for oldStt in oldStts}
+
+    runtasks = []
+    resps = {}
+    for taskArns in chunks(list(oldStts), 100):
+        resp = client.describe_tasks(cluster=MachineEcsConfig.AWS_ECS_CLUSTER, tasks=taskArns)
+        runtasks.extend(resp['tasks'])
+        for failure in resp.get('failures', []):
+            # Stopped tasks are forgotten by ECS after a while
+            if failure.get('reason') == 'MISSING' and failure.get('arn') in oldStts:
+                missing = dict(oldStts[failure['arn']])
+                missing['lastStatus'] = 'STOPPED'
+                missing['desiredStatus'] = 'STOPPED'
+                resps[failure['arn']] = missing
+
+    resps.update(parse_multitask_response(runtasks, oldStts))
+    return resps
+
+
+def parse_multitask_response(runtasks, oldStts):
+    """
+    Parse many task descriptions at once, looking up their networks in batches.
+
+    :param runtasks: list of ECS task dictionaries, from describe_tasks or task state change events
+    :param oldStts: dictionary of taskArn to the old machine detail
+    :return: dictionary of taskArn to the new machine detail
+    """
+    resps = {}
+    running = [runtask for runtask in runtasks if runtask['lastStatus'] == 'RUNNING']
+    eni_ids = [fargate_get_eni_id(runtask) for runtask in running if runtask['launchType'] == 'FARGATE']
+    enis = fargate_describe_enis([eni_id for eni_id in eni_ids if eni_id != None])
+    instance_ips = external_describe_instance_ips([
+        runtask['containerInstanceArn'] for runtask in running if runtask['launchType'] != 'FARGATE'
+    ])
+
+    for runtask in runtasks:
+        old = oldStts.get(runtask['taskArn'])
+        resps[runtask['taskArn']] = parse_runtask_response(runtask, old = old, enis = enis, instance_ips = instance_ips)
+    return resps
+
+
+@metrics.aws_helper
+def ecs_describe_cluster_tasks(family_prefix):
+    """
+    Describe every task of the cluster that should be running and belongs to a task definition family with the given prefix.
+
+    :param family_prefix:
+    :return: list of ECS task dictionaries
+    """
+    client = get_client('ecs')
+    taskArns = []
+    paginator = client.get_paginator('list_tasks')
+    for page in paginator.paginate(cluster=MachineEcsConfig.AWS_ECS_CLUSTER, desiredStatus='RUNNING'):
+        taskArns.extend(page['taskArns'])
+
+    runtasks = []
+    for arns in chunks(taskArns, 100):
+        resp = client.describe_tasks(cluster=MachineEcsConfig.AWS_ECS_CLUSTER, tasks=arns)
+        for runtask in resp['tasks']:
+            family = runtask['taskDefinitionArn'].split('/')[-1].split(':')[0]
+            if family.startswith(family_prefix):
+                runtasks.append(runtask)
+    return runtasks
+
+
+@metrics.aws_helper
 def ecs_terminate_machine(taskArn):
-    ecs = awssession.client('ecs')
+    ecs = get_client('ecs')
     ecs.stop_task(
         cluster=MachineEcsConfig.AWS_ECS_CLUSTER,
         task=taskArn
@@ -226,18 +521,64 @@ def ecs_terminate_machine(taskArn):
     return True
 
 
-def ecs_terminate_multimachine(family):
-    client = awssession.client('ecs')
-    r = client.list_tasks(cluster=MachineEcsConfig.AWS_ECS_CLUSTER, family=family)
-    taskArns = r['taskArns']
-    for task in taskArns:
-        ecs_terminate_machine(task)
-
-
-def ecs_delete_secgroup(cfg_str):
-    ec2 = awssession.client('ec2')
-    cfg = json.loads(cfg_str)
-
-    if cfg['launchType'] == 'FARGATE':
-        for secgroup in cfg.get('securityGroupId', []):
-            ec2.delete_security_group(GroupId=secgroup)
\ No newline at end of file
+@metrics.aws_helper
+def ecs_terminate_machines(taskArns, max_workers = 16):
+    """
+    Stop many tasks in parallel, retrying with backoff when ECS throttles us.
+
+    :param taskArns: list of task ARN
+    :param max_workers: maximum number of concurrent stop_task calls
+    :return: dictionary of taskArn to None on success, or the error message
+    """
+    if len(taskArns) == 0:
+        return {}
+    level = ratelimit.current_priority()
+
+    def stop(taskArn):
+        with ratelimit.priority(level):
+            return ecs_stop_task(taskArn)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(taskArns)))) as executor:
+        return dict(zip(taskArns, executor.map(stop, taskArns)))
+
+
+@metrics.aws_helper
+def ecs_stop_task(taskArn):
+    """
+    Stop a task, throttled calls are retried by the adaptive client.
+
+    :return: None on success, or the error message
+    """
+    try:
+        get_client('ecs').stop_task(cluster=MachineEcsConfig.AWS_ECS_CLUSTER, task=taskArn)
+    except ClientError as e:
+        # Tasks stopped long ago are already forgotten by ECS
+        if 'task was not found' in str(e):
+            return None
+        return str(e)
+    except Exception as e:
+        return str(e)
+    return None
+
+
+def load(app):
+    global client_config
+    ratelimit.load(
+        app,
+        budgets=get_config('MACHINECHALL_AWS_RATE_LIMITS') or None,
+        shared=bool(get_config('MACHINECHALL_AWS_RATE_LIMIT_SHARED'))
+    )
+    client_config = Config(
+        max_pool_connections=int(get_config('MACHINECHALL_AWS_MAX_POOL_CONNECTIONS') or 50),
+        retries={'mode': 'adaptive', 'max_attempts': int(get_config('MACHINECHALL_AWS_MAX_ATTEMPTS') or 5)},
+        connect_timeout=int(get_config('MACHINECHALL_AWS_CONNECT_TIMEOUT') or 5),
+        read_timeout=int(get_config('MACHINECHALL_AWS_READ_TIMEOUT') or 30)
+    )
+    with _clients_lock:
+        _clients.clear()
+
+    subnet_inventory.ttl = int(get_config('MACHINECHALL_SUBNET_TTL') or 300)
+    try:
+        subnet_inventory.refresh()
+    except Exception as e:
+        logger.error(f"Failed to load VPC subnets: {str(e)}")
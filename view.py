@@ -1,6 +1,6 @@
 from CTFd.models import Challenges, Users
 from .models import MachineChallModel, MachineChallenge, MachineLogModel
-from .utils import ecs_delete_multitask
+from .ratelimit import bulk
 
 from flask import request, Blueprint, render_template, url_for
 
@@ -9,12 +9,12 @@ from CTFd.utils.decorators import admins_only
 from CTFd.utils.helpers.models import build_model_filters
 
 @admins_only
+@bulk
 def admin_reset_mod():
     if request.method == "POST":
         data = request.form
         if data.get("challenges"):
-            MachineChallenge.terminatemachine()
-            ecs_delete_multitask("ctfd")
+            MachineChallenge.resetmachines()
             MachineChallModel.query.delete()
     return admin_reset() 
 